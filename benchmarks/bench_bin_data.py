@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the bin average engine of seabird_processes.bin_data against
+the pandas.cut and groupby mean binning it replaces, on a synthetic 24 Hz
+cruise, with a check that both give the same bins and means: with the 
+empty bins of the groupby with observed=False (pandas 2.2.2 of 
+requirements.txt) and without (empty_bins=False, observed=True).
+
+Run from the repository root:
+    python -m benchmarks.bench_bin_data
+"""
+import math
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import scripts.seabird_processes as seabird_processes
+from benchmarks.synthetic import synthetic_profile, CNV_COLUMNS
+
+#%%
+def bin_data_cut(input_df, cast, zcord, profile_id, params_out, bin_width=1., observed=False):
+    """
+    Binning with pandas.cut on a list of bin edges and a groupby mean
+    """
+    bin_df = input_df[(input_df['cast']==cast) & (input_df['prDM_QC'].astype(int)!=4)].copy(deep=True)
+    bins = list(np.arange(0, math.ceil(bin_df[zcord].max())+bin_width, bin_width))
+    bin_labels = [bi for bi in bins][1:]
+    bin_df["bin"] = pd.cut(bin_df[zcord], bins=bins, labels=bin_labels, right=False)
+    gby = [profile_id,'bin']
+    if isinstance(bin_df[profile_id].dtype, pd.CategoricalDtype):
+        bin_df[profile_id] = bin_df[profile_id].cat.remove_unused_categories()
+    bin_df = bin_df.groupby(gby, observed=observed).mean(numeric_only=True).sort_values(by=gby).reset_index(inplace=False)
+    bin_df = bin_df.drop(columns=[zcord]).rename(columns={'bin': zcord})
+    bin_df = bin_df[params_out]
+    return bin_df.dropna(subset=bin_df.columns.difference(["CTD number", "depSM"]), how="all")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=40)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--bin-width', type=float, default=1.)
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    df = pd.concat([pd.DataFrame(synthetic_profile(n_scans, seed=i), columns=columns).assign(profile='P%03d' % i)
+                    for i in range(args.profiles)], ignore_index=True)
+    df['cast'] = np.where(np.tile(np.arange(n_scans) < n_scans // 2, args.profiles), 'D', 'U')
+    df['prDM_QC'] = np.int8(1)
+    params_out = ['profile', 'prDM', 't090C', 'c0S/m', 'sal00', 'sbeox0V', 'sbeox0Mm/L']
+
+    print("%s profiles x %s scans (24 Hz), %s rows" % (args.profiles, n_scans, len(df)))
+    for empty_bins in (True, False):
+        start = time.perf_counter()
+        expected = bin_data_cut(df, 'D', 'prDM', 'profile', params_out, bin_width=args.bin_width,
+                                observed=not empty_bins)
+        t_cut = time.perf_counter() - start
+        start = time.perf_counter()
+        result = seabird_processes.bin_data(df, 'D', 'prDM', 'profile', params_out, bin_width=args.bin_width,
+                                            empty_bins=empty_bins)
+        t_engine = time.perf_counter() - start
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True),
+                                      check_exact=False)
+
+        print("empty_bins=%s, %s bins" % (empty_bins, len(result)))
+        print("\tpandas.cut + groupby mean: %.3f s" % t_cut)
+        print("\tbin_data:                  %.3f s" % t_engine)
+
+if __name__ == '__main__':
+    main()
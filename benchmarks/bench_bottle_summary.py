@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of bottle_processing.bottle_summary, the bottle summary from the
+profile data and the .bl files, against the .btl files of SBE Bottle
+Summary read by bottle_processing.sbe_btl2df, with a check that both give
+the same bottles, firing times and channel means.
+
+By default on synthetic casts, with a .btl file written in the SBE Bottle
+Summary layout from the average of the scans of each bottle. With --sbe, on
+the CNV, .btl and raw (.bl, .xmlcon) folders of a cruise processed with SBE
+Data Processing.
+
+Run from the repository root:
+    python -m benchmarks.bench_bottle_summary
+    python -m benchmarks.bench_bottle_summary --sbe CNV_FOLDER BTL_FOLDER RAW_FOLDER
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+import scripts.bottle_processing as bottle_processing
+from benchmarks.synthetic import synthetic_profile, write_xmlcon, CNV_COLUMNS
+
+# Channels of the synthetic .btl files
+BTL_COLUMNS = ['prDM', 'depSM', 't090C', 'c0S/m', 'sal00', 'sbeox0V', 'sbeox0Mm/L']
+START = pd.Timestamp('2023-06-20 10:00:00')
+
+#%%
+def write_bottle_files(raw_folder, bottle_folder, name, profile, n_bottles, seed=0):
+    """
+    Write the .bl file of a synthetic cast, with the bottles fired on the
+    upcast, and the .btl file of SBE Bottle Summary: the mean, standard
+    deviation, minimum and maximum of the scans of each bottle
+
+    Parameters:
+        raw_folder: str
+        bottle_folder: str
+        name: str
+            Cast name, e.g. 'CTD001'
+        profile: pandas.DataFrame
+            Synthetic cast at 24 Hz, scan 1 in the first row
+        n_bottles: int
+        seed: int
+    """
+    rng = np.random.default_rng(seed)
+    n_scans = len(profile)
+    # 1.5 s (36 scans) per bottle on the upcast
+    begin = np.sort(rng.choice(np.arange(n_scans // 2, n_scans - 40), n_bottles, replace=False))
+    end = begin + 35
+    fired = [START + pd.Timedelta(seconds=int(scan // 24)) for scan in end]
+    with open(os.path.join(raw_folder, name + '.bl'), 'w') as f:
+        f.write('RESET %s\r\n' % START.strftime('%b %d %Y %H:%M:%S'))
+        f.write('\r\n')
+        for i in range(n_bottles):
+            f.write('%s, %s, %s, %s, %s\r\n' % (i + 1, i + 1, fired[i].strftime('%b %d %Y %H:%M:%S'), begin[i], end[i]))
+
+    names = [col[0].upper() + col[1:] for col in BTL_COLUMNS]
+    lines = ['* Sea-Bird SBE 9 Data File:', '*END*',
+             '    Bottle        Date' + ''.join('%11s' % col for col in names),
+             '  Position        Time']
+    for i in range(n_bottles):
+        window = profile[BTL_COLUMNS].iloc[begin[i] - 1:end[i]]
+        date = fired[i].strftime('%b %d %Y')
+        lines.append('%10s    %s' % (i + 1, date) + ''.join('%11.4f' % value for value in window.mean()) + ' (avg)')
+        lines.append('%22s' % fired[i].strftime('%H:%M:%S') + ''.join('%11.4f' % value for value in window.std()) + ' (sdev)')
+        lines.append(' ' * 22 + ''.join('%11.4f' % value for value in window.min()) + ' (min)')
+        lines.append(' ' * 22 + ''.join('%11.4f' % value for value in window.max()) + ' (max)')
+    with open(os.path.join(bottle_folder, name + '.btl'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def compare(summary, btl_output):
+    """
+    Largest difference of the channel means of bottle_summary and the .btl
+    files, matched by cast and bottle
+
+    Returns:
+        pandas.DataFrame
+        Bottles of the .btl files merged with those of bottle_summary
+    """
+    btl_output = btl_output.rename(columns={col: col[0].lower() + col[1:] for col in btl_output.columns
+                                            if col[0].lower() + col[1:] in summary.columns})
+    merged = pd.merge(btl_output, summary, on=['CTD number', 'Bottle'], how='outer', suffixes=('_btl', ''),
+                      indicator=True)
+    print("\t%s bottles in the .btl files, %s from bottle_summary, %s in both"
+          % (len(btl_output), len(summary), (merged['_merge'] == 'both').sum()))
+    both = merged[merged['_merge'] == 'both']
+    time_difference = (pd.to_datetime(both['Bottle Firing Time_btl']) - pd.to_datetime(both['Bottle Firing Time'])).abs()
+    print("\tmax difference Bottle Firing Time %s" % time_difference.max())
+    for col in summary.columns:
+        if col + '_btl' in both.columns and pd.api.types.is_numeric_dtype(summary[col]):
+            difference = np.abs(pd.to_numeric(both[col + '_btl']) - both[col]).max()
+            print("\tmax difference %-12s %.2e" % (col, difference))
+    return merged
+
+def run(df, bottle_folder, raw_folder, profile_id, n_casts, n_scans=None):
+    """
+    Time sbe_btl2df and bottle_summary and compare their bottles
+    """
+    start = time.perf_counter()
+    btl_output = bottle_processing.sbe_btl2df(bottle_folder, raw_folder)
+    t_btl = time.perf_counter() - start
+    start = time.perf_counter()
+    summary = bottle_processing.bottle_summary(df, raw_folder, profile_id=profile_id)
+    t_summary = time.perf_counter() - start
+
+    print("%s casts%s, %s rows" % (n_casts, '' if n_scans is None else ' x %s scans (24 Hz)' % n_scans, len(df)))
+    print("\tsbe_btl2df (.btl files):  %.3f s" % t_btl)
+    print("\tbottle_summary (.bl):     %.3f s" % t_summary)
+    compare(summary, btl_output)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--casts', type=int, default=20)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--bottles', type=int, default=24, help='bottles fired per cast')
+    parser.add_argument('--sbe', nargs=3, metavar=('CNV_FOLDER', 'BTL_FOLDER', 'RAW_FOLDER'))
+    args = parser.parse_args()
+
+    if args.sbe:
+        # Imported here as data_processing loads the plotting modules
+        import scripts.data_processing as data_processing
+        cnv_folder, bottle_folder, raw_folder = args.sbe
+        files = [file for file in os.listdir(cnv_folder) if file.lower().endswith('.cnv')]
+        df = data_processing.cnv2df('', files, raw_folder=raw_folder, directory=cnv_folder, ud_id=False)
+        run(df, bottle_folder, raw_folder, 'profile', len(files))
+        return
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    with tempfile.TemporaryDirectory() as directory:
+        raw_folder = os.path.join(directory, 'raw_files')
+        bottle_folder = os.path.join(directory, 'bottle')
+        os.makedirs(raw_folder)
+        os.makedirs(bottle_folder)
+        profiles = []
+        for i in range(args.casts):
+            name = 'CTD%03d' % (i + 1)
+            profile = pd.DataFrame(synthetic_profile(n_scans, seed=i), columns=columns)
+            write_bottle_files(raw_folder, bottle_folder, name, profile, args.bottles, seed=i)
+            write_xmlcon(os.path.join(raw_folder, name + '.xmlcon'))
+            # Profile names of cnv2df
+            profiles.append(profile.assign(profile=name + '.CNV'))
+        df = pd.concat(profiles, ignore_index=True)
+        run(df[['profile'] + BTL_COLUMNS + ['timeS']], bottle_folder, raw_folder, 'profile', args.casts,
+            n_scans=n_scans)
+
+if __name__ == '__main__':
+    main()
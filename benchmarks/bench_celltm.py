@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the native Cell Thermal Mass correction against a scan by scan
+implementation of the SBE CellTM algorithm, on synthetic profiles, both 
+recalculating the salinity. The correction is also compared to a CNV file
+before and after Cell Thermal Mass with the MI_celltmTemplate.psa settings:
+by default the example pair in benchmarks/data (a synthetic profile 
+corrected by celltm_scan_by_scan, written by --write-example), with --sbe
+a CNV file before and after SBE Cell Thermal Mass with the same PSA file.
+
+Run from the repository root:
+    python -m benchmarks.bench_celltm
+    python -m benchmarks.bench_celltm --sbe CTD001.cnv CTD001_celltm.cnv
+"""
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import scripts.seabird_processes as seabird_processes
+from scripts.cnv_reader import read_cnv_frame
+from benchmarks.synthetic import synthetic_profile, CNV_COLUMNS
+
+# Example CNV pair before and after Cell Thermal Mass
+EXAMPLE_FILES = tuple(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', name)
+                      for name in ('celltm_example.cnv', 'celltm_example_celltm.cnv'))
+EXAMPLE_COLUMNS = ['timeS', 'prDM', 't090C', 'c0S/m', 'sal00', 'flag']
+
+#%%
+def celltm_scan_by_scan(temperature, conductivity, alpha, tau, sample_interval):
+    """
+    SBE CellTM as described in the SBE Data Processing manual, one scan at a
+    time
+
+    Returns:
+        numpy.ndarray
+        Corrected conductivity (S/m)
+    """
+    a = 2 * alpha / (sample_interval * (1 / tau) + 2)
+    b = 1 - (2 * a / alpha)
+    corrected = np.empty(len(conductivity))
+    ctm = 0.
+    for n in range(len(conductivity)):
+        if n > 0:
+            dcdt = 0.1 * (1 + 0.006 * (temperature[n] - 20))
+            ctm = -1.0 * b * ctm + a * dcdt * (temperature[n] - temperature[n - 1])
+        corrected[n] = conductivity[n] + ctm
+    return corrected
+
+def celltm_scans(df, alpha, tau, sample_interval):
+    """
+    celltm_scan_by_scan of the primary sensor of each profile, with the 
+    salinity recalculated
+
+    Returns:
+        pandas.DataFrame
+    """
+    corrected = []
+    for _, group in df.groupby('profile', sort=False):
+        group = group.copy()
+        group['c0S/m'] = celltm_scan_by_scan(group['t090C'].to_numpy(), group['c0S/m'].to_numpy(),
+                                             alpha, tau, sample_interval)
+        group['sal00'] = seabird_processes.practical_salinity(group['c0S/m'].to_numpy(), group['t090C'].to_numpy(),
+                                                              group['prDM'].to_numpy())
+        corrected.append(group)
+    return pd.concat(corrected)
+
+def write_example(minutes=0.5):
+    """
+    Write the example pair: a synthetic profile and its correction by
+    celltm_scan_by_scan with the MI_celltmTemplate.psa settings
+    """
+    # Imported here as datcnv loads the plotting modules
+    from scripts.datcnv import write_cnv
+    settings = seabird_processes.psa_xml.psa_settings(os.path.join(seabird_processes.PSA_TEMPLATE_FOLDER,
+                                                                   'MI_celltmTemplate.psa'))
+    columns = [name for name, _ in CNV_COLUMNS]
+    descriptions = dict(CNV_COLUMNS)
+    n_scans = int(minutes * 60 * 24)
+    data = pd.DataFrame(synthetic_profile(n_scans, max_pressure=100.), columns=columns)[EXAMPLE_COLUMNS]
+    data['sal00'] = seabird_processes.practical_salinity(data['c0S/m'], data['t090C'], data['prDM'])
+    os.makedirs(os.path.dirname(EXAMPLE_FILES[0]), exist_ok=True)
+    data.attrs['descriptions'] = ['%s: %s' % (col, descriptions[col]) for col in EXAMPLE_COLUMNS]
+    write_cnv(data, ['* Sea-Bird SBE 9 Data File:'], EXAMPLE_FILES[0])
+    # Corrected from the values of the input file, as SBE Cell Thermal Mass
+    data = read_cnv_frame(EXAMPLE_FILES[0])
+    corrected = celltm_scans(data.assign(profile='example'), settings['Primary']['TA_Amplitude'],
+                             settings['Primary']['TA_TimeConstant'], 1 / 24)[EXAMPLE_COLUMNS]
+    corrected.attrs['descriptions'] = ['%s: %s' % (col, descriptions[col]) for col in EXAMPLE_COLUMNS]
+    write_cnv(corrected, ['* Sea-Bird SBE 9 Data File:'], EXAMPLE_FILES[1])
+
+def compare_sbe(input_file, sbe_file, psa_file):
+    """
+    Largest difference of the conductivity and salinity columns between the
+    native correction of input_file and the output sbe_file
+    """
+    data = read_cnv_frame(input_file).assign(profile='sbe')
+    sbe = read_cnv_frame(sbe_file)
+    corrected = seabird_processes.celltm(data, psa_file=psa_file)
+    print("%s and %s (%s scans)" % (os.path.basename(input_file), os.path.basename(sbe_file), len(data)))
+    for col in corrected.columns:
+        if col in sbe.columns and (col[:2] in ('c0', 'c1') or col in ('sal00', 'sal11')):
+            print("\tmax difference %-8s %.2e (correction up to %.2e)"
+                  % (col, np.abs(corrected[col] - sbe[col]).max(), np.abs(data[col] - sbe[col]).max()))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=8)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--alpha', type=float, default=0.03)
+    parser.add_argument('--tau', type=float, default=7.)
+    parser.add_argument('--sbe', nargs=2, metavar=('INPUT_CNV', 'SBE_CNV'))
+    parser.add_argument('--psa', help='Cell Thermal Mass PSA file used for the SBE output')
+    parser.add_argument('--write-example', action='store_true', help='write the example pair of benchmarks/data')
+    args = parser.parse_args()
+    if args.write_example:
+        write_example()
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    df = pd.concat([pd.DataFrame(synthetic_profile(n_scans, seed=i), columns=columns).assign(profile='P%03d' % i)
+                    for i in range(args.profiles)], ignore_index=True)
+
+    # Warm-up call, so the timing does not include the first use of the modules
+    seabird_processes.celltm(df[df['profile'] == 'P000'].head(100), alpha=args.alpha, tau=args.tau)
+    start = time.perf_counter()
+    corrected = seabird_processes.celltm(df, alpha=args.alpha, tau=args.tau)
+    t_native = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = celltm_scans(df, args.alpha, args.tau, 1 / 24)
+    t_scans = time.perf_counter() - start
+
+    print("%s profiles x %s scans (24 Hz), with the salinity recalculated" % (args.profiles, n_scans))
+    print("\tscan by scan CellTM:      %.3f s" % t_scans)
+    print("\tseabird_processes.celltm: %.3f s (%.0fx)" % (t_native, t_scans / t_native))
+    for col in ('c0S/m', 'sal00'):
+        print("\tmax difference %-10s %.2e" % (col, np.abs(corrected[col].to_numpy() - expected[col].to_numpy()).max()))
+    if args.sbe:
+        compare_sbe(*args.sbe, args.psa)
+    elif os.path.exists(EXAMPLE_FILES[1]):
+        compare_sbe(*EXAMPLE_FILES, None)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the fixed-width CNV reader against the pandas text parser used
+previously in cnv2df, on synthetic 24 Hz files.
+
+Run from the repository root:
+    python -m benchmarks.bench_cnv_reader
+"""
+import time
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+
+import scripts.cnv_header as cnv_header
+import scripts.cnv_reader as cnv_reader
+from benchmarks.synthetic import write_cnv_files
+
+#%%
+def read_text_parser(file):
+    """
+    Previous cnv2df read path: whitespace separated text parser followed by
+    numeric coercion of non-float columns.
+    """
+    header = cnv_header.read_header(file)
+    data = pd.read_csv(file, sep=r'\s+', header=None, index_col=0, names=header['columns'],
+                       skiprows=header['skiprows'], low_memory=False)
+    colsf = data.select_dtypes(exclude=['float']).columns
+    data[colsf] = data[colsf].apply(pd.to_numeric, errors='coerce')
+    return data.reset_index()
+
+def best_of(function, files, repeat):
+    """
+    Returns:
+        float
+        Best wall time (s) over repeat runs of function on all files
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file in files:
+            function(file)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    with tempfile.TemporaryDirectory() as directory:
+        files = write_cnv_files(directory, args.files, n_scans)
+        n_columns = len(cnv_header.read_headers(files)[files[0]]['columns'])
+
+        # Check both paths give the same values
+        for file in files:
+            np.testing.assert_array_equal(read_text_parser(file).to_numpy(),
+                                          cnv_reader.read_cnv_frame(file).to_numpy())
+
+        t_text = best_of(read_text_parser, files, args.repeat)
+        t_fixed64 = best_of(cnv_reader.read_cnv_array, files, args.repeat)
+        t_fixed32 = best_of(lambda f: cnv_reader.read_cnv_array(f, dtype=np.float32), files, args.repeat)
+
+    print("%s files x %s scans (24 Hz, %s columns)" % (args.files, n_scans, n_columns))
+    print("\tpandas text parser:       %.3f s" % t_text)
+    print("\tfixed-width float64:      %.3f s (x%.1f)" % (t_fixed64, t_text / t_fixed64))
+    print("\tfixed-width float32:      %.3f s (x%.1f)" % (t_fixed32, t_text / t_fixed32))
+
+if __name__ == '__main__':
+    main()
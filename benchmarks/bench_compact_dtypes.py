@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Memory report of the compact dtype mode of cnv2df on a synthetic 24 Hz 
+cruise, and the time of the downstream steps on each representation.
+
+Run from the repository root:
+    python -m benchmarks.bench_compact_dtypes
+"""
+import os
+import io
+import time
+import tempfile
+import argparse
+import contextlib
+
+import scripts.data_processing as data_processing
+import scripts.seabird_processes as seabird_processes
+from benchmarks.synthetic import write_cnv_files
+
+#%%
+def downstream(data):
+    """
+    Returns:
+        float
+        Wall time (s) of start_dcast, heave_flagging and bin_data on data
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        data_processing.start_dcast(data, 'profile', 'prDM')
+    flagged = seabird_processes.heave_flagging(data, 0.2, 2)
+    seabird_processes.bin_data(flagged, 'D', 'prDM', 'profile', ['profile', 'prDM', 't090C', 'sal00'])
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    with tempfile.TemporaryDirectory() as directory:
+        files = [os.path.basename(file) for file in write_cnv_files(directory, args.files, n_scans, xmlcon=True)]
+        load = {}
+        for mode, options in [('default', {}),
+                              ('compact', {'compact': True}),
+                              ('compact float32', {'compact': True, 'float32': True})]:
+            load[mode] = data_processing.cnv2df('BENCH', files, raw_folder=directory,
+                                                directory=directory, **options)
+
+    print("%s files x %s scans (24 Hz)\n" % (args.files, n_scans))
+    print(data_processing.memory_report(load['default'], load['compact float32']).round(2).to_string())
+    print()
+    for mode, data in load.items():
+        memory = data.memory_usage(deep=True).sum() / 1e6
+        print("\t%-16s %8.1f MB\tstart_dcast + heave_flagging + bin_data: %.2f s" % (mode, memory, downstream(data)))
+
+if __name__ == '__main__':
+    main()
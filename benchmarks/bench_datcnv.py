@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the native DatCnv conversion on synthetic SBE 911plus .hex
+files, with the error of the converted channels against the synthetic
+profile (quantisation of the hex words only).
+
+Run from the repository root:
+    python -m benchmarks.bench_datcnv
+"""
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+
+import scripts.datcnv as datcnv
+from benchmarks.synthetic import write_hex, CNV_COLUMNS
+
+PSA_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'psa_templates', 'MI_datcnvTemplate_oneO2.psa')
+
+#%%
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    with tempfile.TemporaryDirectory() as directory:
+        hex_files, xmlcon_files, profiles = [], [], []
+        for i in range(args.files):
+            hex_file = os.path.join(directory, 'BENCH_CTD%03d.hex' % (i + 1))
+            profiles.append(write_hex(hex_file, n_scans, seed=i))
+            hex_files.append(hex_file)
+            xmlcon_files.append(os.path.splitext(hex_file)[0] + '.XMLCON')
+
+        # Largest error of the directly converted channels
+        errors = {}
+        for hex_file, xmlcon_file, profile in zip(hex_files, xmlcon_files, profiles):
+            data, _ = datcnv.datcnv(hex_file, xmlcon_file, PSA_TEMPLATE)
+            for name in ['prDM', 't090C', 'c0S/m', 'v1', 'pumps']:
+                error = np.abs(data[name].to_numpy() - profile[:, columns.index(name)]).max()
+                errors[name] = max(errors.get(name, 0.), error)
+
+        output_directory = os.path.join(directory, 'cnv')
+        os.makedirs(output_directory)
+        start = time.perf_counter()
+        datcnv.datcnv_files(hex_files, xmlcon_files, PSA_TEMPLATE, output_directory)
+        t_convert = time.perf_counter() - start
+
+    print("%s files x %s scans (24 Hz)" % (args.files, n_scans))
+    print("\tdatcnv to CNV:  %.3f s" % t_convert)
+    for name, error in errors.items():
+        print("\tmax error %-8s %.2e" % (name, error))
+
+if __name__ == '__main__':
+    main()
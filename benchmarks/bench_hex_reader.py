@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the memory-mapped .hex reader against a line by line decoder,
+for decoding all scans and for random access to single scans, on synthetic
+SBE 911plus files.
+
+Run from the repository root:
+    python -m benchmarks.bench_hex_reader
+"""
+import os
+import time
+import tempfile
+import argparse
+import numpy as np
+
+from scripts.hex_reader import HexFile, frequencies, voltages, status_word
+from benchmarks.synthetic import write_hex
+
+#%%
+def read_line_by_line(file):
+    """
+    Line by line decoder: each scan line is converted with bytes.fromhex and
+    the frequency, voltage and status words are unpacked per scan.
+
+    Returns:
+        tuple
+        Frequencies, voltages and status bits as arrays
+    """
+    freqs, volts, status = [], [], []
+    with open(file, 'r') as f:
+        for line in f:
+            if line.startswith('*END*'):
+                break
+        for line in f:
+            scan = bytes.fromhex(line.strip())
+            freqs.append([scan[i] * 256 + scan[i + 1] + scan[i + 2] / 256 for i in range(0, 15, 3)])
+            v = []
+            for i in range(15, 27, 3):
+                v.append(5 * (1 - ((scan[i] << 4) | (scan[i + 1] >> 4)) / 4095))
+                v.append(5 * (1 - (((scan[i + 1] & 0x0F) << 8) | scan[i + 2]) / 4095))
+            volts.append(v)
+            status.append(scan[-6] & 0x0F)
+    return np.array(freqs), np.array(volts), np.array(status)
+
+def read_hex_file(file):
+    with HexFile(file) as hex_file:
+        records = hex_file.records()
+    return frequencies(records), voltages(records), status_word(records)[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=60., help='cast duration at 24 Hz')
+    parser.add_argument('--lookups', type=int, default=1000, help='random single scan reads')
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    with tempfile.TemporaryDirectory() as directory:
+        file = os.path.join(directory, 'BENCH_CTD001.hex')
+        write_hex(file, n_scans)
+
+        # Check both decoders give the same values
+        for expected, result in zip(read_line_by_line(file), read_hex_file(file)):
+            np.testing.assert_array_equal(expected, result)
+
+        start = time.perf_counter()
+        read_line_by_line(file)
+        t_lines = time.perf_counter() - start
+        start = time.perf_counter()
+        read_hex_file(file)
+        t_mmap = time.perf_counter() - start
+
+        indices = np.random.default_rng(0).integers(0, n_scans, args.lookups)
+        start = time.perf_counter()
+        with HexFile(file) as hex_file:
+            for i in indices:
+                hex_file[i]
+        t_random = time.perf_counter() - start
+
+    print("%s scans (24 Hz, %s minutes)" % (n_scans, args.minutes))
+    print("\tline by line decoder:     %.3f s" % t_lines)
+    print("\tmemory-mapped decoder:    %.3f s (x%.1f)" % (t_mmap, t_lines / t_mmap))
+    print("\t%s random scans:        %.3f s (%.1f us per scan)" % (args.lookups, t_random, 1e6 * t_random / args.lookups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the hysteresis and oxygen alignment sweep of calculations 
+against a loop of hyst_compare_calc over the same grid, on a synthetic 24 Hz
+cast, with a check that both give the same down minus up differences.
+Also compares tune_oxygen_hysteresis with the best combination of an 
+exhaustive sweep over whole second alignments.
+
+Run from the repository root:
+    python -m benchmarks.bench_hyst_sweep
+    python -m benchmarks.bench_hyst_sweep --workers 4
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import scripts.calculations as calculations
+from benchmarks.synthetic import synthetic_profile, CNV_COLUMNS, XMLCON_COEFFICIENTS
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--grid', type=int, default=5, help='values of H1, H3 and alignment')
+    parser.add_argument('--tune-grid', type=int, default=20, help='values of H1 and H3 of the grid compared with the tuner')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    df = pd.DataFrame(synthetic_profile(n_scans), columns=columns).rename(columns={'sbeox0V': 'oxy_volts'})
+    df['cast'] = np.where(np.arange(n_scans) < n_scans // 2, 'D', 'U')
+    coefs = XMLCON_COEFFICIENTS['OxygenSensor']
+    H1s = np.linspace(-0.05, -0.01, args.grid)
+    H3s = np.linspace(500., 3000., args.grid)
+    O2_advs = np.linspace(0., 6., args.grid)
+
+    start = time.perf_counter()
+    expected = pd.DataFrame([calculations.hyst_compare_calc(df, H1, H3, coefs, O2_adv)
+                             for O2_adv in O2_advs for H1 in H1s for H3 in H3s],
+                            columns=['O2_adv', 'H1', 'H3', 'diff'])
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    result = calculations.hyst_compare_sweep(df, H1s, H3s, coefs, O2_advs, workers=args.workers)
+    t_sweep = time.perf_counter() - start
+    pd.testing.assert_frame_equal(expected, result, check_exact=False)
+
+    print("%s scans (24 Hz), %s combinations" % (n_scans, len(result)))
+    print("\thyst_compare_calc loop: %.3f s" % t_loop)
+    print("\thyst_compare_sweep:     %.3f s (%.0fx)" % (t_sweep, t_loop / t_sweep))
+    print("\tmax difference          %.1e" % np.abs(expected['diff'] - result['diff']).max())
+
+    # Optimiser against an exhaustive grid over the tuning bounds
+    start = time.perf_counter()
+    grid = calculations.hyst_compare_sweep(df, np.linspace(-0.06, -0.01, args.tune_grid),
+                                           np.linspace(500., 3000., args.tune_grid), coefs,
+                                           np.arange(0, 13), workers=args.workers)
+    t_grid = time.perf_counter() - start
+    grid_best = grid.loc[grid['diff'].abs().idxmin()]
+    tuned = calculations.tune_oxygen_hysteresis(df, coefs)
+    print("\tgrid of %s:  %.3f s, |diff| %.2e at O2_adv %s, H1 %.4f, H3 %.0f"
+          % (len(grid), t_grid, abs(grid_best['diff']), grid_best['O2_adv'], grid_best['H1'], grid_best['H3']))
+    print("\ttuner, %s evaluations:  %.3f s, |diff| %.2e at O2_adv %s, H1 %.4f, H3 %.0f"
+          % (tuned['evaluations'], tuned['time'], abs(tuned['diff']), tuned['O2_adv'], tuned['H1'], tuned['H3']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the oxygen hysteresis kernel of calculations against the
+itertuples implementation of oxyVolts_hysteresis it replaces, on synthetic
+24 Hz profiles, with a check that both give the same corrected voltages.
+Also times a batch of parameter sets and several profiles in one call.
+
+Run from the repository root:
+    python -m benchmarks.bench_hysteresis
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import scripts.calculations as calculations
+from benchmarks.synthetic import synthetic_profile, CNV_COLUMNS
+
+H1, H2, H3, VOFFSET = -0.033, 5000., 1450., -0.5
+
+#%%
+def oxyVolts_hysteresis_rows(DF, H1, H2, H3, Voffset):
+    """
+    Scan by scan implementation with DataFrame.itertuples
+    """
+    df = DF.copy(deep=True)
+    df['D'] =  1 + (H1 * (np.exp(df['prDM'] / H2) - 1))
+    df['C'] = np.exp(-1 * df['timeS'].diff() / H3)
+    df['OxygenVolts'] = df['oxy_volts'] + Voffset
+
+    out_list = []
+    prev_OxygenVolts = df.iloc[0,df.columns.get_loc('OxygenVolts')]
+    prev_newOxygenVolts = df.iloc[0,df.columns.get_loc('OxygenVolts')]
+    count = 0
+    for row in df.itertuples():
+        if count == 0:
+            out_list.append(np.nan)
+            count+=1
+        else:
+            C = row[df.columns.get_loc('C')+1]
+            D = row[df.columns.get_loc('D')+1]
+            OxygenVolts = row[df.columns.get_loc('OxygenVolts')+1]
+            newOxygenVolts = (OxygenVolts + (prev_newOxygenVolts * C * D) - (prev_OxygenVolts * C)) / D
+            out_list.append(newOxygenVolts)
+            prev_OxygenVolts = OxygenVolts
+            prev_newOxygenVolts = newOxygenVolts
+    df['OxnewVolts'] = out_list
+    df['oxy_volts_corr'] = df['OxnewVolts'].round(4) - Voffset
+
+    return df['oxy_volts_corr']
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=10)
+    parser.add_argument('--minutes', type=float, default=30., help='cast duration at 24 Hz')
+    parser.add_argument('--parameter-sets', type=int, default=50)
+    args = parser.parse_args()
+
+    n_scans = int(args.minutes * 60 * 24)
+    columns = [name for name, _ in CNV_COLUMNS]
+    profiles = [pd.DataFrame(synthetic_profile(n_scans, seed=i), columns=columns).rename(columns={'sbeox0V': 'oxy_volts'})
+                for i in range(args.profiles)]
+    df = profiles[0]
+
+    start = time.perf_counter()
+    expected = oxyVolts_hysteresis_rows(df, H1, H2, H3, VOFFSET)
+    t_rows = time.perf_counter() - start
+    start = time.perf_counter()
+    result = calculations.oxyVolts_hysteresis(df, H1, H2, H3, VOFFSET)
+    t_kernel = time.perf_counter() - start
+    blocks = calculations.hysteresis_kernel(df['oxy_volts'], df['prDM'], df['timeS'], H1, H2, H3, VOFFSET,
+                                            use_numba=False)
+    differences = {'oxyVolts_hysteresis': np.abs(result - expected).max(),
+                   'NumPy block kernel': np.nanmax(np.abs(blocks - expected))}
+    if calculations.numba is not None:
+        loop = calculations.hysteresis_kernel(df['oxy_volts'], df['prDM'], df['timeS'], H1, H2, H3, VOFFSET,
+                                              use_numba=True)
+        differences['numba kernel'] = np.nanmax(np.abs(loop - expected))
+
+    # All profiles and a batch of parameter sets in one call
+    cruise = pd.concat(profiles, ignore_index=True)
+    profile_starts = np.arange(args.profiles) * n_scans
+    rng = np.random.default_rng(0)
+    H1s = rng.uniform(-0.05, -0.01, args.parameter_sets)
+    H3s = rng.uniform(500., 3000., args.parameter_sets)
+    start = time.perf_counter()
+    batch = calculations.hysteresis_kernel(cruise['oxy_volts'], cruise['prDM'], cruise['timeS'], H1s, H2, H3s,
+                                           VOFFSET, profile_starts=profile_starts)
+    t_batch = time.perf_counter() - start
+    check = oxyVolts_hysteresis_rows(profiles[-1], H1s[-1], H2, H3s[-1], VOFFSET).to_numpy()
+    differences['batch, last profile and set'] = np.nanmax(np.abs(batch[-1, -n_scans:] - check))
+
+    print("%s scans (24 Hz), numba %s" % (n_scans, 'installed' if calculations.numba is not None else 'not installed'))
+    print("\titertuples oxyVolts_hysteresis:  %.3f s" % t_rows)
+    print("\toxyVolts_hysteresis:             %.3f s (%.0fx)" % (t_kernel, t_rows / t_kernel))
+    print("\t%s profiles x %s parameter sets:  %.3f s" % (args.profiles, args.parameter_sets, t_batch))
+    for name, difference in differences.items():
+        print("\tmax difference %-30s %.1e" % (name, difference))
+
+if __name__ == '__main__':
+    main()
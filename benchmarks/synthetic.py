@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic SBE files for the benchmarks.
+"""
+import os
+import numpy as np
+
+CNV_COLUMNS = [('timeS', 'Time, Elapsed [seconds]'),
+               ('prDM', 'Pressure, Digiquartz [db]'),
+               ('depSM', 'Depth [salt water, m]'),
+               ('t090C', 'Temperature [ITS-90, deg C]'),
+               ('c0S/m', 'Conductivity [S/m]'),
+               ('sal00', 'Salinity, Practical [PSU]'),
+               ('sbeox0V', 'Oxygen raw, SBE 43 [V]'),
+               ('sbeox0Mm/L', 'Oxygen, SBE 43 [umol/l]'),
+               ] + [('v%s' % i, 'Voltage %s' % i) for i in range(8)] + \
+              [('pumps', 'Pump Status'),
+               ('flag', 'flag'),
+               ]
+
+# Sensors of the 13 entry SBE 911plus sensor array, the last 8 on voltage channels v0 - v7
+XMLCON_SENSORS = ['TemperatureSensor', 'ConductivitySensor', 'PressureSensor', 
+                  'TemperatureSensor', 'ConductivitySensor', 'OxygenSensor', 
+                  'FluoroWetlabWetstarSensor', 'TurbidityMeter', 'NotInUse', 
+                  'NotInUse', 'NotInUse', 'NotInUse', 'AltimeterSensor']
+# Calibration coefficients of the primary and secondary sensors (same values)
+XMLCON_COEFFICIENTS = {
+    'TemperatureSensor': {'UseG_J': 1, 'G': 4.35e-3, 'H': 6.4e-4, 'I': 2.3e-5, 'J': 2.2e-6,
+                          'F0': 1000.0, 'Slope': 1.0, 'Offset': 0.0},
+    'ConductivitySensor': {'G': -10.0, 'H': 1.45, 'I': -3.0e-3, 'J': 2.5e-4,
+                           'CPcor': -9.57e-8, 'CTcor': 3.25e-6, 'WBOTC': 0.0, 'Slope': 1.0, 'Offset': 0.0},
+    'PressureSensor': {'C1': -4.2e4, 'C2': -0.2, 'C3': 1.3e-2, 'D1': 3.6e-2, 'D2': 0.0,
+                       'T1': 30.0, 'T2': -3.7e-4, 'T3': 4.1e-6, 'T4': 3.3e-9, 'T5': 0.0,
+                       'Slope': 1.0, 'Offset': 0.0, 'AD590M': 1.28e-2, 'AD590B': -9.3},
+    'OxygenSensor': {'Soc': 0.45, 'offset': -0.5, 'A': -4e-3, 'B': 2e-4, 'C': -3e-6, 'D0': 2.5,
+                     'D1': 1.9e-4, 'D2': -4.6e-2, 'E': 0.036, 'Tau20': 1.1, 'H1': -0.033,
+                     'H2': 5000.0, 'H3': 1450.0},
+    }
+
+#%%
+def synthetic_profile(n_scans, scan_rate=24, max_pressure=1000., seed=0):
+    """
+    Parameters:
+        n_scans: int
+            Number of scans in the profile
+        scan_rate: int
+            Scans per second
+        max_pressure: float
+            Pressure at the bottom of the cast
+        seed: int
+    Returns:
+        numpy.ndarray
+        Array of shape (n_scans, len(CNV_COLUMNS)) in the CNV column order
+    """
+    rng = np.random.default_rng(seed)
+    time = np.arange(n_scans) / scan_rate
+    half = n_scans // 2
+    pressure = np.concatenate([np.linspace(0.5, max_pressure, half),
+                               np.linspace(max_pressure, 0.5, n_scans - half)])
+    pressure = pressure + rng.normal(0, 0.05, n_scans)
+    temperature = 4 + 11 * np.exp(-pressure / 200) + rng.normal(0, 0.002, n_scans)
+    conductivity = 3.0 + 0.09 * temperature
+    salinity = 35.2 + rng.normal(0, 0.002, n_scans)
+    oxygen_volts = 2.2 + 0.3 * np.exp(-pressure / 300) + rng.normal(0, 0.001, n_scans)
+    oxygen = 180 + 80 * np.exp(-pressure / 300)
+    voltages = rng.uniform(0, 5, (n_scans, 8))
+    pumps = (time > 30).astype(float)
+    flag = np.zeros(n_scans)
+
+    return np.column_stack([time, pressure, pressure * 0.99, temperature, conductivity,
+                            salinity, oxygen_volts, oxygen, voltages, pumps, flag])
+
+def write_cnv(path, data):
+    """
+    Write an array in the CNV column order as an SBE CNV file with CRLF line
+    endings and 11 character fixed-width fields.
+
+    Parameters:
+        path: str
+        data: numpy.ndarray
+    """
+    lines = ['* Sea-Bird SBE 9 Data File:',
+             '* NMEA Latitude = 53 16.78 N',
+             '* NMEA Longitude = 009 03.12 W',
+             '* System UpLoad Time = Jun 20 2023 10:11:12',
+             '* System UTC = Jun 20 2023 10:11:10',
+             '# nquan = %s' % len(CNV_COLUMNS),
+             '# nvalues = %s' % len(data),
+             ]
+    for i, (name, description) in enumerate(CNV_COLUMNS):
+        lines.append('# name %s = %s: %s' % (i, name, description))
+    for i in range(len(CNV_COLUMNS)):
+        lines.append('# span %s = %11.4f, %11.4f' % (i, data[:, i].min(), data[:, i].max()))
+    lines += ['# bad_flag = -9.990e-29', '# file_type = ascii', '*END*']
+    fmt = ''.join(['%11.4f'] * (len(CNV_COLUMNS) - 1) + ['%11.3e'])
+    with open(path, 'w', newline='') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+        np.savetxt(f, data, fmt=fmt, newline='\r\n')
+
+def write_xmlcon(path, nmea=True, scan_time=True):
+    """
+    Write a minimal SBE 911plus XMLCON file with the sensor array of 
+    XMLCON_SENSORS and the calibration coefficients of XMLCON_COEFFICIENTS.
+
+    Parameters:
+        path: str
+        nmea: bool
+            NMEA position and time added to the scans
+        scan_time: bool
+            Scan time added to the scans
+    """
+    sensors = []
+    for i, sensor in enumerate(XMLCON_SENSORS):
+        serial = '<SerialNumber/>' if sensor == 'NotInUse' else '<SerialNumber>%s</SerialNumber>' % (1000 + i)
+        coefficients = ''.join('<%s>%r</%s>' % (key, value, key) for key, value in XMLCON_COEFFICIENTS.get(sensor, {}).items())
+        if sensor in ('ConductivitySensor', 'OxygenSensor'):
+            tag = 'Coefficients' if sensor == 'ConductivitySensor' else 'CalibrationCoefficients'
+            coefficients = '<%s equation="1">%s</%s>' % (tag, coefficients, tag)
+        sensors.append('<Sensor index="%s" SensorID="1"><%s SensorID="1">%s%s</%s></Sensor>' % (i, sensor, serial, coefficients, sensor))
+    settings = {'FrequencyChannelsSuppressed': 0, 'VoltageWordsSuppressed': 0, 'SurfaceParVoltageAdded': 0,
+                'ScanTimeAdded': int(scan_time), 'NmeaPositionDataAdded': int(nmea),
+                'NmeaDepthDataAdded': 0, 'NmeaTimeAdded': int(nmea)}
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?><SBE_InstrumentConfiguration><Instrument>'
+                '<Name>SBE 911plus/917plus CTD</Name>%s<SensorArray Size="%s">%s</SensorArray>'
+                '</Instrument></SBE_InstrumentConfiguration>' % (
+                    ''.join('<%s>%s</%s>' % (key, value, key) for key, value in settings.items()),
+                    len(XMLCON_SENSORS), ''.join(sensors)))
+
+def _newton(function, derivative, x0, iterations=30):
+    x = np.array(x0, dtype=np.float64)
+    for _ in range(iterations):
+        x = x - function(x) / derivative(x)
+    return x
+
+def write_hex(path, n_scans, nmea=True, scan_time=True, seed=0):
+    """
+    Write an SBE 911plus .hex file of a synthetic profile, with the sensor
+    frequencies and voltages computed by inverting the calibration equations
+    of XMLCON_COEFFICIENTS. The XMLCON file is written next to it.
+
+    Parameters:
+        path: str
+        n_scans: int
+        nmea: bool
+        scan_time: bool
+        seed: int
+    Returns:
+        numpy.ndarray
+        The synthetic profile in the CNV column order (at 24 Hz)
+    """
+    profile = synthetic_profile(n_scans, seed=seed)
+    pressure, temperature, conductivity = profile[:, 1], profile[:, 3], profile[:, 4]
+
+    # Temperature: 1 / (T + 273.15) = g + h x + i x^2 + j x^3, x = ln(f0 / f)
+    c = XMLCON_COEFFICIENTS['TemperatureSensor']
+    target = 1. / (temperature + 273.15)
+    x = _newton(lambda x: c['G'] + x * (c['H'] + x * (c['I'] + x * c['J'])) - target,
+                lambda x: c['H'] + x * (2 * c['I'] + 3 * x * c['J']), np.zeros(n_scans))
+    f_temperature = c['F0'] / np.exp(x)
+    # Pressure sensor temperature counts for a constant 15 deg C
+    c = XMLCON_COEFFICIENTS['PressureSensor']
+    u = np.full(n_scans, 15.)
+    counts = np.round((u - c['AD590B']) / c['AD590M'])
+    u = c['AD590M'] * counts + c['AD590B']
+    cc = c['C1'] + u * (c['C2'] + u * c['C3'])
+    d = c['D1'] + u * c['D2']
+    t0 = c['T1'] + u * (c['T2'] + u * (c['T3'] + u * (c['T4'] + u * c['T5'])))
+    psia = pressure / 0.689476 + 14.7
+    ratio = _newton(lambda r: cc * r * (1 - d * r) - psia, lambda r: cc * (1 - 2 * d * r), np.zeros(n_scans))
+    f_pressure = np.sqrt(1 - ratio) * 1e6 / t0
+    # Conductivity: C (1 + CTcor t + CPcor p) = g + h f^2 + i f^3 + j f^4, f in kHz
+    c = XMLCON_COEFFICIENTS['ConductivitySensor']
+    target = conductivity * (1 + c['CTcor'] * temperature + c['CPcor'] * pressure)
+    f = _newton(lambda f: c['G'] + f * f * (c['H'] + f * (c['I'] + f * c['J'])) - target,
+                lambda f: f * (2 * c['H'] + f * (3 * c['I'] + 4 * f * c['J'])), np.full(n_scans, 5.))
+    f_conductivity = f * 1000.
+
+    freq = np.column_stack([f_temperature, f_conductivity, f_pressure, f_temperature, f_conductivity])
+    freq = np.round(freq * 256).astype(np.uint32)
+    words = [np.stack([(freq >> 16) & 0xFF, (freq >> 8) & 0xFF, freq & 0xFF], axis=-1).reshape(n_scans, -1)]
+    # Voltage channels v0 - v7 (the oxygen sensor on v0)
+    volts = profile[:, 8:16].copy()
+    volts[:, 0] = profile[:, 6]
+    n = np.round((1 - volts / 5.) * 4095).astype(np.uint32)
+    n = np.clip(n, 0, 4095)
+    pairs = n.reshape(n_scans, 4, 2)
+    words.append(np.stack([pairs[..., 0] >> 4, ((pairs[..., 0] & 0x0F) << 4) | (pairs[..., 1] >> 8),
+                           pairs[..., 1] & 0xFF], axis=-1).reshape(n_scans, -1))
+    if nmea:
+        latitude, longitude = int(53.2797 * 50000), int(9.052 * 50000)
+        position = [(latitude >> 16) & 0xFF, (latitude >> 8) & 0xFF, latitude & 0xFF,
+                    (longitude >> 16) & 0xFF, (longitude >> 8) & 0xFF, longitude & 0xFF, 0x40]
+        words.append(np.tile(np.array(position, dtype=np.uint32), (n_scans, 1)))
+        seconds = (740000000 + np.arange(n_scans) // 24).astype('<u4')
+        words.append(seconds.view(np.uint8).reshape(n_scans, 4).astype(np.uint32))
+    pumps = profile[:, 16].astype(np.uint32)
+    status = (counts.astype(np.uint32) << 12) | (pumps << 8) | (np.arange(n_scans, dtype=np.uint32) & 0xFF)
+    words.append(np.stack([(status >> 16) & 0xFF, (status >> 8) & 0xFF, status & 0xFF], axis=-1))
+    if scan_time:
+        seconds = (1687255872 + np.arange(n_scans) // 24).astype('<u4')
+        words.append(seconds.view(np.uint8).reshape(n_scans, 4).astype(np.uint32))
+    scans = np.concatenate(words, axis=1).astype(np.uint8)
+
+    lines = ['* Sea-Bird SBE 9 Data File:',
+             '* FileName = %s' % path,
+             '* Software version 7.26.7.129',
+             '* Temperature SN = 1000',
+             '* Conductivity SN = 1001',
+             '* System UpLoad Time = Jun 20 2023 10:11:12',
+             '* NMEA Latitude = 53 16.78 N',
+             '* NMEA Longitude = 009 03.12 W',
+             '* NMEA UTC (Time) = Jun 20 2023  10:11:10',
+             '* Store Lat/Lon Data = Append to Every Scan',
+             '* SBE 11plus V 5.2',
+             '* number of voltages sampled = 8',
+             '* nmea_data_appended = %s' % ('1' if nmea else '0'),
+             '* System UTC = Jun 20 2023 10:11:10',
+             '*END*']
+    digits = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+    text = np.empty((n_scans, 2 * scans.shape[1] + 2), dtype=np.uint8)
+    text[:, 0:-2:2] = digits[scans >> 4]
+    text[:, 1:-2:2] = digits[scans & 0x0F]
+    text[:, -2:] = np.frombuffer(b'\r\n', dtype=np.uint8)
+    with open(path, 'wb') as f:
+        f.write(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+        f.write(text.tobytes())
+    write_xmlcon(os.path.splitext(path)[0] + '.XMLCON', nmea=nmea, scan_time=scan_time)
+    return profile
+
+def write_cnv_files(directory, n_files, n_scans, scan_rate=24, xmlcon=False):
+    """
+    Parameters:
+        directory: str
+        n_files: int
+        n_scans: int
+            Scans per file
+        scan_rate: int
+        xmlcon: bool
+            Also write an XMLCON file for each CNV file
+    Returns:
+        list
+        Paths of the files written
+    """
+    files = []
+    for i in range(n_files):
+        path = os.path.join(directory, 'BENCH_CTD%03d.cnv' % (i + 1))
+        write_cnv(path, synthetic_profile(n_scans, scan_rate=scan_rate, seed=i))
+        if xmlcon:
+            write_xmlcon(os.path.splitext(path)[0] + '.XMLCON')
+        files.append(path)
+    return files
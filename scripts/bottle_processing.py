@@ -5,12 +5,19 @@ Created on Tue Mar 26 09:39:46 2024
 @author: dosullivan1
 """
 import os
+from pathlib import Path
+import numpy as np
 import pandas as pd
 from datetime import datetime as dt
 import seawater
 from IPython.display import display
 
 import scripts.sensor_configuration as sensor_configuration
+from scripts.filename_matching import file_index
+
+# A .bl file has two header lines followed by one line per bottle fired
+BL_HEADER_LINES = 2
+BL_COLUMNS = ['Firing Sequence', 'Bottle', 'Bottle Firing Time', 'Begin Scan', 'End Scan']
 
 #%%    
 def sbe_btl2df(directory, raw_folder):
@@ -122,6 +129,133 @@ def sbe_btl2df(directory, raw_folder):
     
     return data_all
     
+#%%
+def read_bl(file):
+    """
+    Read the bottle firings of a Seasave .bl file: one line per bottle fired
+    with the firing sequence, bottle position, firing time and the first and
+    last scan of the bottle (the scans written to the .ros file).
+
+    Parameters:
+        file: str
+            Path to the .bl file
+    Returns:
+        pandas.DataFrame
+        With the BL_COLUMNS, one row per bottle fired
+    """
+    rows = []
+    with open(file, 'r', errors='replace') as f:
+        for line_num, line in enumerate(f):
+            item = [field.strip() for field in line.split(',')]
+            if line_num < BL_HEADER_LINES or len(item) < len(BL_COLUMNS):
+                continue
+            rows.append(item[:len(BL_COLUMNS)])
+    bottles = pd.DataFrame(rows, columns=BL_COLUMNS)
+    for col in ['Firing Sequence', 'Bottle', 'Begin Scan', 'End Scan']:
+        bottles[col] = bottles[col].astype(int)
+    bottles['Bottle Firing Time'] = pd.to_datetime(bottles['Bottle Firing Time'], format='%b %d %Y %H:%M:%S')
+    return bottles
+
+def _bottle_windows(values, scans, bottles):
+    """
+    Mean, standard deviation, minimum and maximum of the values over the 
+    scan window of each bottle, ignoring NaN
+
+    Parameters:
+        values: numpy.ndarray
+            Array of shape (rows, channels) in scan order
+        scans: numpy.ndarray
+            Scan number of each row, ascending
+        bottles: pandas.DataFrame
+            Bottle firings of read_bl
+    Returns:
+        tuple
+        Arrays of shape (bottles, channels)
+    """
+    first = np.searchsorted(scans, bottles['Begin Scan'].to_numpy(), side='left')
+    last = np.searchsorted(scans, bottles['End Scan'].to_numpy(), side='right')
+    width = max(int((last - first).max()), 1)
+    # Rows of each window, padded with NaN to the longest window
+    rows = first[:, None] + np.arange(width)
+    inside = rows < last[:, None]
+    windows = values[np.minimum(rows, len(values) - 1)]
+    windows[~inside] = np.nan
+
+    present = ~np.isnan(windows)
+    count = present.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(present, windows, 0.).sum(axis=1) / count
+        deviation = np.where(present, windows - mean[:, None], 0.)
+        std = np.where(count > 1, np.sqrt((deviation * deviation).sum(axis=1) / (count - 1)), np.nan)
+    return mean, std, np.fmin.reduce(windows, axis=1), np.fmax.reduce(windows, axis=1)
+
+def bottle_summary(df, raw_folder, profile_id='profile', columns=None, scan_rate=24, time='timeS'):
+    """
+    Bottle summary from the profile data already loaded, without SBE Bottle
+    Summary and the .btl files: the data are averaged over the scans of each
+    bottle fired in the .bl file of the profile.
+
+    The scan number of each row is taken from the 'scan' column if present,
+    otherwise from the elapsed time (scan 1 at 0 s), so data edited or 
+    averaged in time (e.g. 2 Hz) are averaged over the rows in the window.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data, e.g. from cnv2df, or from datcnv.datcnv with the 
+            profile name added in a profile_id column
+        raw_folder: str
+            Name of directory with the .bl files, matched without case to the
+            profile names without their extension (e.g. 'CTD001.CNV' of
+            cnv2df is matched to CTD001.bl)
+        profile_id: str
+            Name of column containing the profile name
+        columns: list
+            Channels to summarise, all numeric columns by default
+        scan_rate: int
+            Scans per second of the raw data
+        time: str
+            Name of the elapsed time column
+    Returns:
+        pandas.DataFrame
+        One row per bottle fired with 'CTD number' (the upper case profile 
+        name without extension, as sbe_btl2df), 'Bottle', 'Bottle Firing Time', the mean of each channel and its standard deviation,
+        minimum and maximum as '{channel}_std', '{channel}_min' and
+        '{channel}_max'
+    """
+    if columns is None:
+        columns = [col for col in df.columns if col != profile_id and pd.api.types.is_numeric_dtype(df[col])]
+    index = file_index(raw_folder)
+    summaries, missing = [], []
+    for profile, rows in df.groupby(profile_id, sort=False, observed=True).indices.items():
+        stem = Path(str(profile)).stem
+        files = index.find_stem(stem, '.bl')
+        if len(files) == 0:
+            missing.append(stem)
+            continue
+        bottles = read_bl(files[0])
+        if bottles.empty:
+            continue
+        data = df.iloc[rows]
+        if 'scan' in data.columns:
+            scans = data['scan'].to_numpy(dtype=np.float64)
+        else:
+            scans = np.rint(data[time].to_numpy(dtype=np.float64) * scan_rate) + 1
+        order = np.argsort(scans, kind='stable')
+        mean, std, minimum, maximum = _bottle_windows(data[columns].to_numpy(dtype=np.float64)[order],
+                                                      scans[order], bottles)
+        summary = {'CTD number': stem.upper(),
+                   'Bottle': bottles['Bottle'].to_numpy(),
+                   'Bottle Firing Time': bottles['Bottle Firing Time'].to_numpy()}
+        for statistic, result in [('', mean), ('_std', std), ('_min', minimum), ('_max', maximum)]:
+            summary.update({col + statistic: result[:, i] for i, col in enumerate(columns)})
+        summaries.append(pd.DataFrame(summary))
+    if len(missing) > 0:
+        print("\033[1;31m*** No .bl file in %s for %s profiles, no bottles summarised for: ***\033[0m" % (raw_folder, len(missing)))
+        print(missing)
+    if len(summaries) == 0:
+        return pd.DataFrame(columns=['CTD number', 'Bottle', 'Bottle Firing Time'] + columns)
+    return pd.concat(summaries, ignore_index=True)
+    
 #%%  
 def sbe352df(directory):
     """
@@ -168,7 +302,8 @@ def create_bottle_summary(bottle_directory, cruiseID,
                           logs,
                           ctd_events,
                           sbe35_raw,
-                          raw_folder):
+                          raw_folder,
+                          btl_output=None):
     # TODO: Should not have a function that doesn't return something
     # Should really return the data frame and then save it to a csv file within the notebook
     """
@@ -187,19 +322,23 @@ def create_bottle_summary(bottle_directory, cruiseID,
             Name of directory with raw output files from the SBE35 sensor
         raw_folder: str
             Name of directory where raw data files are stored.
+        btl_output: pandas.DataFrame
+            Bottle firing data from bottle_summary. Read from the .btl files
+            if None
     Returns:
         Saves CSV files with the bottle summary
     """
     ## Load event, bottle logsheet metadata, .btl firing metadata and SBE35 file temperatures
     print("\nMerging bottle firing data with metadata from logsheets")
     # Run through btl file outputs and reformat to a csv for the cruise using function sbe_btl2df()
-    if len(os.listdir(bottle_directory))>0:
+    if btl_output is not None or len(os.listdir(bottle_directory))>0:
         
         ####################################################################################################################################
         ## Reformat the .btl files into a single csv
         ####################################################################################################################################
         
-        btl_output = sbe_btl2df(bottle_directory, raw_folder)
+        if btl_output is None:
+            btl_output = sbe_btl2df(bottle_directory, raw_folder)
 
                         ### ED removing second o2 sensor variables from end of following list 21/06/2021
         btl_output = btl_output.rename(columns={'PrDM': 'prDM', 'DepSM': 'depSM', 'T090C': 't090C', 'T190C': 't190C', 'C0S/m': 'c0S/m', 'C1S/m': 'c1S/m', 
@@ -4,9 +4,27 @@ Created on Tue Mar 26 09:32:20 2024
 
 @author: dosullivan1
 """
+from time import perf_counter
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+import pandas as pd
+from scipy import optimize, fft
 from bokeh.models import Label, BoxAnnotation
 
+# Optional, compiles the oxygen hysteresis recurrence when installed
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Largest decay (exp(-dt / H3) summed in log) within a block of the NumPy
+# hysteresis kernel, keeps the block scaling factors between exp(-1) and 1
+HYSTERESIS_BLOCK_DECAY = 1.
+# Rolling window of the oxygen dV/dt, 2 seconds of 24 Hz data
+OXYGEN_DVDT_WINDOW = 48
+
 #%% 
 def merc_from_arrays(lats, lons):
     """
@@ -197,10 +215,142 @@ def sbe43_oxycalc(V, T, P, S, coef, Vdiff, units):
     return oxy_out
 
 #%%
+def _hysteresis_loop(volts, pressure, time, resets, H1, H2, H3):
+    """
+    SBE 43 hysteresis recurrence, one scan at a time, for each parameter set
+    (compiled with numba when installed)
+    """
+    out = np.empty((len(H1), len(volts)))
+    for k in range(len(H1)):
+        prev_volts = volts[0]
+        prev_new_volts = volts[0]
+        for i in range(len(volts)):
+            if resets[i]:
+                out[k, i] = np.nan
+                prev_volts = volts[i]
+                prev_new_volts = volts[i]
+                continue
+            C = np.exp(-1 * (time[i] - time[i - 1]) / H3[k])
+            D = 1 + (H1[k] * (np.exp(pressure[i] / H2[k]) - 1))
+            new_volts = (volts[i] + (prev_new_volts * C * D) - (prev_volts * C)) / D
+            out[k, i] = new_volts
+            prev_volts = volts[i]
+            prev_new_volts = new_volts
+    return out
+
+if numba is not None:
+    _hysteresis_loop = numba.njit(cache=True)(_hysteresis_loop)
+
+def _hysteresis_blocks(volts, pressure, time, resets, H1, H2, H3):
+    """
+    SBE 43 hysteresis recurrence with NumPy. The recurrence is linear,
+        new[i] = C[i] new[i-1] + (V[i] - C[i] V[i-1]) / D[i]
+    so within a block of scans it is the cumulative sum of the inputs scaled
+    by the cumulative product of C. Blocks end at profile boundaries and 
+    before the product of C falls below exp(-HYSTERESIS_BLOCK_DECAY), so the
+    scaling stays accurate, and the value at the end of each block is 
+    carried into the next block in a short loop over the blocks.
+    """
+    n = len(volts)
+    H1, H2, H3 = H1[:, None], H2[:, None], H3[:, None]
+    dt = np.diff(time, prepend=np.nan)
+    log_C = -1 * dt / H3
+    C = np.exp(log_C)
+    D = 1 + (H1 * (np.exp(pressure / H2) - 1))
+    inputs = (volts - C * np.r_[np.nan, volts[:-1]]) / D
+    # At the start of a profile the state is the voltage of the first scan
+    inputs[:, resets] = volts[resets]
+    log_C[:, resets] = 0.
+    # NaN inputs make the rest of the profile NaN, as in the scan by scan loop
+    bad = np.isnan(inputs) | np.isnan(log_C)
+    inputs[bad] = 0.
+    log_C[bad] = 0.
+    profile = np.cumsum(resets)
+    bad_seen = np.cumsum(bad, axis=1)
+    bad_seen = bad_seen - (bad_seen - bad)[:, np.flatnonzero(resets)][:, profile - 1] > 0
+
+    # Blocks: new profile or HYSTERESIS_BLOCK_DECAY exceeded for the fastest decay
+    decay = np.cumsum(np.nan_to_num(np.abs(dt) / H3.min()))
+    block_start = resets | (np.diff(np.floor(decay / HYSTERESIS_BLOCK_DECAY), prepend=-1) != 0)
+    starts = np.flatnonzero(block_start)
+    block = np.cumsum(block_start) - 1
+
+    def block_cumsum(values):
+        total = np.cumsum(values, axis=1)
+        return total - (total - values)[:, starts][:, block]
+
+    scale = np.exp(block_cumsum(log_C))
+    zero_carry = scale * block_cumsum(inputs / scale)
+    # Carry the value at the end of each block into the next block
+    ends = np.r_[starts[1:], n] - 1
+    carry = np.zeros((len(H1), len(starts)))
+    for j in range(1, len(starts)):
+        if not resets[starts[j]]:
+            carry[:, j] = zero_carry[:, ends[j - 1]] + scale[:, ends[j - 1]] * carry[:, j - 1]
+    out = zero_carry + scale * carry[:, block]
+    out[bad_seen] = np.nan
+    out[:, resets] = np.nan
+    return out
+
+def hysteresis_kernel(volts, pressure, time, H1, H2, H3, Voffset, profile_starts=None, use_numba=None):
+    """
+    SBE 43 oxygen voltage hysteresis correction on NumPy arrays, for one or 
+    several profiles and one or a batch of (H1, H2, H3) parameter sets. The
+    state of the recurrence restarts at each profile, where the corrected 
+    voltage is NaN for the first scan, as in oxyVolts_hysteresis.
+
+    Parameters:
+        volts: numpy.ndarray
+            Oxygen voltage (V) in time order within each profile
+        pressure: numpy.ndarray
+            Pressure (dbar)
+        time: numpy.ndarray
+            Elapsed time (s)
+        H1: float | numpy.ndarray
+        H2: float | numpy.ndarray
+        H3: float | numpy.ndarray
+            Hysteresis coefficients, or arrays of the same length with one
+            parameter set per element
+        Voffset: float
+            Oxygen voltage offset
+        profile_starts: array-like
+            Row index of the first scan of each profile. A single profile if
+            None
+        use_numba: bool | None
+            Use the compiled scan by scan kernel, by default when numba is 
+            installed. Otherwise the NumPy block kernel is used
+    Returns:
+        numpy.ndarray
+        Corrected oxygen voltage, rounded to 4 decimals as by SBE, of shape
+        (scans,) for a single parameter set or (parameter sets, scans)
+    """
+    batch = np.ndim(H1) > 0 or np.ndim(H2) > 0 or np.ndim(H3) > 0
+    H1, H2, H3 = (np.atleast_1d(np.asarray(H, dtype=np.float64)) for H in (H1, H2, H3))
+    H1, H2, H3 = np.broadcast_arrays(H1, H2, H3)
+    volts = np.asarray(volts, dtype=np.float64) + Voffset
+    pressure = np.asarray(pressure, dtype=np.float64)
+    time = np.asarray(time, dtype=np.float64)
+    resets = np.zeros(len(volts), dtype=bool)
+    if len(volts):
+        resets[0] = True
+    if profile_starts is not None:
+        resets[np.asarray(profile_starts, dtype=np.int64)] = True
+    if use_numba is None:
+        use_numba = numba is not None
+    kernel = _hysteresis_loop if use_numba else _hysteresis_blocks
+    if len(volts) == 0:
+        out = np.empty((len(H1), 0))
+    else:
+        out = kernel(volts, pressure, time, resets, H1, H2, H3)
+    out = np.round(out, 4) - Voffset
+    return out if batch else out[0]
+
 def oxyVolts_hysteresis(DF, H1, H2, H3, Voffset):
     """
     Parameters:
-        DF:
+        DF: pandas.DataFrame
+            Profile data with the oxygen voltage in 'oxy_volts', 'prDM' and 
+            'timeS'
         H1:
         H2:
         H3:
@@ -208,33 +358,11 @@ def oxyVolts_hysteresis(DF, H1, H2, H3, Voffset):
         
     Returns:
         Series
-        Oxygen voltage corrected for hysteresis
+        Oxygen voltage corrected for hysteresis, see hysteresis_kernel
     """
-    df = DF.copy(deep=True)
-    df['D'] =  1 + (H1 * (np.exp(df['prDM'] / H2) - 1))
-    df['C'] = np.exp(-1 * df['timeS'].diff() / H3)
-    df['OxygenVolts'] = df['oxy_volts'] + Voffset
-    
-    out_list = []
-    prev_OxygenVolts = df.iloc[0,df.columns.get_loc('OxygenVolts')]
-    prev_newOxygenVolts = df.iloc[0,df.columns.get_loc('OxygenVolts')]
-    count = 0
-    for row in df.itertuples():
-        if count == 0:
-            out_list.append(np.nan)
-            count+=1
-        else:
-            C = row[df.columns.get_loc('C')+1]
-            D = row[df.columns.get_loc('D')+1]
-            OxygenVolts = row[df.columns.get_loc('OxygenVolts')+1]
-            newOxygenVolts = (OxygenVolts + (prev_newOxygenVolts * C * D) - (prev_OxygenVolts * C)) / D
-            out_list.append(newOxygenVolts)
-            prev_OxygenVolts = OxygenVolts
-            prev_newOxygenVolts = newOxygenVolts
-    df['OxnewVolts'] = out_list
-    df['oxy_volts_corr'] = df['OxnewVolts'].round(4) - Voffset
-    
-    return df['oxy_volts_corr']
+    corrected = hysteresis_kernel(DF['oxy_volts'].to_numpy(), DF['prDM'].to_numpy(), DF['timeS'].to_numpy(),
+                                  H1, H2, H3, Voffset)
+    return pd.Series(corrected, index=DF.index, name='oxy_volts_corr')
 
 #%%
 def hys_calc_binned(df,o2_adv,H1,H3,coefs):
@@ -258,12 +386,14 @@ def hys_calc_binned(df,o2_adv,H1,H3,coefs):
     Voffset = coefs['offset']
     # Subset from base dataframe
     full24Hz_df = df.copy(deep=True)
-    # Update the voltage alignment
-    full24Hz_df['oxy_volts'] = full24Hz_df['oxy_volts'].shift(periods=o2_adv*-24)
+    # Update the voltage alignment, o2_adv seconds (fractions of a scan are interpolated)
+    elapsed = full24Hz_df['timeS'].to_numpy(dtype=np.float64)
+    full24Hz_df['oxy_volts'] = np.interp(elapsed + o2_adv, elapsed, full24Hz_df['oxy_volts'].to_numpy(dtype=np.float64),
+                                         left=np.nan, right=np.nan)
     # Recalc the oxygen voltage with hysteresis correction
     full24Hz_df['oxy_volts_corr'] = oxyVolts_hysteresis(full24Hz_df, H1, H2, H3, Voffset)
     # Calculate dV/dt using a 2 second rolling window (48 rows of 24Hz data)
-    full24Hz_df['oxy1dV/dt'] = full24Hz_df['oxy_volts'].rolling(48, min_periods=1).mean().diff()/full24Hz_df['timeS'].rolling(48, min_periods=1).mean().diff()
+    full24Hz_df['oxy1dV/dt'] = full24Hz_df['oxy_volts'].rolling(OXYGEN_DVDT_WINDOW, min_periods=1).mean().diff()/full24Hz_df['timeS'].rolling(OXYGEN_DVDT_WINDOW, min_periods=1).mean().diff()
     # Regenerate oxygen concentration with hysteresis corrected sensor voltage
     full24Hz_df['oxy_conc_corr_umol'] = sbe43_oxycalc(full24Hz_df['oxy_volts_corr'],
                                                         full24Hz_df['t090C'],
@@ -275,7 +405,7 @@ def hys_calc_binned(df,o2_adv,H1,H3,coefs):
                                                        )
     # Bin data to 1 decibar resolution
     full24Hz_df['bin'] = full24Hz_df['prDM'].round(0)
-    bin1dbar_df = full24Hz_df.groupby(['cast','bin']).mean().reset_index()
+    bin1dbar_df = full24Hz_df.groupby(['cast','bin']).mean(numeric_only=True).reset_index()
 
     return bin1dbar_df    
 
@@ -305,12 +435,303 @@ def hyst_compare_calc(df,H1,H3,coefs,O2_adv):
     bin1dbar_df = hys_calc_binned(df,O2_adv,H1,H3,coefs)
     
     # Rearrange down and upcast by bin
-    compare_df = bin1dbar_df[['cast','bin','oxy_conc_corr_umol']].pivot('bin','cast','oxy_conc_corr_umol')
+    compare_df = bin1dbar_df[['cast','bin','oxy_conc_corr_umol']].pivot(index='bin', columns='cast', values='oxy_conc_corr_umol')
     # Calculate mean difference between up and down cast by depth
     diff = compare_df['D'].sub(compare_df['U']).mean()
     
     return [O2_adv, H1, H3, diff]
 
+#%%
+def _aligned_oxygen(elapsed, volts, dt, o2_adv):
+    """
+    Oxygen voltage advanced by o2_adv seconds and its dV/dt, as in 
+    hys_calc_binned. dt is the difference of the rolling mean of the time
+    """
+    aligned = np.interp(elapsed + o2_adv, elapsed, volts, left=np.nan, right=np.nan)
+    dvdt = pd.Series(aligned).rolling(OXYGEN_DVDT_WINDOW, min_periods=1).mean().diff().to_numpy() / dt
+    return aligned, dvdt
+
+def _cast_difference(conc, slots, n_bins):
+    """
+    Mean over the bins of the down minus up cast bin mean oxygen, for each 
+    row of conc. slots is 2 * bin for the down cast, 2 * bin + 1 for the up
+    cast and -1 for scans left out
+    """
+    n_sets = len(conc)
+    valid = (slots >= 0) & ~np.isnan(conc)
+    keys = (slots + 2 * n_bins * np.arange(n_sets)[:, None])[valid]
+    sums = np.bincount(keys, weights=conc[valid], minlength=2 * n_bins * n_sets).reshape(n_sets, n_bins, 2)
+    counts = np.bincount(keys, minlength=2 * n_bins * n_sets).reshape(n_sets, n_bins, 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        diff = means[..., 0] - means[..., 1]
+        paired = ~np.isnan(diff)
+        return np.where(paired, diff, 0.).sum(axis=1) / paired.sum(axis=1)
+
+def _sweep_inputs(df):
+    """
+    Arrays of df used by the hysteresis sweeps, the 1 dbar bin slots of each
+    cast (see _cast_difference) as the groupby of hys_calc_binned, and the
+    difference of the rolling mean of the time used for dV/dt
+
+    Returns:
+        tuple
+        (dict of arrays, dt, number of bins)
+    """
+    bins, bin_values = pd.factorize(df['prDM'].round(0))
+    cast = df['cast'].to_numpy()
+    slots = np.where(bins < 0, -1, np.where(cast == 'D', 2 * bins, np.where(cast == 'U', 2 * bins + 1, -1)))
+    arrays = {name: df[name].to_numpy(dtype=np.float64) for name in ('timeS', 'prDM', 't090C', 'sal00', 'oxy_volts')}
+    arrays['slots'] = slots.astype(np.int64)
+    dt = pd.Series(arrays['timeS']).rolling(OXYGEN_DVDT_WINDOW, min_periods=1).mean().diff().to_numpy()
+    return arrays, dt, len(bin_values)
+
+def _sweep_combinations(arrays, volts, dvdt, H1, H3, coefs, n_bins):
+    """
+    Down minus up cast difference for one alignment, given by the aligned 
+    voltage and its dV/dt, and a batch of (H1, H3) pairs
+    """
+    corrected = hysteresis_kernel(volts, arrays['prDM'], arrays['timeS'], H1, coefs['H2'], H3, coefs['offset'])
+    conc = sbe43_oxycalc(corrected, arrays['t090C'], arrays['prDM'], arrays['sal00'], coefs, dvdt, 'umol/L')
+    return _cast_difference(conc, arrays['slots'], n_bins)
+
+def _to_shared_memory(arrays):
+    """
+    Copy a dict of arrays to one shared memory block
+
+    Returns:
+        tuple
+        The SharedMemory block and the (offset, shape, dtype) of each array
+    """
+    layout = {}
+    size = 0
+    for name, array in arrays.items():
+        layout[name] = (size, array.shape, array.dtype.str)
+        size += -(-array.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        offset, shape, dtype = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+    return shm, layout
+
+def _sweep_task(shm_name, layout, lag_index, H1, H3, coefs, n_bins):
+    """
+    _sweep_combinations in a worker, on the arrays of the shared memory block
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        arrays = {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+                  for name, (offset, shape, dtype) in layout.items()}
+        diff = _sweep_combinations(arrays, arrays['volts'][lag_index], arrays['dvdt'][lag_index],
+                                   H1, H3, coefs, n_bins)
+        del arrays
+    finally:
+        shm.close()
+    return diff
+
+def hyst_compare_sweep(df, H1, H3, coefs, O2_adv, workers=None, batch_size=64):
+    """
+    Mean difference between the down and up cast binned oxygen concentration,
+    as by hyst_compare_calc, for every combination of grids of H1, H3 and 
+    oxygen alignment. The aligned voltages and dV/dt are computed once per 
+    alignment and the 1 dbar bins once, then the hysteresis correction runs
+    on batches of (H1, H3) pairs.
+
+    Parameters:
+        df: pandas.DataFrame
+            24 Hz data with 'timeS', 'prDM', 't090C', 'sal00', 'oxy_volts' 
+            and 'cast' ('D' or 'U')
+        H1: float | array-like
+        H3: float | array-like
+            Grids of hysteresis coefficients
+        coefs: dict
+            Oxygen sensor calibration coefficients, including 'H2' and 
+            'offset'
+        O2_adv: float | array-like
+            Grid of oxygen alignments (s)
+        workers: int | None
+            Number of processes used, which read the arrays from shared 
+            memory. None or 1 evaluates the grid sequentially in the current
+            process.
+        batch_size: int
+            Number of (H1, H3) pairs corrected at once, the memory used by a
+            batch is about 3 * batch_size * 8 bytes per scan
+    Returns:
+        pandas.DataFrame
+        One row per combination, with columns 'O2_adv', 'H1', 'H3' and 'diff'
+    """
+    H1, H3, O2_adv = (np.atleast_1d(np.asarray(v, dtype=np.float64)) for v in (H1, H3, O2_adv))
+    arrays, dt, n_bins = _sweep_inputs(df)
+    volts = arrays.pop('oxy_volts')
+    aligned = [_aligned_oxygen(arrays['timeS'], volts, dt, lag) for lag in O2_adv]
+    arrays['volts'] = np.stack([aligned_volts for aligned_volts, _ in aligned])
+    arrays['dvdt'] = np.stack([dvdt for _, dvdt in aligned])
+    H1_grid, H3_grid = (grid.ravel() for grid in np.meshgrid(H1, H3, indexing='ij'))
+    tasks = [(lag_index, H1_grid[i:i + batch_size], H3_grid[i:i + batch_size])
+             for lag_index in range(len(O2_adv)) for i in range(0, len(H1_grid), batch_size)]
+    if workers is not None and workers > 1 and len(tasks) > 1:
+        shm, layout = _to_shared_memory(arrays)
+        try:
+            task = partial(_sweep_task, shm.name, layout, coefs=coefs, n_bins=n_bins)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                diffs = list(executor.map(task, *zip(*tasks)))
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        diffs = [_sweep_combinations(arrays, arrays['volts'][lag_index], arrays['dvdt'][lag_index], H1s, H3s, coefs, n_bins)
+                 for lag_index, H1s, H3s in tasks]
+    return pd.DataFrame({'O2_adv': np.repeat(O2_adv, len(H1_grid)),
+                         'H1': np.tile(H1_grid, len(O2_adv)),
+                         'H3': np.tile(H3_grid, len(O2_adv)),
+                         'diff': np.concatenate(diffs)})
+
+def tune_oxygen_hysteresis(df, coefs, H1=(-0.06, -0.01), H3=(500., 3000.), O2_adv=(0, 12), x0=None,
+                           method='Nelder-Mead', options=None):
+    """
+    Hysteresis coefficients and oxygen alignment minimising the absolute mean
+    difference between the down and up cast binned oxygen concentration of
+    hyst_compare_calc. For a given alignment, H1 and H3 are found with a 
+    bounded scipy.optimize.minimize. The alignment is searched in whole 
+    seconds, from the starting alignment towards the neighbour that lowers 
+    the difference, until neither does. The aligned voltages and dV/dt are 
+    computed once per alignment visited.
+
+    Parameters:
+        df: pandas.DataFrame
+            24 Hz data, see hyst_compare_sweep
+        coefs: dict
+            Oxygen sensor calibration coefficients, including 'H2' and 
+            'offset'
+        H1: tuple
+        H3: tuple
+            (lower, upper) bounds of the hysteresis coefficients
+        O2_adv: tuple
+            (lower, upper) bounds of the oxygen alignment (s)
+        x0: tuple | None
+            Starting (H1, H3, O2_adv). By default the 'H1' and 'H3' of coefs
+            when given, otherwise the middle of the bounds
+        method: str
+            scipy.optimize.minimize method supporting bounds. The corrected 
+            voltage is rounded to 4 decimals, so the difference is piecewise
+            constant and a direct search such as Nelder-Mead suits better 
+            than a gradient method such as L-BFGS-B
+        options: dict | None
+            Options of scipy.optimize.minimize
+    Returns:
+        dict
+        'O2_adv', 'H1', 'H3' and 'diff' of the best combination, the number
+        of 'evaluations' of the difference and the wall 'time' (s)
+    """
+    start = perf_counter()
+    arrays, dt, n_bins = _sweep_inputs(df)
+    volts = arrays.pop('oxy_volts')
+    lower = np.array([H1[0], H3[0]], dtype=np.float64)
+    span = np.array([H1[1] - H1[0], H3[1] - H3[0]], dtype=np.float64)
+    if x0 is None:
+        x0 = (coefs.get('H1', lower[0] + span[0] / 2), coefs.get('H3', lower[1] + span[1] / 2), sum(O2_adv) / 2)
+    aligned = {}
+    evaluations = 0
+
+    def difference(x, lag):
+        if lag not in aligned:
+            aligned[lag] = _aligned_oxygen(arrays['timeS'], volts, dt, lag)
+        H = lower + np.clip(x, 0., 1.) * span
+        return _sweep_combinations(arrays, *aligned[lag], H[:1], H[1:], coefs, n_bins)[0]
+
+    def objective(x, lag):
+        nonlocal evaluations
+        evaluations += 1
+        diff = abs(difference(x, lag))
+        return np.inf if np.isnan(diff) else diff
+
+    # H1 and H3 are scaled to [0, 1] between their bounds, each search 
+    # starts slightly inside them, so that its first steps are not clipped
+    fits = {}
+    def fit(lag, x):
+        fits[lag] = optimize.minimize(objective, np.clip(x, 0.01, 0.99), args=(lag,), method=method,
+                                      bounds=[(0., 1.), (0., 1.)], options=options)
+
+    lag = int(np.clip(round(x0[2]), np.ceil(O2_adv[0]), np.floor(O2_adv[1])))
+    fit(lag, (np.asarray(x0[:2], dtype=np.float64) - lower) / span)
+    for step in (1, -1):
+        while O2_adv[0] <= lag + step <= O2_adv[1] and lag + step not in fits:
+            fit(lag + step, fits[lag].x)
+            if fits[lag + step].fun >= fits[lag].fun:
+                break
+            lag += step
+    best = lower + np.clip(fits[lag].x, 0., 1.) * span
+    return {'O2_adv': float(lag), 'H1': float(best[0]), 'H3': float(best[1]), 'diff': float(difference(fits[lag].x, lag)),
+            'evaluations': evaluations, 'time': perf_counter() - start}
+
+#%%
+def _oxygen_lag(oxygen, temperature, time, max_lag):
+    """
+    Lag (s) of the oxygen behind the temperature of one profile, at the peak
+    of the cross-correlation of their scan to scan changes
+    """
+    valid = np.isfinite(oxygen) & np.isfinite(temperature) & np.isfinite(time)
+    oxygen, temperature, time = oxygen[valid], temperature[valid], time[valid]
+    if len(time) < 3:
+        return np.nan
+    interval = np.median(np.diff(time))
+    if not interval > 0:
+        return np.nan
+    x = np.diff(oxygen)
+    y = np.diff(temperature)
+    x = x - x.mean()
+    y = y - y.mean()
+    # Cross-correlation by FFT, corr[k] = sum of x[n + k] * y[n]
+    n_fft = fft.next_fast_len(2 * len(x) - 1, real=True)
+    corr = fft.irfft(fft.rfft(x, n_fft) * np.conj(fft.rfft(y, n_fft)), n_fft)
+    max_scans = min(int(max_lag / interval), len(x) - 1)
+    lags = np.arange(-max_scans, max_scans + 1)
+    peak = np.abs(corr[lags])
+    if not peak.any():
+        return np.nan
+    return lags[np.argmax(peak)] * interval
+
+def estimate_oxygen_alignment(df, oxygen='sbeox0V', temperature='t090C', profile_id='profile', time='timeS',
+                              max_lag=12., workers=None):
+    """
+    Oxygen alignment of each profile, estimated as the lag of the oxygen 
+    behind the temperature at the peak of the absolute cross-correlation of 
+    their scan to scan changes, computed by FFT
+
+    Parameters:
+        df: pandas.DataFrame
+            One or more profiles, in time order within each profile
+        oxygen: str
+            Oxygen voltage or concentration column
+        temperature: str
+            Temperature column of the same sensor pair
+        profile_id: str
+        time: str
+            Elapsed time (s), gives the scan interval of each profile
+        max_lag: float
+            Largest alignment searched, before and after (s)
+        workers: int | None
+            Number of processes used. None or 1 processes the profiles 
+            sequentially in the current process.
+    Returns:
+        pandas.Series
+        Alignment (s) indexed by profile, positive when the oxygen lags the
+        temperature, i.e. the advance as O2_adv of hyst_compare_calc and the
+        oxygen alignment sliders of ctd_bokeh. NaN for profiles too short or
+        without any change
+    """
+    names, profiles = [], []
+    for name, group in df.groupby(profile_id, sort=False, observed=True):
+        names.append(name)
+        profiles.append([group[col].to_numpy(dtype=np.float64) for col in (oxygen, temperature, time)])
+    estimate = partial(_oxygen_lag, max_lag=max_lag)
+    if workers is not None and workers > 1 and len(profiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            lags = list(executor.map(estimate, *zip(*profiles)))
+    else:
+        lags = [estimate(*profile) for profile in profiles]
+    return pd.Series(lags, index=pd.Index(names, name=profile_id), name='O2_adv', dtype=np.float64)
+
 #%%   
 def get_water_mass_label(water_mass_type):
     saiw = {'parameters': {'salinity': [34.78,34.99,34.8,34.6,34.78], 
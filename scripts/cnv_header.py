@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass header index for SBE CNV and HDR files.
+
+Each file header is read once, byte by byte up to the '*END*' marker, and the
+fields needed by the processing functions (column names, header length, NMEA
+position and system times) are stored in a per-file record. Records are cached
+in memory and persisted in a small JSON index in the directory of the files,
+keyed on file size and modification time, so that unchanged files are never
+re-read between notebook runs.
+"""
+import os
+import re
+import json
+import numpy as np
+
+from scripts.filename_matching import file_index
+
+HEADER_INDEX_FILE = '.sbe_header_index.json'
+
+# In-memory cache of the on-disk indices, {directory: {filename: entry}}
+_header_indices = {}
+# Directories with records scanned since their index was last written
+_unsaved = set()
+
+#%%
+def _file_key(file):
+    """
+    Parameters:
+        file: str
+            Path to a file
+    Returns:
+        list
+        Size (bytes) and modification time (ns) identifying the file version
+    """
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+#%%
+def nmea_to_decimal(line, negative_hemisphere):
+    """
+    Convert an NMEA header line to decimal degrees
+
+    Parameters:
+        line: str
+            Header line, e.g. '* NMEA Latitude = 53 16.78 N'
+        negative_hemisphere: str
+            Hemisphere indicator for negative values ('S' or 'W')
+    Returns:
+        float
+    """
+    x = line.split( )
+    dec = float(x[5])/60
+    dec = dec + float(x[4])
+    if x[6]==negative_hemisphere:
+        dec = dec * -1
+    return dec
+
+#%%
+def scan_header(file):
+    """
+    Read the header of an SBE CNV or HDR file in a single pass.
+    The file is read in binary mode and decoded as latin-1, so the scan does
+    not depend on the file encoding.
+
+    Parameters:
+        file: str
+            Path to the CNV or HDR file
+    Returns:
+        dict
+        Header record with the column names and descriptions, the number of
+        header lines (skiprows), the byte offset of the data block, nvalues,
+        spans, the NMEA lines with the decimal position and the system times
+    """
+    record = {'columns': [],
+              'descriptions': [],
+              'skiprows': 0,
+              'data_offset': 0,
+              'nvalues': None,
+              'spans': {},
+              'nmea_latitude': '',
+              'nmea_longitude': '',
+              'upload_time': '',
+              'utc_time': '',
+              'lat': np.nan,
+              'lon': np.nan,
+              }
+    count = 0
+    offset = 0
+    with open(file, 'rb') as f:
+        for raw_line in f:
+            count += 1
+            offset += len(raw_line)
+            line = raw_line.decode('ISO-8859-1').rstrip()
+            if line == '*END*':
+                record['skiprows'] = count
+                record['data_offset'] = offset
+                break
+            elif '# name ' in line:
+                record['columns'].append(line.split(': ')[0].split(' = ')[1])
+                record['descriptions'].append(line.split(': ')[1])
+            elif line.startswith('# nvalues'):
+                record['nvalues'] = int(line.split('=')[1])
+            elif line.startswith('# span '):
+                span_id = int(re.findall(r'[0-9]+', line)[0])
+                record['spans'][span_id] = [float(x) for x in line.split('=')[1].split(',')]
+            elif line.startswith("* NMEA Latitude"):
+                record['nmea_latitude'] = line
+                record['lat'] = nmea_to_decimal(line, 'S')
+            elif line.startswith("* NMEA Longitude"):
+                record['nmea_longitude'] = line
+                record['lon'] = nmea_to_decimal(line, 'W')
+            elif line.startswith("* System UpLoad Time"):
+                record['upload_time'] = line
+            elif line.startswith("* System UTC"):
+                record['utc_time'] = line
+    # Key spans by column name once all names are known
+    record['spans'] = {record['columns'][int(k)]: v for k, v in record['spans'].items()
+                       if int(k) < len(record['columns'])}
+
+    return record
+
+#%%
+def _load_index(directory):
+    """
+    Load the persisted header index of a directory into the memory cache
+
+    Parameters:
+        directory: str
+    Returns:
+        dict
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _header_indices:
+        index = {}
+        index_file = os.path.join(directory, HEADER_INDEX_FILE)
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+        _header_indices[directory] = index
+    return _header_indices[directory]
+
+def _save_index(directory):
+    """
+    Write the header index of a directory to disk. Entries written by another
+    session since the index was loaded are kept, and the index is written to
+    a temporary file swapped in with os.replace, so a reader never sees a
+    truncated index. Read-only directories are skipped silently, the index 
+    then only lives for the current session.
+
+    Parameters:
+        directory: str
+    """
+    directory = os.path.abspath(directory)
+    index_file = os.path.join(directory, HEADER_INDEX_FILE)
+    index = _header_indices.get(directory, {})
+    try:
+        with open(index_file, 'r') as f:
+            stored = json.load(f)
+        for name, entry in stored.items():
+            index.setdefault(name, entry)
+    except (OSError, ValueError):
+        pass
+    _unsaved.discard(directory)
+    temp_file = '%s.%s.tmp' % (index_file, os.getpid())
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_file, index_file)
+    except OSError:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+#%%
+def read_header(file, persist=False):
+    """
+    Return the header record of a CNV or HDR file, scanning the file only if
+    it is new or has changed (size or modification time) since the last scan.
+    Records are only kept in memory by default, batches of files are written
+    to the index once by read_headers.
+
+    Parameters:
+        file: str
+            Path to the CNV or HDR file
+        persist: bool
+            Write a newly scanned record to the index file in the directory
+    Returns:
+        dict
+        Header record as returned by scan_header
+    """
+    directory, name = os.path.split(os.path.abspath(file))
+    index = _load_index(directory)
+    key = _file_key(file)
+    entry = index.get(name)
+    if entry is None or entry['key'] != key:
+        entry = {'key': key, 'record': scan_header(file)}
+        index[name] = entry
+        if persist:
+            _save_index(directory)
+        else:
+            _unsaved.add(directory)
+    return entry['record']
+
+def read_headers(files, persist=True):
+    """
+    Return the header records for a list of files, writing each directory
+    index at most once, with the records scanned before by read_header.
+
+    Parameters:
+        files: list
+            Paths to CNV or HDR files
+        persist: bool
+            Write newly scanned records to the index files
+    Returns:
+        dict
+        Header records keyed by the file path provided
+    """
+    records = {}
+    directories = set()
+    for file in files:
+        directory, name = os.path.split(os.path.abspath(file))
+        directories.add(directory)
+        records[file] = read_header(file, persist=False)
+    if persist:
+        for directory in directories & _unsaved:
+            _save_index(directory)
+    return records
+
+def files_with_extension(directory, extension):
+    """
+    Parameters:
+        directory: str
+        extension: str
+            File extension without the dot, matched case-insensitively
+    Returns:
+        list
+        Paths of the files in the directory (recursive) with the extension
+    """
+    return [str(file) for file in file_index(directory, recursive=True).with_extension(f'.{extension}')]
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-width reader for the data block of SBE CNV files.
+
+SBE Data Conversion writes the CNV data block as fixed-width ASCII columns
+(11 characters per value). The reader memory-maps the file, locates the data
+block from the header offset in the header index and decodes the fields
+directly into a contiguous NumPy array. Files that do not have a regular
+fixed-width layout fall back to the pandas text parser.
+"""
+import os
+import mmap
+import numpy as np
+import pandas as pd
+
+import scripts.cnv_header as cnv_header
+
+#%%
+def _fixed_width_fields(buf, ncols):
+    """
+    View a CNV data block as a 3D array of fixed-width byte fields.
+
+    Parameters:
+        buf: numpy.ndarray
+            uint8 view of the data block
+        ncols: int
+            Number of columns in the file
+    Returns:
+        numpy.ndarray | None
+        uint8 array of shape (rows, ncols, width), or None if the block is 
+        not regular fixed-width
+    """
+    newlines = np.flatnonzero(buf == ord('\n'))
+    if len(newlines) == 0 or ncols == 0:
+        return None
+    line_length = int(newlines[0]) + 1
+    nrows = len(newlines)
+    # All lines must be the same length, with only a trailing newline after the last line
+    if len(buf) != nrows * line_length or \
+       not np.array_equal(newlines, np.arange(line_length - 1, nrows * line_length, line_length)):
+        return None
+    text_length = line_length - 1
+    if text_length > 0 and buf[text_length - 1] == ord('\r'):
+        text_length -= 1
+    if text_length % ncols != 0:
+        return None
+    width = text_length // ncols
+    lines = buf.reshape(nrows, line_length)[:, :text_length]
+
+    return lines.reshape(nrows, ncols, width)
+
+def _decode_fixed_point(chars):
+    """
+    Decode right-aligned fixed-point ASCII fields (e.g. '  -12.3456'), with 
+    the decimal point of each column at the same position in every row. The 
+    digits are accumulated one character position at a time (Horner's scheme,
+    skipping the point) into an exact integer mantissa, which is divided by 
+    the power of ten of the decimal places. This gives the correctly rounded
+    value, identical to a text parser.
+
+    Parameters:
+        chars: numpy.ndarray
+            uint8 array of shape (width, rows, columns), i.e. one 2D slice per
+            character position
+    Returns:
+        tuple
+        Float64 array of shape (rows, columns) and a boolean array of the 
+        columns that are not plain fixed-point (e.g. exponent notation) and 
+        need to be parsed as text
+    """
+    width, nrows, ncols = chars.shape
+    is_dot = chars[:, 0, :] == ord('.')
+    dot_position = is_dot.argmax(axis=0)
+    text_columns = (is_dot.sum(axis=0) != 1) | (width > 16)
+    decimals = width - 1 - dot_position
+
+    mantissa = np.zeros((nrows, ncols))
+    negative = np.zeros((nrows, ncols), dtype=bool)
+    started = np.zeros((nrows, ncols), dtype=bool)
+    has_digit = np.zeros((nrows, ncols), dtype=bool)
+    invalid = np.zeros((nrows, ncols), dtype=bool)
+    for position in range(width):
+        c = chars[position]
+        value = c - np.uint8(ord('0'))
+        digit = value <= 9
+        space = c == ord(' ')
+        minus = c == ord('-')
+        dot = c == ord('.')
+        # Only leading spaces, an optional minus sign before the digits, 
+        # digits and a point at the same position as in the first row
+        invalid |= ~(digit | space | minus | dot) | (started & (space | minus)) | \
+                   (dot != is_dot[position])
+        started |= ~space
+        has_digit |= digit
+        negative |= minus
+        # Leading spaces and the sign add zeros to a zero mantissa
+        np.multiply(mantissa, np.where(is_dot[position], 1., 10.), out=mantissa)
+        np.add(mantissa, value * digit, out=mantissa)
+    text_columns |= (invalid | ~has_digit).any(axis=0)
+
+    values = mantissa / 10. ** decimals
+    np.negative(values, out=values, where=negative)
+
+    return values, text_columns
+
+def _read_cnv_text(file, header, usecols):
+    """
+    Fallback reader using the pandas text parser, with non-numeric values
+    coerced to NaN.
+
+    Parameters:
+        file: str
+        header: dict
+            Header record from cnv_header.read_header
+        usecols: list
+            Column positions to read
+    Returns:
+        numpy.ndarray
+    """
+    data = pd.read_csv(file, sep=r'\s+', header=None, usecols=usecols,
+                       skiprows=header['skiprows'], low_memory=False)
+    data = data.apply(pd.to_numeric, errors='coerce')
+
+    return data.to_numpy(dtype=np.float64)
+
+def _decode_fields(fields, usecols, dtype, chunk_rows=16384):
+    """
+    Decode the selected columns of the fixed-width fields in blocks of rows.
+
+    Parameters:
+        fields: numpy.ndarray
+            uint8 array of shape (rows, ncols, width)
+        usecols: list
+            Column positions to decode
+        dtype: numpy.dtype
+        chunk_rows: int
+            Number of rows decoded at once, limits the temporary memory used
+    Returns:
+        numpy.ndarray | None
+        None if a field cannot be parsed as a number
+    """
+    nrows, ncols, width = fields.shape
+    all_columns = usecols == list(range(ncols))
+    values = np.empty((nrows, len(usecols)), dtype=dtype)
+    for start in range(0, nrows, chunk_rows):
+        chars = fields[start:start + chunk_rows]
+        if not all_columns:
+            chars = chars[:, usecols, :]
+        block, text_columns = _decode_fixed_point(np.ascontiguousarray(chars.transpose(2, 0, 1)))
+        if text_columns.any():
+            # Exponent notation (e.g. the flag column) or malformed fields
+            try:
+                text = np.ascontiguousarray(chars[:, text_columns, :]).view('S%d' % width)[..., 0]
+                block[:, text_columns] = text.astype(np.float64)
+            except ValueError:
+                return None
+        values[start:start + chunk_rows] = block
+    return values
+
+#%%
+def read_cnv_array(file, header=None, usecols=None, dtype=np.float64):
+    """
+    Read the data block of a CNV file into a contiguous NumPy array.
+
+    Parameters:
+        file: str
+            Path to the CNV file
+        header: dict
+            Header record from cnv_header.read_header. Read from the header
+            index if not provided
+        usecols: list
+            Column positions to decode. All columns are decoded if None
+        dtype: numpy.dtype
+            numpy.float64 or numpy.float32
+    Returns:
+        numpy.ndarray
+        Array of shape (rows, columns) in C order
+    """
+    if header is None:
+        header = cnv_header.read_header(file)
+    ncols = len(header['columns'])
+    if usecols is None:
+        usecols = list(range(ncols))
+    usecols = list(usecols)
+
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= header['data_offset']:
+            return np.empty((0, len(usecols)), dtype=dtype)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8, offset=header['data_offset'])
+            try:
+                fields = _fixed_width_fields(buf, ncols)
+                if fields is not None:
+                    values = _decode_fields(fields, usecols, dtype)
+                    if values is not None:
+                        return values
+            finally:
+                # Release the buffer views before the memory map is closed
+                del buf
+                fields = None
+
+    return np.ascontiguousarray(_read_cnv_text(file, header, usecols), dtype=dtype)
+
+def read_cnv_frame(file, header=None, columns=None, dtype=np.float64):
+    """
+    Read the data block of a CNV file into a pandas DataFrame with the
+    column names from the header.
+
+    Parameters:
+        file: str
+            Path to the CNV file
+        header: dict
+            Header record from cnv_header.read_header
+        columns: list
+            Column names to read. All columns are read if None
+        dtype: numpy.dtype
+            numpy.float64 or numpy.float32
+    Returns:
+        pandas.DataFrame
+    """
+    if header is None:
+        header = cnv_header.read_header(file)
+    col_name = header['columns']
+    if columns is None:
+        usecols = list(range(len(col_name)))
+    else:
+        usecols = [i for i, item in enumerate(col_name) if item in columns]
+    values = read_cnv_array(file, header=header, usecols=usecols, dtype=dtype)
+
+    return pd.DataFrame(values, columns=[col_name[i] for i in usecols], copy=False)
@@ -12,6 +12,8 @@ from typing import Dict, List
 
 # Import bespoke functions
 import scripts.calculations as calculations
+import scripts.raw_inventory as raw_inventory
+import scripts.hex_reader as hex_reader
 from scripts.filename_matching import match_stem_caseinsensitive_lists, match_stem_caseinsensitive
 
 class CTD_Data:
@@ -33,9 +35,14 @@ class CTD_Data:
         Returns:
             CTD_Data Class
         """
-        # get list of all files in directories
-        files = os.listdir(rawFileDirectory) + os.listdir(bottleFileDirectory) 
-        filetypes = ['.xmlcon','.bl','.hex','.hdr','.cnv','.btl']
+        # Inventory of the raw and bottle directories, listed once. Only the
+        # .bl files that are new or changed since the previous run are read
+        inventory = raw_inventory.build_inventory(rawFileDirectory, bottleFileDirectory)
+        files = inventory['files']
+        if len(inventory['added']) > 0:
+            print("New files since the previous inventory: %s" % ", ".join(inventory['added']))
+        if len(inventory['removed']) > 0:
+            print("Files removed since the previous inventory: %s" % ", ".join(inventory['removed']))
         
         self.psaDirectory = psaDirectory 
         self.instrumentPath =""
@@ -45,15 +52,7 @@ class CTD_Data:
         self.OutputDirectory = rawFileDirectory
         self.cnvDirectory = cnvFileDirectory
         
-        fileTypeCount= []
-        xmlCon = ""
-        i=0
-        
         self.df = pd.DataFrame()    
-        allFilesInDirectory = []
-        allFileTypesInDirectory=[]
-        self.arrayItemsIndex=[]
-        self.arrayItemsValue=[]
         self.blarrayItemsIndex=[]
         self.blarrayItemsValue=[]
         
@@ -61,60 +60,41 @@ class CTD_Data:
         self.numberArrayItems: int | None = None
         self.arrayItems: List | Dict | None = None
 
-        # Loop directory and get the file names and types 
+        # File names and types, by type then directory order. Empty .bl files
+        # (no bottles fired) are left out
+        processing = raw_inventory.processing_files(files)
+        allFilesInDirectory = processing['name'].str.lower().tolist()
+        allFileTypesInDirectory = processing['suffix'].tolist()
+        xmlCon = processing.loc[processing['suffix'] == '.xmlcon', 'name'].iloc[0]
         
-        for filetype in filetypes:
-            names = []
-            for name in files:
-                if filetype == '.bl' and name.lower().endswith(filetype):
-                    with open(os.path.join(rawFileDirectory,name), 'r') as f:
-                        line_num = len(f.readlines()) # not most efficient
-                    if line_num > 2:
-                        #print('greater than 2: ' + name)    
-                        names.append(name)
-                        allFilesInDirectory.append(name.lower())
-                        allFileTypesInDirectory.append(filetype)
-                if filetype != '.bl' and name.lower().endswith(filetype): 
-                    names.append(name)
-                    allFilesInDirectory.append(name.lower())
-                    allFileTypesInDirectory.append(filetype)
-                if filetype == '.hex' and name.lower().endswith(filetype):
-                    self.arrayItemsIndex.append(i)
-                    self.arrayItemsValue.append(name)
-                    i+=1
-
-            fileTypeCount.append(len(names))
-            if filetype=='.xmlcon':
-                xmlCon = names[0]
-                      
-            
-        raw_files = list(Path(rawFileDirectory).iterdir())
-        bottle_dir_files = list(Path(bottleFileDirectory).iterdir())
-        all_files = raw_files + bottle_dir_files
-        def get_file_with_extension_from_list(input_list: list[Path], extension: str) -> list[str]:
-            out = [fi.stem for fi in input_list if fi.suffix.lower() == extension]
-            return out
-        all_hex = get_file_with_extension_from_list(all_files, ".hex")
-        all_bl = get_file_with_extension_from_list(all_files, ".bl")
-        all_btl = get_file_with_extension_from_list(all_files, ".btl")
-        all_ros = get_file_with_extension_from_list(all_files, ".ros") + get_file_with_extension_from_list(raw_files, ".bl")
-        all_cnv = get_file_with_extension_from_list(all_files, ".hex")
+        self.arrayItemsValue = files.loc[files['suffix'] == '.hex', 'name'].tolist()
+        self.arrayItemsIndex = list(range(len(self.arrayItemsValue)))
+        # Number of scans and path of the .hex file of each cast
+        hex_rows = files[files['suffix'] == '.hex']
+        self.hexScans = dict(zip(hex_rows['stem'].str.lower(), hex_rows['scans']))
+        self.hexPaths = dict(zip(hex_rows['stem'].str.lower(), hex_rows['path']))
+        
+        def get_file_with_extension_from_list(extension: str, directory: str | None = None) -> list[str]:
+            selected = files['suffix'] == extension
+            if directory is not None:
+                selected &= files['directory'] == directory
+            return files.loc[selected, 'stem'].tolist()
+        all_hex = get_file_with_extension_from_list(".hex")
+        all_bl = get_file_with_extension_from_list(".bl")
+        all_btl = get_file_with_extension_from_list(".btl")
+        all_ros = get_file_with_extension_from_list(".ros") + get_file_with_extension_from_list(".bl", directory='raw')
+        all_cnv = get_file_with_extension_from_list(".hex")
         self.hexfiles = all_hex
         self.blfiles = all_bl
         self.btlfiles = all_btl
         self.rosfiles = all_ros
         self.cnvfiles = all_cnv
         self.fileNameAndType = dict(zip(allFilesInDirectory,allFileTypesInDirectory))
-        self.df_preprocessing = pd.DataFrame(allFilesInDirectory) 
-        self.df = self.df_preprocessing
-        self.df[['cast','file_type']] = self.df[0].str.split(".",expand=True)
-
-        self.df['present'] = 1
+        self.df_preprocessing = processing
         if len(set([fi.lower() for fi in all_bl+all_btl])) != len(all_bl + all_btl):
             print("WARNING: duplicate btl files")
-            self.df = self.df.drop_duplicates()
-        self.df = self.df.pivot(index='cast', columns='file_type', values='present')
-        self.df = self.df.fillna(0)
+        # Presence matrix of the file types per cast, duplicates count once
+        self.df = raw_inventory.presence_matrix(processing)
         
         for item in ['hdr','bl','hex','XMLCON','cnv','btl']:
             if item.lower() not in self.df.columns:
@@ -148,6 +128,18 @@ class CTD_Data:
         self.hexMissing = self.df[self.df['hexMissing']==True].index.tolist()
         self.xmlconMissing = self.df[self.df['xmlconMissing']==True].index.tolist()
 
+    def hex_file(self, cast):
+        """
+        Parameters:
+            cast: str
+                Cast name (file stem, case-insensitive)
+        Returns:
+            hex_reader.HexFile
+            Memory-mapped .hex file of the cast, for random access to the raw
+            scans (e.g. pump status or NMEA data)
+        """
+        return hex_reader.HexFile(self.hexPaths[cast.lower()])
+
 #%%
 def generateXml(psaTemplate, data, name):
     """
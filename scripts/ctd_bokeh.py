@@ -41,7 +41,7 @@ def update_button_attr(button_name, disbld, b_type):
 class bokeh_layout:
     prDM_threshold = 1
 
-    def __init__(self, profile_data, pump_data, output_path, downcast_data):
+    def __init__(self, profile_data, pump_data, output_path, downcast_data, workers=None):
 
         # Define variables
         self.profile_data = profile_data
@@ -49,6 +49,10 @@ class bokeh_layout:
         self.output_path = output_path
         self.downcast_data = downcast_data
         self.oxy_align_default = 2
+        # Oxygen alignment estimated for each profile, by oxygen channel
+        self.oxy_align = {}
+        # Processes used to estimate the oxygen alignment of the profiles, all CPUs by default
+        self.workers = os.cpu_count() if workers is None else workers
 
         if "profile" in profile_data.columns:
             self.profile_list = self.profile_data["profile"].unique().tolist()
@@ -126,6 +130,37 @@ class bokeh_layout:
             update_button_attr(self.next_profile, False, "primary")
             update_button_attr(self.prev_profile, False, "primary")
 
+    def estimate_oxy_align(self):
+        # Estimate the alignment of each profile from the oxygen voltage and temperature channels, stored by the
+        # oxygen concentration of the alignment plots
+        data = self.profile_data[self.profile_data["prDM"] > bokeh_layout.prDM_threshold]
+        for oxygen, voltage, temperature in (("sbeox0Mm/L", "sbeox0V", "t090C"), ("sbeox1Mm/L", "sbeox1V", "t190C")):
+            if oxygen in self.oxy_align or not {voltage, temperature, "timeS"}.issubset(self.param_list):
+                continue
+            self.oxy_align[oxygen] = calculations.estimate_oxygen_alignment(
+                data,
+                oxygen=voltage,
+                temperature=temperature,
+                profile_id="profile",
+                max_lag=self.o2adv1.end,
+                workers=self.workers,
+            )
+
+    def oxy_align_value(self, oxygen, profile=None):
+        # Slider value of the estimated alignment of a profile, or the median of the cruise if profile is None
+        lags = self.oxy_align.get(oxygen)
+        if lags is None:
+            return int(self.oxy_align_default)
+        lag = lags.median() if profile is None else lags.get(profile, float("nan"))
+        if lag != lag:
+            return int(self.oxy_align_default)
+        return int(min(max(round(lag), self.o2adv1.start), self.o2adv1.end))
+
+    def set_oxy_align(self):
+        # Set the oxygen alignment sliders to the estimates for the selected profile
+        self.o2adv1.value = self.oxy_align_value("sbeox0Mm/L", self.profile.value)
+        self.o2adv2.value = self.oxy_align_value("sbeox1Mm/L", self.profile.value)
+
     def screen_html(self):
         output_file(
             os.path.join(
@@ -153,6 +188,10 @@ class bokeh_layout:
         ].copy(deep=True)
         self.col_src_pump_time_on = ColumnDataSource(pump_time_on)
 
+        # Oxygen alignment sliders start from the estimated alignment of the profile
+        self.estimate_oxy_align()
+        self.set_oxy_align()
+
         # Oxygen channel updates
         if "sbeox0Mm/L" in self.param_list:
             # Define the ColumnDataSource for the oxygen alignment plot 1
@@ -277,6 +316,10 @@ class bokeh_layout:
         col_src_pump_time_updated = ColumnDataSource(pump_time_updated)
         self.col_src_pump_time_on.data.update(col_src_pump_time_updated.data)
 
+        # A new profile resets the oxygen alignment sliders to its estimates
+        if attr == "value":
+            self.set_oxy_align()
+
         # Oxygen channel updates
         if "sbeox0Mm/L" in self.param_list:
             # Update source for p1
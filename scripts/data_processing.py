@@ -6,6 +6,8 @@ Created on Tue Mar 26 09:29:19 2024
 """
 import os
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import gc
 import re
@@ -15,6 +17,11 @@ import numpy as np
 # Import bespoke functions
 import scripts.calculations as calculations
 import scripts.sensor_configuration as sensor_configuration
+import scripts.cnv_header as cnv_header
+import scripts.cnv_reader as cnv_reader
+
+# Columns with repeated strings stored as categoricals by compact_dtypes
+COMPACT_CATEGORY_COLUMNS = ['profile', 'CTD number', 'cast']
 
 #%% 
 def process_cnv(raw_directory):
@@ -28,50 +35,27 @@ def process_cnv(raw_directory):
         Contains names of CNV files, latitude, longitude and timestamp of the 
         start of each cast contained in the CNV files
     """
-    # Get list of files in the raw data directory
-    filelist = os.listdir(raw_directory)
     # Initiate lists to store data in
-    cnvfilelist = []
     latlist = []
     longlist = []    
     timelist = []
     systimelist = []
     
     # Extract cnv file names
-    for item in filelist:
-        if item.endswith(".cnv"):
-            item = item.split('.')
-            cnvfilelist.append(item[0].upper())
-    cnv_extension = "cnv"
-    cnvfilelist = [str(file) for file in Path(raw_directory).rglob(f"*") if file.suffix.lower() == f'.{cnv_extension.lower()}']
-    
-    # Extract lat, long and timestamp from cnv file and create list to add to dataframe        
+    cnvfilelist = cnv_header.files_with_extension(raw_directory, "cnv")
+    
+    # Extract lat, long and timestamp from the cnv header index and create list to add to dataframe        
+    headers = cnv_header.read_headers(cnvfilelist)
     for item in cnvfilelist:
-        try:
-            with open(item) as f:
-                for line in f:
-                    line = line.rstrip()
-                    if line.startswith("* NMEA Latitude"):
-                        latlist.append(line)
-                    if line.startswith("* NMEA Longitude"):
-                        longlist.append(line)
-                    if line.startswith("* System UpLoad Time"):
-                        timelist.append(line)
-                    if line.startswith("* System UTC"):
-                        systimelist.append(line)
-        except UnicodeDecodeError:
-           with open(item, "r", encoding='ISO-8859-1') as f:
-                for line in f:
-                    line = line.rstrip()
-                    if line.startswith("* NMEA Latitude"):
-                        latlist.append(line)
-                    if line.startswith("* NMEA Longitude"):
-                        longlist.append(line)
-                    if line.startswith("* System UpLoad Time"):
-                        timelist.append(line)
-                    if line.startswith("* System UTC"):
-                        systimelist.append(line)
- 
+        header = headers[item]
+        if header['nmea_latitude']:
+            latlist.append(header['nmea_latitude'])
+        if header['nmea_longitude']:
+            longlist.append(header['nmea_longitude'])
+        if header['upload_time']:
+            timelist.append(header['upload_time'])
+        if header['utc_time']:
+            systimelist.append(header['utc_time'])
                 
     return {'cnvfilelist': [Path(cnv_i).name for cnv_i in cnvfilelist],
             'latlist': latlist,
@@ -89,87 +73,17 @@ def get_NMEA_from_header(directory, fileformat):
     '''
     
     # Get CNV filenames
-    filelist = os.listdir(directory)
-
-    infofilelist = [str(file) for file in Path(directory).rglob(f"*") if file.suffix.lower() == f'.{fileformat.lower()}']
-
-    # for item in filelist:
-        # if item.endswith(".%s" % fileformat.lower()):
-            # item = item.split('.')
-            # infofilelist.append(item[0].upper())
+    infofilelist = cnv_header.files_with_extension(directory, fileformat)
     
-    # Set dataframe for population
-    df_NMEA = pd.DataFrame(columns = ['CTD number', 'Lat','Long','Upload Time','UTC Time'])
-    
-    # Extract lat, long and timestamps from cnv file        
+    # Extract lat, long and timestamps from the header index of each file
+    headers = cnv_header.read_headers(infofilelist)
+    rows = []
     for item in infofilelist:
-        # file_i_lower = os.path.join(directory,item.lower()+".%s" % fileformat.lower())
-        # file_i_upper = os.path.join(directory,item.upper()+".%s" % fileformat.lower())
-        # file_i = [file_i_lower, file_i_upper][os.path.exists(file_i_upper)]
-        try: 
-            with open(item) as f:
-                latdec = np.nan 
-                londec = np.nan
-                upload_time = ''
-                utc_time = ''
-        
-                for line in f:
-                    line = line.rstrip()
-                    if line.startswith("* NMEA Latitude"):
-                        x = line.split( )
-                        latdec = float(x[5])/60
-                        latdec = latdec + float(x[4])
-                        if x[6]=='S':
-                            latdec = latdec * -1
-
-                    if line.startswith("* NMEA Longitude"):
-                        x = line.split( )
-                        londec = float(x[5])/60
-                        londec = londec + float(x[4])
-                        if x[6]=='W':
-                            londec = londec * -1
-
-                    if line.startswith("* System UpLoad Time"):
-                        upload_time = line
-
-                    if line.startswith("* System UTC"):
-                        utc_time = line
-        except UnicodeDecodeError:
-           with open(item, "r", encoding="ISO-8859-1") as f:
-                latdec = np.nan 
-                londec = np.nan
-                upload_time = ''
-                utc_time = ''
-        
-                for line in f:
-                    line = line.rstrip()
-                    if line.startswith("* NMEA Latitude"):
-                        x = line.split( )
-                        latdec = float(x[5])/60
-                        latdec = latdec + float(x[4])
-                        if x[6]=='S':
-                            latdec = latdec * -1
-
-                    if line.startswith("* NMEA Longitude"):
-                        x = line.split( )
-                        londec = float(x[5])/60
-                        londec = londec + float(x[4])
-                        if x[6]=='W':
-                            londec = londec * -1
-
-                    if line.startswith("* System UpLoad Time"):
-                        upload_time = line
-
-                    if line.startswith("* System UTC"):
-                        utc_time = line
- 
-
-        # Save metadata to dataframe for file
-        df_NMEA = pd.concat([df_NMEA, 
-                             pd.DataFrame([[Path(item).stem.upper(),latdec,londec,upload_time,utc_time]], 
-                                          columns = ['CTD number', 'Lat','Long','Upload Time','UTC Time'])
-                             ]
-                            )
+        header = headers[item]
+        rows.append([Path(item).stem.upper(), header['lat'], header['lon'], header['upload_time'], header['utc_time']])
+
+    # Save metadata to dataframe for all files
+    df_NMEA = pd.DataFrame(rows, columns = ['CTD number', 'Lat','Long','Upload Time','UTC Time'])
     df_NMEA['Upload Time'] = pd.to_datetime(df_NMEA['Upload Time'].str.split('= ',expand=True)[1], format= '%b %d %Y %H:%M:%S')
     df_NMEA['UTC Time'] = pd.to_datetime(df_NMEA['UTC Time'].str.split('= ',expand=True)[1], format= '%b %d %Y %H:%M:%S')
     
@@ -440,7 +354,8 @@ def merge_data_with_metadata(cruiseID,
         logs: str
             Name of directory to save metadata csv file to
         binning_info: str
-            String indicating the bin width and unit.
+            String indicating the bin width and unit, see 
+            seabird_processes.binning_info
             
     Returns:
         pandas.DataFrame
@@ -476,9 +391,87 @@ def merge_data_with_metadata(cruiseID,
     return df
     
 
+#%%
+def read_cnv_file(file, raw_folder = '', directory = '', txt_strip = '', 
+                  ud_id = True, z_cord = 'prDM', params = [], float32 = False):
+    """
+    Load a single SBE CNV file into a pandas DataFrame. Used by cnv2df for 
+    each file in the file list, either sequentially or in a worker process.
+    
+    Parameters:   
+        file: str
+            Name of the CNV file
+        raw_folder: str
+            Name of directory with raw files
+        directory: str
+            Name of folder containing CNV files
+        txt_strip: str
+            Regular expression to isolate the profile name from the file name
+        ud_id: bool
+            Add a column ('cast') indicating the down or upcast of the profile
+        z_cord: str
+            Provide the z variable for determining the down/up cast split
+        params: list
+            If only a subset of the parameters are required, only these (and 
+            the z-coordinate for the down/up cast split) are parsed from the file
+        float32: bool
+            Store the sensor channels as float32 (see compact_dtypes)
+    
+    Returns:
+        pandas.DataFrame
+    """
+    f = os.path.join(directory,file)
+    # Determine column names and file header length from the header index
+    header = cnv_header.read_header(f)
+    col_name = header['columns']
+    
+    # Voltage channel to sensor type mapping
+    sensor_dict = sensor_configuration.file_sensor_config(raw_folder, file)
+
+    if len(params) != 0:
+        # Resolve the parameters to the SBE CNV column names in the header, 
+        # so only the columns required are parsed from the file
+        sensor_channels = {sensor: channel for channel, sensor in sensor_dict.items()}
+        required = [sensor_channels.get(item, item) for item in params]
+        if ud_id == True:
+            required.append(z_cord)
+        data = cnv_reader.read_cnv_frame(f, header=header, columns=required)
+    else:
+        # Read data from file into a DataFrame using the fixed-width CNV reader
+        data = cnv_reader.read_cnv_frame(f, header=header)
+    
+    # Drop SBE CNV file flag column
+    if 'flag' in data.columns:
+        data = data.drop(columns=['flag'])
+    
+    # Rename voltage channels to sensor type
+    data.rename(columns=sensor_dict, inplace=True)
+    # Drop any voltage channels that were not in use
+    if 'NotInUse' in data.columns:
+        data = data.drop(columns=['NotInUse'])
+            
+    # Checks the z-cordinate parameter provided exists in the data.
+    if ud_id == True and z_cord not in col_name:
+        raise IOError("Please provide the name of a valid z-co-ordinate within file: %s." % file)
+        
+    # If the cast is to be split into down and up cast cycles use the z-cord provided.
+    if ud_id ==True:
+        data['cast'] = 'D'
+        data.loc[int(data[z_cord].idxmax())+1:,['cast']] = 'U'
+    
+    # Add profile name to the DataFrame as taken from the filename using txt_strip argument.
+    data.insert(0, 'profile', file.replace(txt_strip,'').upper())
+    
+    # Reduce the sensor channels to float32 per file, before the files are combined
+    if float32 == True:
+        data = compact_dtypes(data, float32=True, categories=False)
+    
+    return data
+
 #%%                              
 def cnv2df(cruiseID, file_list, params=[], raw_folder = '', directory = '', 
-           txt_strip = '', ud_id = True, z_cord = 'prDM'):
+           txt_strip = '', ud_id = True, z_cord = 'prDM', workers = None,
+           compact = False, float32 = False):
     """
     This function loads a list of SBE CTD profile CNV format files into a 
     pandas DataFrame. Using arguments the profiles can be provisionally QC'd, 
@@ -491,7 +484,8 @@ def cnv2df(cruiseID, file_list, params=[], raw_folder = '', directory = '',
             A list of file paths for the CNV files. To run for a single file, provide a list with one item;
         params: list
             If only a subset of the parameters are required, provide a list 
-            using the SBE CNV column name (e.g. 'prDM' for Pressure);
+            using the SBE CNV column name (e.g. 'prDM' for Pressure). Only 
+            these columns are parsed from the files;
         raw_folder: str
             Name of directory with raw files
         directory: str
@@ -504,6 +498,14 @@ def cnv2df(cruiseID, file_list, params=[], raw_folder = '', directory = '',
             is part of the down or upcast of each profile
         z_cord: str
             Provide the z variable for determining the down/up cast split
+        workers: int | None
+            Number of processes used to parse the CNV files. None or 1 reads
+            the files sequentially in the current process.
+        compact: bool
+            Return the compact representation of the DataFrame (categorical
+            profile and cast columns, see compact_dtypes)
+        float32: bool
+            With compact, also store the sensor channels as float32
     
     Returns:
         pandas.DataFrame
@@ -524,84 +526,169 @@ def cnv2df(cruiseID, file_list, params=[], raw_folder = '', directory = '',
         
     type_check(file_list=file_list, params=params, txt_strip=txt_strip, ud_id=ud_id, z_cord=z_cord)
 
-    # Set DataFrame container for function
-    data_all = pd.DataFrame()
+    # Scan the headers once in this process and write the header index, the
+    # workers then only read it (read_cnv_file does not persist the index)
+    cnv_header.read_headers([os.path.join(directory, file) for file in file_list])
+
+    # Load each file provided in the file_list argument, in order
+    # Only the parameters requested are parsed from each file
+    read_file = partial(read_cnv_file, raw_folder=raw_folder, directory=directory,
+                        txt_strip=txt_strip, ud_id=ud_id, z_cord=z_cord, params=params,
+                        float32=compact and float32)
+    if workers is not None and workers > 1 and len(file_list) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(read_file, file_list))
+    else:
+        frames = [read_file(file) for file in file_list]
     
-    # Iterate through files provided in the file_list argument
-    for file in file_list:
-        #print(file)       # for debugging
-        f = os.path.join(directory,file)
-        with open(f,'r') as prof:
-            # Determine column names and descriptions and file header length
-            count = 0
-            col_id = []
-            col_name = []
-            col_description = []
-            while True:
-                line = next(prof)
-                count += 1
-                if line =='*END*\n':
-                    break
-                elif '# name ' in line:
-                    col_id.append(re.findall(r'[0-9]+',line)[0])
-                    col_name.append(line.split(': ')[0].split(' = ')[1])
-                    col_description.append(line.split(': ')[1][0:-1])
-
-        # Read data from file into a DataFrame using arguments from above
-        data = pd.read_csv(f, sep=r'\s+', header=None, index_col=0, names=col_name, skiprows=count, low_memory=False)
-        
-        # Set any columns that are read as string to float
-        colsf = data.select_dtypes(exclude=['float']).columns
-        data[colsf] = data[colsf].apply(pd.to_numeric, errors='coerce')
-        # Drop SBE CNV file flag column
-        data = data.drop(columns=['flag'])
-        
-        # Rename voltage channels to sensor type
-        sensor_dict = sensor_configuration.file_sensor_config(raw_folder, file)
-        data.rename(columns=sensor_dict, inplace=True)
-        # Drop any voltage channels that were not in use
-        if 'NotInUse' in data.columns:
-            data = data.drop(columns=['NotInUse'])
-            
-        # Return data as DataFrame and reset the Index as unique for each cycle.
-        data = data.reset_index()
-                
-        # Checks the z-cordinate parameter provided exists in the data.
-        if ud_id == True and z_cord not in col_name:
-            raise IOError("Please provide the name of a valid z-co-ordinate within file: %s." % file)
-            
-        # If the cast is to be split into down and up cast cycles use the z-cord provided.
-        if ud_id ==True:
-            data['cast'] = 'D'
-            data.loc[int(data[z_cord].idxmax())+1:,['cast']] = 'U'
-        
-        # Add profile name to the DataFrame as taken from the filename using txt_strip argument.
-        data.insert(0, 'profile', file.replace(txt_strip,'').upper())
-        
-        # Add file data to function DataFrame
-        data_all = pd.concat([data_all, data],sort=False)
-            
-    # Reset function DataFrame index to unique row number for all cycles in the data set     
-    data_all = data_all.reset_index(drop=True)
+    # Combine file data into the function DataFrame with a single concatenation
+    # and reset the index to unique row number for all cycles in the data set
+    if len(frames) == 0:
+        data_all = pd.DataFrame()
+    else:
+        data_all = pd.concat(frames, sort=False).reset_index(drop=True)
 
     # Reduce to a subset of the parameters provided as an function argument
+    data_all = subset_params(data_all, params, ud_id)
+    
+    if compact == True:
+        data_all = compact_dtypes(data_all, float32=float32)
+
+    return data_all
+
+#%%
+def subset_params(data, params, ud_id):
+    """
+    Reduce a DataFrame loaded from CNV files to the profile (and cast) columns
+    and a subset of the parameters.
+    
+    Parameters:
+        data: pandas.DataFrame
+        params: list
+            SBE CNV column names to keep. An empty list keeps all columns
+        ud_id: bool
+            Keep the 'cast' column
+    
+    Returns:
+        pandas.DataFrame
+    """
     if len(params) != 0:
         file_params = ['profile']
         if ud_id==True:
             file_params.append('cast')
         for item in params:
             file_params.append(item)
-        data_all = data_all[file_params]
+        data = data[file_params]
+    
+    return data
 
-    return data_all
+#%%
+def compact_dtypes(data, float32=False, categories=True):
+    """
+    Compact representation of a cruise-wide DataFrame: profile names and the
+    cast indicator as categoricals, QC flag columns as int8 and optionally the
+    sensor channels as float32. Time channels are kept as float64, as float32
+    cannot resolve a 24 Hz scan over a long cast.
+    
+    Parameters:
+        data: pandas.DataFrame
+        float32: bool
+            Store the float64 sensor channels as float32
+        categories: bool
+            Store the profile and cast columns as categoricals
+    
+    Returns:
+        pandas.DataFrame
+    """
+    compact = {}
+    for column in data.columns:
+        dtype = data[column].dtype
+        if column in COMPACT_CATEGORY_COLUMNS:
+            if categories == True and not isinstance(dtype, pd.CategoricalDtype):
+                compact[column] = data[column].astype('category')
+        elif column.endswith('_QC') or column.startswith('QC_'):
+            flags = pd.to_numeric(data[column], errors='coerce')
+            if flags.notna().all():
+                compact[column] = flags.astype(np.int8)
+        elif float32 == True and dtype == np.float64 and not column.startswith('time'):
+            compact[column] = data[column].astype(np.float32)
+    
+    if len(compact) == 0:
+        return data
+    return data.assign(**compact)
+
+def memory_report(before, after):
+    """
+    Compare the memory use of two representations of a DataFrame, e.g. before
+    and after compact_dtypes.
+    
+    Parameters:
+        before: pandas.DataFrame
+        after: pandas.DataFrame
+    
+    Returns:
+        pandas.DataFrame
+        dtype and memory (MB) of each column before and after, with the totals
+        in the last row
+    """
+    report = pd.DataFrame({'dtype before': before.dtypes.astype(str),
+                           'MB before': before.memory_usage(deep=True, index=False) / 1e6,
+                           'dtype after': after.dtypes.astype(str),
+                           'MB after': after.memory_usage(deep=True, index=False) / 1e6,
+                           })
+    report.loc['Total'] = ['', report['MB before'].sum(), '', report['MB after'].sum()]
+    
+    return report
+
+#%%
+def iter_cnv_profiles(file_list, params=[], raw_folder = '', directory = '', 
+                      txt_strip = '', ud_id = True, z_cord = 'prDM'):
+    """
+    Generator version of cnv2df, yielding the data of one CNV file (profile) 
+    at a time so that a cruise can be processed with bounded memory.
+    Each frame has the same columns as cnv2df and is indexed with the row 
+    numbers it would have in the combined cnv2df DataFrame.
+    
+    Parameters:   
+        file_list: list
+            A list of file paths for the CNV files
+        params: list
+            If only a subset of the parameters are required, provide a list 
+            using the SBE CNV column name (e.g. 'prDM' for Pressure);
+        raw_folder: str
+            Name of directory with raw files
+        directory: str
+            Name of folder containing CNV files
+        txt_strip: str
+            Regular expression to isolate the profile name from the file name
+        ud_id: bool
+            Add a column ('cast') indicating the down or upcast of the profile
+        z_cord: str
+            Provide the z variable for determining the down/up cast split
+    
+    Yields:
+        pandas.DataFrame
+        Data from a single CNV file
+    """
+    if not isinstance(file_list, list):
+        raise TypeError("Error: 'file_list' should be a list.")
+    
+    offset = 0
+    for file in file_list:
+        data = read_cnv_file(file, raw_folder=raw_folder, directory=directory,
+                             txt_strip=txt_strip, ud_id=ud_id, z_cord=z_cord, params=params)
+        data.index = data.index + offset
+        offset += len(data)
+        yield subset_params(data, params, ud_id)
 
 #%%
 def start_dcast(df, profile_id, zcoord):
     """
     Parameters:
-        df: pandas.DataFrame
+        df: pandas.DataFrame | iterable of pandas.DataFrame
             2Hz data frame returned from cnv2df function. Contains all data
-            from the CNV files
+            from the CNV files. Profile frames from iter_cnv_profiles are
+            processed one at a time.
         profile_id: str
             Name of column containing the profile name
         zcoord: str
@@ -609,6 +696,13 @@ def start_dcast(df, profile_id, zcoord):
     Returns:
         pandas.DataFrame
     """
+    # Process profile frames from a generator one at a time
+    if not isinstance(df, pd.DataFrame):
+        pumpdfs = [start_dcast(frame, profile_id, zcoord) for frame in df]
+        if len(pumpdfs) == 0:
+            return pd.DataFrame(columns=[profile_id,'timeS',zcoord])
+        return pd.concat(pumpdfs)
+    
     # Get a list of profiles from the dataframe
     profile_list = df[profile_id].unique().tolist()
     # Instantiate an empty list to collate results
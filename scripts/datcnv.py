@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Data conversion of SBE 911plus .hex files to engineering units, as done by
+SBEDataProcessing DatCnv.
+
+The scans of the .hex file are decoded at once with hex_reader.HexFile.
+The frequency and voltage words, the pressure sensor temperature and status
+bits are unpacked with array operations and converted with the calibration
+equations of the sensors in the XMLCON file (SBE 3 temperature, SBE 4
+conductivity, Digiquartz pressure and SBE 43 oxygen on a voltage channel).
+The columns written are those of the CalcArray of the DatCnv PSA file, with
+the same names as in the CNV files written by DatCnv.
+"""
+import os
+import xml.etree.ElementTree as elementTree
+import numpy as np
+import pandas as pd
+import seawater
+
+import scripts.calculations as calculations
+from scripts.psa_xml import psa_calculations
+from scripts.seabird_processes import practical_salinity
+from scripts.hex_reader import (HexFile, SCAN_RATE, FREQUENCY_CHANNELS, instrument_settings,
+                                frequencies, voltages, status_word)
+
+BAD_FLAG = -9.990e-29
+
+# DatCnv calculations by CalcID: column name and description, by ordinal
+# (0 primary, 1 secondary sensor)
+CALCULATIONS = {84: lambda o: ('timeS', 'Time, Elapsed [seconds]'),
+                65: lambda o: ('prDM', 'Pressure, Digiquartz [db]'),
+                17: lambda o: ('depSM', 'Depth [salt water, m]'),
+                81: lambda o: ('t%s90C' % o, 'Temperature%s [ITS-90, deg C]' % (', 2' if o else '')),
+                12: lambda o: ('c%sS/m' % o, 'Conductivity%s [S/m]' % (', 2' if o else '')),
+                70: lambda o: ('sal%s%s' % (o, o), 'Salinity, Practical%s [PSU]' % (', 2' if o else '')),
+                57: lambda o: ('sbeox%sV' % o, 'Oxygen raw, SBE 43%s [V]' % (', 2' if o else '')),
+                55: lambda o: ('sbeox%sMm/L' % o, 'Oxygen, SBE 43%s [umol/l]' % (', 2' if o else '')),
+                89: lambda o: ('v%s' % o, 'Voltage %s' % o),
+                69: lambda o: ('pumps', 'Pump Status'),
+                }
+
+#%%
+def _coefficient_value(element):
+    try:
+        return float(element.text)
+    except (TypeError, ValueError):
+        return element.text
+
+def instrument_config(xmlcon_file):
+    """
+    Parse the instrument settings and the sensor calibration coefficients of
+    an SBE 911plus XMLCON file.
+
+    Parameters:
+        xmlcon_file: str
+    Returns:
+        dict
+        Instrument settings (e.g. 'NmeaPositionDataAdded'), and 'sensors', a
+        list with the sensor type and coefficients of each entry of the
+        sensor array. Coefficients of the equation="1" (g, h, i, j) set are
+        used where a sensor has several equations.
+    """
+    instrument = elementTree.parse(xmlcon_file).getroot().find('./Instrument')
+    settings = instrument_settings(xmlcon_file)
+    sensors = []
+    for sensor in instrument.findall('./SensorArray/Sensor'):
+        element = list(sensor)[0]
+        coefficients = {}
+        for child in element:
+            if len(child) == 0:
+                coefficients[child.tag] = _coefficient_value(child)
+        for child in element:
+            if len(child) > 0 and child.get('equation', '1') == '1':
+                coefficients.update({item.tag: _coefficient_value(item) for item in child})
+        sensors.append({'index': int(sensor.get('index')), 'type': element.tag, 'coefficients': coefficients})
+    settings['sensors'] = sorted(sensors, key=lambda item: item['index'])
+    return settings
+
+#%%
+def temperature_its90(f, coefs):
+    """
+    SBE 3 temperature (ITS-90, deg C) from frequency f (Hz)
+    """
+    x = np.log(coefs['F0'] / f)
+    t = 1. / (coefs['G'] + x * (coefs['H'] + x * (coefs['I'] + x * coefs['J']))) - 273.15
+    return coefs.get('Slope', 1.) * t + coefs.get('Offset', 0.)
+
+def conductivity(f, t, p, coefs):
+    """
+    SBE 4 conductivity (S/m) from frequency f (Hz), temperature t (deg C) and
+    pressure p (dbar)
+    """
+    f = f / 1000.
+    c = (coefs['G'] + f * f * (coefs['H'] + f * (coefs['I'] + f * coefs['J']))) / \
+        (1. + coefs['CTcor'] * t + coefs['CPcor'] * p)
+    return coefs.get('Slope', 1.) * c + coefs.get('Offset', 0.)
+
+def digiquartz_pressure(f, temperature_counts, coefs):
+    """
+    Paroscientific Digiquartz pressure (dbar) from frequency f (Hz) and the
+    12 bit pressure sensor temperature counts, with the temperature
+    compensation of the 911plus
+    """
+    u = coefs['AD590M'] * temperature_counts + coefs['AD590B']
+    c = coefs['C1'] + u * (coefs['C2'] + u * coefs['C3'])
+    d = coefs['D1'] + u * coefs['D2']
+    t0 = coefs['T1'] + u * (coefs['T2'] + u * (coefs['T3'] + u * (coefs['T4'] + u * coefs['T5'])))
+    # Period in microseconds
+    ratio = 1. - (t0 * f / 1e6) ** 2
+    psia = c * ratio * (1. - d * ratio)
+    dbar = (psia - 14.7) * 0.689476
+    return coefs.get('Slope', 1.) * dbar + coefs.get('Offset', 0.)
+
+#%%
+def _sensor(settings, sensor_type, ordinal=0):
+    """
+    Returns:
+        dict
+        The sensor of the given type and ordinal (0 primary, 1 secondary) of
+        the sensor array
+    """
+    sensors = [item for item in settings['sensors'] if item['type'] == sensor_type]
+    if len(sensors) <= ordinal:
+        raise KeyError("No %s with ordinal %s in the XMLCON file." % (sensor_type, ordinal))
+    return sensors[ordinal]
+
+def datcnv(hex_file, xmlcon_file, psa_file, latitude=None):
+    """
+    Convert an SBE 911plus .hex file to engineering units.
+
+    Parameters:
+        hex_file: str
+        xmlcon_file: str
+            XMLCON file of the cast
+        psa_file: str
+            DatCnv PSA file (or template) with the CalcArray of the output
+            columns
+        latitude: float
+            Latitude for the depth calculation. The latitude of the PSA file
+            is used if None
+    Returns:
+        tuple
+        pandas.DataFrame with the CNV column names (and a 'flag' column) and
+        the header lines of the .hex file
+    """
+    with HexFile(hex_file, xmlcon_file=xmlcon_file) as hex_reader:
+        header = hex_reader.header
+        scans = hex_reader.records()
+    settings = instrument_config(xmlcon_file)
+    calcs, psa_latitude = psa_calculations(psa_file)
+    if latitude is None:
+        latitude = psa_latitude if psa_latitude is not None else 0.
+
+    freq = frequencies(scans)
+    volts = voltages(scans)
+    temperature_counts, status, _ = status_word(scans)
+    time = np.arange(len(scans)) / SCAN_RATE
+
+    # Frequency channels are the first entries of the sensor array
+    def frequency_of(sensor):
+        return freq[:, sensor['index']]
+    # Voltage channels follow the frequency channels in the sensor array
+    def volts_of(sensor):
+        return volts[:, sensor['index'] - FREQUENCY_CHANNELS]
+
+    pressure = digiquartz_pressure(frequency_of(_sensor(settings, 'PressureSensor')), temperature_counts,
+                                   _sensor(settings, 'PressureSensor')['coefficients'])
+    derived = {}
+    def temperature(ordinal):
+        if ('t', ordinal) not in derived:
+            sensor = _sensor(settings, 'TemperatureSensor', ordinal)
+            derived[('t', ordinal)] = temperature_its90(frequency_of(sensor), sensor['coefficients'])
+        return derived[('t', ordinal)]
+    def cond(ordinal):
+        if ('c', ordinal) not in derived:
+            sensor = _sensor(settings, 'ConductivitySensor', ordinal)
+            derived[('c', ordinal)] = conductivity(frequency_of(sensor), temperature(ordinal), pressure, sensor['coefficients'])
+        return derived[('c', ordinal)]
+    def oxygen_volts(ordinal, calc):
+        if ('ox', ordinal) not in derived:
+            sensor = _sensor(settings, 'OxygenSensor', ordinal)
+            v = volts_of(sensor)
+            if calc.get('ApplyHysteresisCorrection') == '1':
+                coefs = sensor['coefficients']
+                df = pd.DataFrame({'prDM': pressure, 'timeS': time, 'oxy_volts': v})
+                corrected = calculations.oxyVolts_hysteresis(df, coefs['H1'], coefs['H2'], coefs['H3'], coefs['offset']).to_numpy()
+                v = np.where(np.isnan(corrected), v, corrected)
+            derived[('ox', ordinal)] = (sensor, v)
+        return derived[('ox', ordinal)]
+
+    columns, descriptions = {}, []
+    for calc_id, ordinal, calc in calcs:
+        if calc_id not in CALCULATIONS:
+            raise ValueError("Channel %s (CalcID %s) of the PSA file cannot be converted by datcnv, "
+                             "its calculation is not supported." % (calc.get('FullName'), calc_id))
+        name, description = CALCULATIONS[calc_id](ordinal)
+        if calc_id == 84:
+            values = time
+        elif calc_id == 65:
+            values = pressure
+        elif calc_id == 17:
+            values = seawater.dpth(pressure, float(calc.get('Latitude', latitude)))
+        elif calc_id == 81:
+            values = temperature(ordinal)
+        elif calc_id == 12:
+            values = cond(ordinal)
+        elif calc_id == 70:
+            values = practical_salinity(cond(ordinal), temperature(ordinal), pressure)
+        elif calc_id == 57:
+            _, values = oxygen_volts(ordinal, calc)
+        elif calc_id == 55:
+            sensor, v = oxygen_volts(ordinal, calc)
+            t = temperature(ordinal)
+            # dV/dt over the window for the tau correction
+            window = max(int(round(float(calc.get('WindowSize', 2.)) * SCAN_RATE)), 1)
+            dvdt = pd.Series(v).rolling(window, min_periods=1).mean().diff() / \
+                   pd.Series(time).rolling(window, min_periods=1).mean().diff()
+            if calc.get('ApplyTauCorrection') != '1':
+                dvdt = 0.
+            values = np.asarray(calculations.sbe43_oxycalc(v, t, pressure, practical_salinity(cond(ordinal), t, pressure),
+                                                           sensor['coefficients'], np.nan_to_num(np.asarray(dvdt)), 'umol/L'))
+        elif calc_id == 89:
+            values = volts[:, ordinal]
+        elif calc_id == 69:
+            values = (status & 0x01).astype(np.float64)
+        columns[name] = values
+        descriptions.append('%s: %s' % (name, description))
+    columns['flag'] = np.zeros(len(scans))
+    descriptions.append('flag:  0.000e+00')
+
+    data = pd.DataFrame(columns)
+    data.attrs['descriptions'] = descriptions
+    return data, header
+
+#%%
+def write_cnv(data, header, output_file):
+    """
+    Write the output of datcnv as an ASCII CNV file, with the .hex header
+    followed by the column names and spans, and 11 character fixed-width
+    fields.
+
+    Parameters:
+        data: pandas.DataFrame
+            From datcnv
+        header: list
+            Header lines of the .hex file
+        output_file: str
+    """
+    lines = [line for line in header if line.strip() != '*END*']
+    lines += ['# nquan = %s' % data.shape[1],
+              '# nvalues = %s' % data.shape[0],
+              '# units = specified']
+    for i, description in enumerate(data.attrs.get('descriptions', data.columns)):
+        lines.append('# name %s = %s' % (i, description))
+    for i, column in enumerate(data.columns):
+        if len(data) > 0:
+            lines.append('# span %s = %11.4f, %11.4f' % (i, data[column].min(), data[column].max()))
+    lines += ['# interval = seconds: %s' % round(1. / SCAN_RATE, 7),
+              '# bad_flag = %.3e' % BAD_FLAG,
+              '# file_type = ascii',
+              '*END*']
+    fmt = ['%11.4f'] * (data.shape[1] - 1) + ['%11.3e']
+    values = data.to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    with open(output_file, 'w', newline='') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+        if not missing.any():
+            np.savetxt(f, values, fmt=''.join(fmt), newline='\r\n')
+            return
+        # Missing values are written as the bad flag in the exponent format, 
+        # %11.4f would round it to -0.0000
+        fields = [np.where(missing[:, i], '%11.3e' % BAD_FLAG, np.char.mod(fmt[i], values[:, i]))
+                  for i in range(values.shape[1])]
+        f.writelines(''.join(row) + '\r\n' for row in zip(*fields))
+
+def _datcnv_file(hex_file, xmlcon_file, psa_file, output_directory, latitude):
+    data, header = datcnv(hex_file, xmlcon_file, psa_file, latitude=latitude)
+    output_file = os.path.join(output_directory, os.path.splitext(os.path.basename(hex_file))[0] + '.cnv')
+    write_cnv(data, header, output_file)
+    return output_file
+
+def datcnv_files(hex_files, xmlcon_files, psa_file, output_directory, latitude=None):
+    """
+    Convert .hex files to CNV files in the output directory, in place of a
+    DatCnv batch run.
+
+    Parameters:
+        hex_files: list
+            Paths of the .hex files
+        xmlcon_files: list
+            Path of the XMLCON file of each .hex file
+        psa_file: str
+            DatCnv PSA file (or template)
+        output_directory: str
+        latitude: float
+            Latitude for the depth calculation, from the PSA file if None
+    Returns:
+        list
+        Paths of the CNV files written
+    """
+    return [_datcnv_file(hex_file, xmlcon_file, psa_file, output_directory, latitude)
+            for hex_file, xmlcon_file in zip(hex_files, xmlcon_files)]
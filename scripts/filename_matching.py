@@ -1,8 +1,82 @@
+import os
+from bisect import bisect_left
 from pathlib import Path
 import pandas as pd
 # import openpyxl
 import re
 
+# FileIndex per directory, {(directory, recursive): FileIndex}
+_file_indices = {}
+
+
+class FileIndex:
+    """
+    Case-insensitive index of the files in a directory. The directory is 
+    listed once and the files are looked up by lower-cased name (stem + 
+    suffix) in a hash map. The index is rebuilt when a directory in the tree
+    is modified (files added, removed or renamed).
+    """
+
+    def __init__(self, directory: str | Path, recursive: bool = False):
+        self.directory = Path(directory)
+        self.recursive = recursive
+        self.files: list[Path] = []
+        self._directories: list[str] = []
+        self._mtimes: list[int] = []
+        self._by_name: dict[str, list[Path]] = {}
+        self.build()
+
+    def build(self) -> None:
+        directories, files = [], []
+        if self.recursive:
+            for root, dirs, names in os.walk(self.directory):
+                directories.append(root)
+                files += [Path(root, name) for name in dirs + names]
+        else:
+            directories.append(str(self.directory))
+            files = [Path(entry.path) for entry in os.scandir(self.directory)]
+        self._directories = directories
+        self._mtimes = [os.stat(di).st_mtime_ns for di in directories]
+        self.files = files
+        self._by_name = {}
+        for fi in files:
+            self._by_name.setdefault(fi.name.lower(), []).append(fi)
+
+    def refresh(self) -> bool:
+        # Rebuild the index if a directory has been modified since it was built
+        try:
+            if [os.stat(di).st_mtime_ns for di in self._directories] == self._mtimes:
+                return False
+        except OSError:
+            pass
+        self.build()
+        return True
+
+    def find(self, name: str) -> list[Path]:
+        return self._by_name.get(name.lower(), [])
+
+    def find_stem(self, stem: str, extension: str) -> list[Path]:
+        return self.find(stem + extension)
+
+    def with_extension(self, extension: str) -> list[Path]:
+        extension = extension.lower()
+        return [fi for fi in self.files if fi.suffix.lower() == extension]
+
+    def stems(self, extension: str) -> list[str]:
+        return [fi.stem for fi in self.with_extension(extension)]
+
+
+def file_index(directory: str | Path, recursive: bool = False) -> FileIndex:
+    # FileIndex of a directory, built on first use and refreshed when the directory changes
+    key = (os.path.abspath(directory), recursive)
+    index = _file_indices.get(key)
+    if index is None:
+        index = FileIndex(directory, recursive=recursive)
+        _file_indices[key] = index
+    else:
+        index.refresh()
+    return index
+
 
 def get_df_files(folder: Path | str) -> pd.DataFrame:
     files = []
@@ -25,8 +99,7 @@ def replace_extension(file: Path | str, ext_in, ext_out) -> str:
 def match_stem_caseinsensitive(
     filename: str | Path, search_path: str | Path, searched_extension: str, return_full_path: bool=False
 ) -> str:
-    pattern = re.compile(re.escape(Path(filename).stem + f"{searched_extension}"), re.IGNORECASE)
-    files = [f for f in Path(search_path).rglob("*") if pattern.match(f.name)]
+    files = file_index(search_path, recursive=True).find_stem(Path(filename).stem, searched_extension)
     assert len(files) <= 1
     if len(files) == 0:
         return ""
@@ -37,10 +110,19 @@ def match_stem_caseinsensitive(
 
 
 def match_stem_caseinsensitive_lists(matching: list[str], input: list[str]):
+    # Items of input starting with each item of matching (case-insensitive), 
+    # found by bisection in the sorted lower-cased input, in input order
+    lowered = sorted((fi.lower(), i) for i, fi in enumerate(input))
+    keys = [key for key, _ in lowered]
     matched = []
     for mi in matching:
-        pattern = re.compile(re.escape(mi), re.IGNORECASE)
-        matched += [fi for fi in input if pattern.match(fi)]
+        prefix = mi.lower()
+        positions = []
+        for j in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[j].startswith(prefix):
+                break
+            positions.append(lowered[j][1])
+        matched += [input[i] for i in sorted(positions)]
     return matched
 
 
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped reader for SBE 911plus .hex files.
+
+The header is read up to the '*END*' line and the scans are addressed by
+position in the memory map: all scan lines have the same length, so scan i
+starts at data_offset + i * line_length and any range of scans (or time
+range, at 24 scans per second) is decoded without reading the rest of the
+file. The decoded bytes are viewed as a NumPy structured array with one
+field per word of the scan layout from the XMLCON file (frequencies,
+voltages, NMEA data, status word and scan time).
+"""
+import os
+import mmap
+import xml.etree.ElementTree as elementTree
+import numpy as np
+
+from scripts.filename_matching import file_index
+
+# SBE 911plus scan rate (Hz)
+SCAN_RATE = 24
+FREQUENCY_CHANNELS = 5
+VOLTAGE_CHANNELS = 8
+# Epochs of the NMEA time (seconds since 2000) and scan time (seconds since 1970)
+NMEA_EPOCH = np.datetime64('2000-01-01T00:00:00', 's')
+SCAN_TIME_EPOCH = np.datetime64('1970-01-01T00:00:00', 's')
+
+# Nibble value of each ASCII character, 255 for characters that are not hex
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+_HEX_VALUES[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+_HEX_VALUES[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+_HEX_VALUES[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+
+#%%
+def instrument_settings(xmlcon_file):
+    """
+    Parameters:
+        xmlcon_file: str
+    Returns:
+        dict
+        Instrument settings of an XMLCON file that define the scan layout
+        (e.g. 'NmeaPositionDataAdded'), as numbers where possible
+    """
+    instrument = elementTree.parse(xmlcon_file).getroot().find('./Instrument')
+    settings = {}
+    for child in instrument:
+        if len(child) == 0:
+            try:
+                settings[child.tag] = float(child.text)
+            except (TypeError, ValueError):
+                settings[child.tag] = child.text
+    return settings
+
+def scan_layout(settings):
+    """
+    Byte offsets of the words in a 911plus scan, from the XMLCON settings.
+
+    Parameters:
+        settings: dict
+            From instrument_settings
+    Returns:
+        dict
+        Offset of each word in the scan, None for words not in the scan
+    """
+    def added(key):
+        return int(settings.get(key) or 0) == 1
+    n_frequencies = FREQUENCY_CHANNELS - int(settings.get('FrequencyChannelsSuppressed') or 0)
+    n_voltages = VOLTAGE_CHANNELS - 2 * int(settings.get('VoltageWordsSuppressed') or 0)
+    layout = {'n_frequencies': n_frequencies, 'n_voltages': n_voltages,
+              'frequencies': 0, 'voltages': 3 * n_frequencies}
+    offset = layout['voltages'] + 3 * n_voltages // 2
+    for key, name, length in [('SurfaceParVoltageAdded', 'surface_par', 3),
+                              ('NmeaPositionDataAdded', 'nmea_position', 7),
+                              ('NmeaDepthDataAdded', 'nmea_depth', 3),
+                              ('NmeaTimeAdded', 'nmea_time', 4)]:
+        layout[name] = offset if added(key) else None
+        offset += length if added(key) else 0
+    # Pressure sensor temperature (12 bits), status (4 bits) and modulo count (8 bits)
+    layout['status'] = offset
+    offset += 3
+    layout['scan_time'] = offset if added('ScanTimeAdded') else None
+    offset += 4 if added('ScanTimeAdded') else 0
+    layout['scan_length'] = offset
+    return layout
+
+def scan_dtype(layout):
+    """
+    Parameters:
+        layout: dict
+            From scan_layout
+    Returns:
+        numpy.dtype
+        Structured dtype of a scan, one field per word in the layout
+    """
+    fields = {'frequencies': (np.dtype((np.uint8, (layout['n_frequencies'], 3))), layout['frequencies']),
+              'voltages': (np.dtype((np.uint8, (layout['n_voltages'] // 2, 3))), layout['voltages']),
+              'surface_par': (np.dtype((np.uint8, 3)), layout['surface_par']),
+              'nmea_position': (np.dtype((np.uint8, 7)), layout['nmea_position']),
+              'nmea_depth': (np.dtype((np.uint8, 3)), layout['nmea_depth']),
+              'nmea_time': (np.dtype('<u4'), layout['nmea_time']),
+              'status': (np.dtype((np.uint8, 3)), layout['status']),
+              'scan_time': (np.dtype('<u4'), layout['scan_time']),
+              }
+    fields = {name: item for name, item in fields.items() if item[1] is not None}
+    return np.dtype({'names': list(fields),
+                     'formats': [item[0] for item in fields.values()],
+                     'offsets': [item[1] for item in fields.values()],
+                     'itemsize': layout['scan_length']})
+
+#%%
+def frequencies(records):
+    """
+    Returns:
+        numpy.ndarray
+        Frequencies (Hz) of shape (scans, frequency channels), from 3 byte
+        words f = byte0 * 256 + byte1 + byte2 / 256
+    """
+    words = records['frequencies'].astype(np.float64)
+    return words[..., 0] * 256. + words[..., 1] + words[..., 2] / 256.
+
+def voltages(records):
+    """
+    Returns:
+        numpy.ndarray
+        Voltages of shape (scans, voltage channels), from 12 bit words
+        V = 5 * (1 - N / 4095), two channels per 3 bytes
+    """
+    words = records['voltages'].astype(np.uint16)
+    counts = np.empty((len(records), words.shape[1] * 2), dtype=np.uint16)
+    counts[:, 0::2] = (words[..., 0] << 4) | (words[..., 1] >> 4)
+    counts[:, 1::2] = ((words[..., 1] & 0x0F) << 8) | words[..., 2]
+    return 5. * (1. - counts / 4095.)
+
+def status_word(records):
+    """
+    Returns:
+        tuple
+        Pressure sensor temperature counts (12 bits), status bits (pump
+        status in bit 0, bottom contact in bit 1, water sampler confirm in
+        bit 2, modem carrier detect in bit 3) and modulo count
+    """
+    words = records['status'].astype(np.uint32)
+    word = (words[:, 0] << 16) | (words[:, 1] << 8) | words[:, 2]
+    return word >> 12, (word >> 8) & 0x0F, word & 0xFF
+
+def nmea_position(records):
+    """
+    Returns:
+        tuple
+        Latitude and longitude (decimal degrees, negative south and west)
+        appended to each scan
+    """
+    words = records['nmea_position'].astype(np.int64)
+    latitude = ((words[:, 0] << 16) | (words[:, 1] << 8) | words[:, 2]) / 50000.
+    longitude = ((words[:, 3] << 16) | (words[:, 4] << 8) | words[:, 5]) / 50000.
+    latitude[(words[:, 6] & 0x80) != 0] *= -1
+    longitude[(words[:, 6] & 0x40) != 0] *= -1
+    return latitude, longitude
+
+def nmea_time(records):
+    """
+    Returns:
+        numpy.ndarray
+        NMEA time appended to each scan (datetime64)
+    """
+    return NMEA_EPOCH + records['nmea_time'].astype('timedelta64[s]')
+
+def scan_time(records):
+    """
+    Returns:
+        numpy.ndarray
+        System time of each scan (datetime64)
+    """
+    return SCAN_TIME_EPOCH + records['scan_time'].astype('timedelta64[s]')
+
+#%%
+class HexFile:
+    """
+    Memory-mapped SBE 911plus .hex file with random access by scan index or
+    elapsed time.
+
+    Parameters:
+        path: str
+        xmlcon_file: str
+            XMLCON file of the cast, for the scan layout. The XMLCON file
+            with the same name as the .hex file is used if None
+    """
+
+    def __init__(self, path, xmlcon_file=None):
+        self.path = str(path)
+        self.xmlcon_file = xmlcon_file
+        self._layout = None
+        self._dtype = None
+        self._line_offsets = None
+        self._file = open(self.path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._size > 0 else b''
+
+        end = self._mm.find(b'*END*')
+        if end == -1:
+            self.close()
+            raise ValueError("No '*END*' line in the header of %s" % self.path)
+        self.data_offset = self._mm.find(b'\n', end) + 1 or self._size
+        self.header = self._mm[:self.data_offset].decode('latin-1').splitlines()
+
+        # The first scan line gives the line length of all scans
+        newline = self._mm.find(b'\n', self.data_offset)
+        if newline == -1:
+            self.line_length, self.scan_length, self.n_scans = 0, 0, 0
+            return
+        self.line_length = newline - self.data_offset + 1
+        text_length = self.line_length - 1
+        if text_length > 0 and self._mm[newline - 1:newline] == b'\r':
+            text_length -= 1
+        self.scan_length = text_length // 2
+        # A partly written last scan (file still being recorded) is left out
+        self.n_scans = (self._size - self.data_offset) // self.line_length
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.n_scans
+
+    @property
+    def layout(self):
+        """
+        Scan layout from the XMLCON file
+        """
+        if self._layout is None:
+            xmlcon_file = self.xmlcon_file
+            if xmlcon_file is None:
+                directory, name = os.path.split(os.path.abspath(self.path))
+                found = file_index(directory).find_stem(os.path.splitext(name)[0], '.xmlcon')
+                if len(found) == 0:
+                    raise FileNotFoundError("No XMLCON file found for %s, the scan layout is unknown." % self.path)
+                xmlcon_file = found[0]
+            layout = scan_layout(instrument_settings(xmlcon_file))
+            if self.n_scans > 0 and layout['scan_length'] != self.scan_length:
+                raise ValueError("Scans in %s are %s bytes, %s bytes expected from %s." %
+                                 (self.path, self.scan_length, layout['scan_length'], xmlcon_file))
+            self._layout = layout
+        return self._layout
+
+    @property
+    def dtype(self):
+        if self._dtype is None:
+            self._dtype = scan_dtype(self.layout)
+        return self._dtype
+
+    def _index_lines(self):
+        """
+        Index the start of each complete scan line, for files where the
+        lines are not all the same length
+        """
+        buf = np.frombuffer(self._mm, dtype=np.uint8, offset=self.data_offset)
+        newlines = np.flatnonzero(buf == ord('\n'))
+        starts = np.concatenate([[0], newlines[:-1] + 1])
+        text_lengths = newlines - starts
+        text_lengths -= (buf[np.maximum(newlines - 1, 0)] == ord('\r')) & (text_lengths > 0)
+        del buf
+        self._line_offsets = starts[text_lengths == 2 * self.scan_length] + self.data_offset
+        self.n_scans = len(self._line_offsets)
+
+    def _read_lines(self, start, stop):
+        """
+        Returns:
+            numpy.ndarray
+            uint8 array of the hex characters of scans start to stop, of
+            shape (scans, 2 * scan_length), or None if the lines are not at
+            the expected positions
+        """
+        if self._line_offsets is not None:
+            buf = np.frombuffer(self._mm, dtype=np.uint8)
+            rows = self._line_offsets[start:stop, None] + np.arange(2 * self.scan_length)
+            chars = buf[rows]
+            del buf
+            return chars
+        lines = np.frombuffer(self._mm, dtype=np.uint8, count=(stop - start) * self.line_length,
+                              offset=self.data_offset + start * self.line_length).reshape(-1, self.line_length)
+        try:
+            if not (lines[:, -1] == ord('\n')).all():
+                return None
+            return lines[:, :2 * self.scan_length].copy()
+        finally:
+            del lines
+
+    def scans(self, start=None, stop=None):
+        """
+        Decode a range of scans to bytes.
+
+        Parameters:
+            start: int
+            stop: int
+                Scan indices as for a slice, all scans if None
+        Returns:
+            numpy.ndarray
+            uint8 array of shape (scans, scan_length)
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_scans)
+        stop = max(start, stop)
+        if stop == start:
+            return np.empty((0, self.scan_length), dtype=np.uint8)
+        chars = self._read_lines(start, stop)
+        if chars is None:
+            self._index_lines()
+            start, stop, _ = slice(start, stop).indices(self.n_scans)
+            chars = self._read_lines(start, max(start, stop))
+        nibbles = _HEX_VALUES[chars]
+        if (nibbles == 255).any():
+            raise ValueError("Invalid hex characters in scans %s to %s of %s" % (start, stop, self.path))
+        return (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+
+    def records(self, start=None, stop=None):
+        """
+        Returns:
+            numpy.ndarray
+            Structured array of scans start to stop, with one field per word
+            of the scan layout
+        """
+        scans = self.scans(start, stop)
+        if len(scans) == 0:
+            return np.empty(0, dtype=self.dtype)
+        return scans.view(self.dtype)[:, 0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.records(key.start, key.stop)[::key.step]
+        index = range(self.n_scans)[key]
+        return self.records(index, index + 1)[0]
+
+    def scan_index(self, time):
+        """
+        Returns:
+            int
+            Index of the scan at an elapsed time (seconds) from the first scan
+        """
+        return int(round(time * SCAN_RATE))
+
+    def time_slice(self, start_time=None, stop_time=None):
+        """
+        Returns:
+            numpy.ndarray
+            Structured array of the scans between two elapsed times (seconds)
+        """
+        start = None if start_time is None else self.scan_index(start_time)
+        stop = None if stop_time is None else self.scan_index(stop_time)
+        return self.records(start, stop)
+
+def hex_scan_count(path):
+    """
+    Returns:
+        int
+        Number of complete scans in a .hex file, from the header and the file
+        size only
+    """
+    with HexFile(path) as hex_file:
+        return hex_file.n_scans
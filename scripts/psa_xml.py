@@ -135,6 +135,50 @@ def process_psa_file(psa_file: str) -> ET.Element:
     return root
 
 
+# Function to read a PSA file, or a PSA template without its mustache lines
+def read_psa(psa_file: str | Path) -> ET.Element:
+    with open(psa_file, "r", encoding="utf-8") as f:
+        lines = [line for line in f if not line.strip().startswith("{{")]
+    return ET.fromstringlist(lines)
+
+
+# Function to read the CalcArray of a DatCnv PSA file as (CalcID, ordinal, calculation settings),
+# with the latitude of the depth calculation
+def psa_calculations(psa_file: str | Path) -> tuple[List[tuple[int, int, Dict[str, str]]], float | None]:
+    root = read_psa(psa_file)
+    calcs = []
+    for item in root.findall("./CalcArray/CalcArrayItem"):
+        calc = item.find("Calc")
+        settings = {child.tag: child.get("value") for child in calc}  # type: ignore
+        calcs.append((int(item.get("CalcID")), int(calc.get("Ordinal", 0)), settings))  # type: ignore
+    latitude = root.find("./MiscellaneousDataForCalculations/Latitude")
+    return calcs, float(latitude.get("value")) if latitude is not None else None  # type: ignore
+
+
+def _psa_value(value: str | None) -> float | str | None:
+    try:
+        return float(value)  # type: ignore
+    except (TypeError, ValueError):
+        return value
+
+
+# Function to read the settings of a processing stage PSA file (e.g. Wild Edit, Filter, Cell Thermal Mass):
+# top level values as numbers where possible, nested settings (e.g. "Primary") as dicts and
+# arrays (e.g. "SelectArray", "FilterTypeArray") as lists. The CalcArray is read by psa_calculations
+def psa_settings(psa_file: str | Path) -> Dict[str, Any]:
+    settings: Dict[str, Any] = {}
+    for child in read_psa(psa_file):
+        if child.tag.endswith("CalcArray"):
+            continue
+        elif child.tag.endswith("Array"):
+            settings[child.tag] = [_psa_value(item.get("value")) for item in child.findall("ArrayItem")]
+        elif len(child) > 0:
+            settings[child.tag] = {item.tag: _psa_value(item.get("value")) for item in child}
+        else:
+            settings[child.tag] = _psa_value(child.get("value"))
+    return settings
+
+
 # Function to write the modified XML tree back to a file
 def write_psa_file(root: ET.Element, psa_file: str) -> None:
     ET.indent(root)
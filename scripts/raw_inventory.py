@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Inventory of the raw CTD files (xmlcon, bl, hex, hdr, cnv) and bottle files
+(btl) of a cruise.
+
+The raw and bottle directories are listed once from the (cached) file index
+of each directory and every file is classified by its extension in a single
+pass. A .bl file only counts as present if bottles were fired, which is
+checked from the file size and by reading at most BL_MIN_LINES lines. The
+entries are persisted in a small JSON file in the raw directory, keyed on
+file size and modification time, so unchanged .bl files are not read again
+between notebook runs and the files added or removed since the previous
+inventory are reported. The number of scans of each .hex file is taken from
+its header and size with hex_reader.HexFile, without decoding the scans.
+"""
+import os
+import json
+import pandas as pd
+
+from scripts.filename_matching import file_index
+from scripts.hex_reader import hex_scan_count
+
+INVENTORY_FILE = '.ctd_inventory.json'
+FILE_TYPES = ['.xmlcon', '.bl', '.hex', '.hdr', '.cnv', '.btl']
+# A .bl file has two header lines followed by one line per bottle fired
+BL_MIN_LINES = 3
+
+# In-memory cache of the persisted inventories, {raw directory: {filename: entry}}
+_inventories = {}
+
+#%%
+def bl_has_bottles(file, size=None):
+    """
+    Parameters:
+        file: str
+            Path to a .bl file
+        size: int
+            File size (bytes) if already known
+    Returns:
+        bool
+        True if the file has at least BL_MIN_LINES lines, i.e. at least one
+        bottle fired. Only the first lines are read.
+    """
+    if size is None:
+        size = os.path.getsize(file)
+    if size == 0:
+        return False
+    line_num = 0
+    with open(file, 'r', errors='replace') as f:
+        for _ in f:
+            line_num += 1
+            if line_num >= BL_MIN_LINES:
+                return True
+    return False
+
+#%%
+def _load_inventory(directory):
+    """
+    Load the persisted inventory of a raw directory into the memory cache
+
+    Parameters:
+        directory: str
+    Returns:
+        dict
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _inventories:
+        inventory = {}
+        inventory_file = os.path.join(directory, INVENTORY_FILE)
+        if os.path.exists(inventory_file):
+            try:
+                with open(inventory_file, 'r') as f:
+                    inventory = json.load(f)
+            except (OSError, ValueError):
+                inventory = {}
+        _inventories[directory] = inventory
+    return _inventories[directory]
+
+def _save_inventory(directory, inventory):
+    """
+    Write the inventory of a raw directory to disk. Read-only directories are
+    skipped silently, the inventory then only lives for the current session.
+
+    Parameters:
+        directory: str
+        inventory: dict
+    """
+    directory = os.path.abspath(directory)
+    _inventories[directory] = inventory
+    try:
+        with open(os.path.join(directory, INVENTORY_FILE), 'w') as f:
+            json.dump(inventory, f)
+    except OSError:
+        pass
+
+#%%
+def build_inventory(rawFileDirectory, bottleFileDirectory, persist=True):
+    """
+    List the raw and bottle directories and check the .bl files that are new
+    or have changed since the previous inventory.
+
+    Parameters:
+        rawFileDirectory: str
+        bottleFileDirectory: str
+        persist: bool
+            Keep the inventory in the raw directory for the next notebook run
+    Returns:
+        dict
+        files: pandas.DataFrame
+            One row per file in directory order (raw directory first) with
+            the file name, path, stem and lower-cased extension, whether
+            a .bl file has bottles fired (False for other files) and the
+            number of scans of a .hex file (None for other files)
+        added: list
+            Files added since the previous inventory
+        removed: list
+            Files removed since the previous inventory
+    """
+    raw_files = file_index(rawFileDirectory).files
+    bottle_dir_files = file_index(bottleFileDirectory).files
+    previous = _load_inventory(rawFileDirectory)
+
+    inventory = {}
+    rows = []
+    for directory, fis in [('raw', raw_files), ('bottle', bottle_dir_files)]:
+        for fi in fis:
+            if fi.name == INVENTORY_FILE:
+                continue
+            suffix = fi.suffix.lower()
+            key = '%s/%s' % (directory, fi.name)
+            entry = [None, None, None]
+            # .bl bottles fired and .hex scan counts, for new or changed files only
+            if suffix in ('.bl', '.hex'):
+                stat = os.stat(fi)
+                entry = [stat.st_size, stat.st_mtime_ns, None]
+                cached = previous.get(key)
+                if cached is not None and cached[:2] == entry[:2]:
+                    entry[2] = cached[2]
+                elif suffix == '.bl':
+                    entry[2] = bl_has_bottles(fi, size=stat.st_size)
+                else:
+                    try:
+                        entry[2] = hex_scan_count(fi)
+                    except ValueError:
+                        entry[2] = 0
+            inventory[key] = entry
+            rows.append((directory, fi.name, fi.as_posix(), fi.stem, suffix,
+                         entry[2] is True, entry[2] if suffix == '.hex' else None))
+
+    added, removed = [], []
+    if previous:
+        added = [key.split('/', 1)[1] for key in inventory if key not in previous]
+        removed = [key.split('/', 1)[1] for key in previous if key not in inventory]
+    if persist and inventory != previous:
+        _save_inventory(rawFileDirectory, inventory)
+
+    files = pd.DataFrame(rows, columns=['directory', 'name', 'path', 'stem', 'suffix', 'bl_bottles', 'scans'])
+    files['scans'] = files['scans'].astype('Int64')
+    return {'files': files, 'added': added, 'removed': removed}
+
+def processing_files(files):
+    """
+    Parameters:
+        files: pandas.DataFrame
+            Files of build_inventory
+    Returns:
+        pandas.DataFrame
+        Files of the FILE_TYPES used for processing ordered by type (in the
+        FILE_TYPES order), then directory order. .bl files without bottles
+        fired are left out
+    """
+    order = files['suffix'].map({ft: i for i, ft in enumerate(FILE_TYPES)})
+    keep = order.notna() & ((files['suffix'] != '.bl') | files['bl_bottles'])
+    return files[keep].assign(order=order[keep]).sort_values('order', kind='stable').drop(columns='order')
+
+def presence_matrix(files):
+    """
+    Parameters:
+        files: pandas.DataFrame
+            Files of processing_files
+    Returns:
+        pandas.DataFrame
+        Casts (lower-cased file stem) by file type (extension without the
+        point), 1 if the cast has a file of the type and 0 otherwise
+    """
+    cast = files['name'].str.lower().str.rsplit('.', n=1).str[0].rename('cast')
+    file_type = files['suffix'].str[1:].rename('file_type')
+    return pd.crosstab(cast, file_type).clip(upper=1)
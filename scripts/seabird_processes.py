@@ -5,9 +5,34 @@ Created on Tue Mar 26 09:35:40 2024
 @author: dosullivan1
 """
 
+import os
+import math
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import math
+from scipy import signal
+import seawater
+
+import scripts.psa_xml as psa_xml
+
+# Scan rate of the SBE 911plus (Hz), for frames without an elapsed time column
+SCAN_RATE = 24
+# Conductivity at S=35, T=15, P=0 (mS/cm)
+C3515 = 42.914
+# Location of the SBE Data Processing PSA templates
+PSA_TEMPLATE_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'psa_templates')
+# Cell Thermal Mass: (conductivity sensor ordinal, salinity column) of the PSA sections, 
+# the temperature sensor ordinal is the TempSensor value of the section
+CELLTM_SECTIONS = {'Primary': (0, 'sal00'), 'Secondary': (1, 'sal11')}
+# Conductivity units of the CNV column names, in S/m
+CONDUCTIVITY_UNITS = {'S/m': 1., 'mS/cm': 0.1, 'uS/cm': 1e-4}
+# Units of the binning z-coordinates, used in the binned cruise data file names
+BIN_UNITS = {'depSM': 'metre', 'prDM': 'decibar'}
+# Casts of the binned data file names
+BIN_CASTS = {'D': 'downcast', 'U': 'upcast'}
+# Per bin statistics of the binned channels, output as '{channel}_{statistic}'
+BIN_STATISTICS = ['count', 'std', 'min', 'max', 'median']
 
 #%% 
 def heave_flagging(df, vel, window):
@@ -20,8 +45,10 @@ def heave_flagging(df, vel, window):
        threshold for each entrainment/heave feature.
     
     Parameters:
-        df: pandas.DataFrame
-        
+        df: pandas.DataFrame | iterable of pandas.DataFrame
+            Profile data. If an iterable of profile frames is provided 
+            (e.g. from data_processing.iter_cnv_profiles) a generator of 
+            flagged profile frames is returned.
         vel: int
             velocity threshold value, any down cast rows will be flagged as heave entrainment
         window: int
@@ -29,22 +56,32 @@ def heave_flagging(df, vel, window):
             
     Returns:
         pandas.DataFrame
-        With 
+        With the pressure QC flags in 'prDM_QC', as strings or as int8 for 
+        compact frames (categorical cast column, see data_processing.compact_dtypes)
         
     """
+    # Flag profile frames from a generator lazily, one at a time
+    if not isinstance(df, pd.DataFrame):
+        return (heave_flagging(frame, vel, window) for frame in df)
+    
     dfo = df.copy(deep=True)
-    dfo['prDM_QC'] = '0' # Set all to 0
+    # Keep the flags compact for compact frames
+    if isinstance(dfo['cast'].dtype, pd.CategoricalDtype):
+        no_flag, good_flag, bad_flag = np.int8(0), np.int8(1), np.int8(4)
+    else:
+        no_flag, good_flag, bad_flag = '0', '1', '4'
+    dfo['prDM_QC'] = no_flag # Set all to 0
     # Calculate the velocity of the CTD using pressure and time
     dfo['CTDvel'] = dfo['prDM'].diff(1)/dfo['timeS'].diff(1)
     # Identify down cast data with a velocity below the user defined velocity 
     # threshold and set the pressure QC flag as 4 ()
     mask = (dfo['CTDvel']<vel) & (dfo['cast']=='D')
-    dfo.loc[mask,'prDM_QC']='4'
+    dfo.loc[mask,'prDM_QC']=bad_flag
     
     # Identify downcast rows where veolcity is above the user defined velocity
     # threshold and set the pressure QC flag as 1
     good_mask = (dfo['CTDvel']>=vel) & (dfo['cast']=='D')
-    dfo.loc[good_mask,'prDM_QC']='1'
+    dfo.loc[good_mask,'prDM_QC']=good_flag
     
 
     dfo['id'] = dfo['prDM_QC'].astype(int).diff()
@@ -56,7 +93,7 @@ def heave_flagging(df, vel, window):
     for item in pre_list:
         for i in range(0,window):
             window1_mask.append(item-window+i)
-    dfo.loc[window1_mask,'prDM_QC']='4'
+    dfo.loc[dfo.index.intersection(window1_mask),'prDM_QC']=bad_flag
     
     # Find the rows 
     post_list = dfo[dfo['id']==-3].index
@@ -64,19 +101,83 @@ def heave_flagging(df, vel, window):
     for item in post_list:
         for i in range(0,window):
             window2_mask.append(item+i)
-    dfo.loc[window2_mask,'prDM_QC']='4'
+    dfo.loc[dfo.index.intersection(window2_mask),'prDM_QC']=bad_flag
     
     return dfo
 
+#%%
+def loop_edit(df, min_velocity=0.25, window=0, profile_id='profile', pressure='prDM', time='timeS'):
+    """
+    Loop Edit of the down casts, vectorised per profile. Down-cast rows are
+    flagged bad where:
+    1) the pressure is below the running maximum pressure of the down cast
+       (pressure reversals, until the CTD is deeper than before the loop),
+    2) the velocity is below the minimum velocity (slowdowns),
+    3) within window rows before or after a bad row.
+    As for SBE Loop Edit, pressure noise at 24 Hz should be removed first 
+    with a low-pass filter of the pressure (filter_channels).
+
+    Parameters:
+        df: pandas.DataFrame | iterable of pandas.DataFrame
+            Profile data with the 'cast' column of data_processing.start_dcast.
+            If an iterable of profile frames is provided a generator of
+            flagged profile frames is returned.
+        min_velocity: float
+            Minimum down-cast velocity (dbar/s)
+        window: int
+            Number of rows flagged before and after each bad row
+        profile_id: str
+            Name of column containing the profile name
+        pressure: str
+            Name of the pressure column
+        time: str
+            Name of the elapsed time column
+
+    Returns:
+        pandas.DataFrame
+        With the velocity in 'CTDvel' and the pressure QC flags in 'prDM_QC'
+        as int8: 1 for good and 4 for bad down-cast rows, 0 for other rows
+    """
+    # Flag profile frames from a generator lazily, one at a time
+    if not isinstance(df, pd.DataFrame):
+        return (loop_edit(frame, min_velocity=min_velocity, window=window, profile_id=profile_id,
+                          pressure=pressure, time=time) for frame in df)
+
+    dfo = df.copy(deep=True)
+    p = dfo[pressure].to_numpy(dtype=np.float64)
+    t = dfo[time].to_numpy(dtype=np.float64)
+    downcast = (dfo['cast'] == 'D').to_numpy()
+    velocity = np.full(len(dfo), np.nan)
+    flags = np.zeros(len(dfo), dtype=np.int8)
+
+    for rows in dfo.groupby(profile_id, sort=False, observed=True).indices.values():
+        with np.errstate(invalid='ignore', divide='ignore'):
+            velocity[rows[1:]] = np.diff(p[rows]) / np.diff(t[rows])
+        rows = rows[downcast[rows]]
+        if len(rows) == 0:
+            continue
+        p_down = p[rows]
+        with np.errstate(invalid='ignore'):
+            bad = (p_down < np.fmax.accumulate(p_down)) | (velocity[rows] < min_velocity)
+        if window > 0:
+            bad = np.convolve(bad, np.ones(2 * window + 1), mode='same') > 0
+        flags[rows] = np.where(bad, 4, 1)
+
+    dfo['CTDvel'] = velocity
+    dfo['prDM_QC'] = flags
+    return dfo
+
 #%% 
-def bin_data(input_df, cast, zcord, profile_id, params_out, bin_width=1.):
+def bin_data(input_df, cast, zcord, profile_id, params_out, bin_width=1., specs=None, output_directory=None,
+             statistics=None, empty_bins=True):
     """
     Function to bin data based on heave flags in the pressure channel.
     Data are binned between +/-0.5 of the zcord using numeric mean.
 
     Parameters: 
-        input_df: pandas.DataFrame
-            Profile data at 2Hz
+        input_df: pandas.DataFrame | iterable of pandas.DataFrame
+            Profile data at 2Hz. Profile frames from a generator are binned
+            one at a time and combined.
         cast: str
             'D' or 'U' to specify if data should be subsetted for heave 
             entrainment on the downcast or upcast
@@ -94,31 +195,785 @@ def bin_data(input_df, cast, zcord, profile_id, params_out, bin_width=1.):
             
         params_out: list
             Parameters to output, based on the column names in the screen 2Hz
-            dataframe
+            dataframe. 'nbin' adds the number of scans in each bin
+
+        specs: list
+            (zcord, bin_width, cast) of each binned product, e.g. 
+            [('prDM', 1., 'D'), ('depSM', 0.5, 'D')]. All products are binned
+            from one pass over the input, cast, zcord and bin_width are 
+            ignored. See bin_products
+            
+        output_directory: str
+            With specs, directory the binned products are written to
+
+        statistics: list
+            Statistics of BIN_STATISTICS to add for each output parameter,
+            as '{parameter}_{statistic}' columns after params_out, e.g. 
+            ['count', 'std'] for the number of values in each bin and their 
+            standard deviation
+
+        empty_bins: bool
+            Keep the empty bins of each profile, down to the deepest bin of 
+            the cast, with NaN values, as the pandas.cut and groupby 
+            (observed=False) binning with pandas 2.2.2 of requirements.txt.
+            False for the bins with data only (the groupby default from 
+            pandas 3)
         
     Returns:
         pandas.DataFrame
+        Or with specs a dict of the binned products, see bin_products
     """
+    if specs is not None:
+        return bin_products(input_df, specs, profile_id, params_out, output_directory=output_directory,
+                            statistics=statistics, empty_bins=empty_bins)
+
+    # Bin profile frames from a generator one at a time
+    if not isinstance(input_df, pd.DataFrame):
+        binned = [bin_data(frame, cast, zcord, profile_id, params_out, bin_width=bin_width, statistics=statistics,
+                           empty_bins=empty_bins)
+                  for frame in input_df]
+        binned = [frame for frame in binned if not frame.empty]
+        if len(binned) == 0:
+            return pd.DataFrame(columns=params_out)
+        return pd.concat(binned).sort_values(by=[profile_id, zcord], kind='stable').reset_index(drop=True)
+    
+    columns = [col for col in params_out if col not in (profile_id, zcord, 'nbin')]
     # For data not flagged suspect due to heave entrainment subset for cast specified and copy to working table
-    bin_df = input_df[(input_df['cast']==cast) & (input_df['prDM_QC']!=4)].copy(deep=True)
+    bin_df = input_df.loc[(input_df['cast']==cast).to_numpy() & ~_heave_flagged(input_df['prDM_QC']),
+                          [profile_id, zcord] + [col for col in columns if col in input_df.columns]]
+    if bin_df.empty:
+        return pd.DataFrame(columns=params_out)
 
-    # Set the z-coordinate column for binning as 'bin'
-    # changed for more flexibility, same result for now
-    # bin_df['bin'] = bin_df[zcord]+0.5
-    # bin_df['bin'] = bin_df['bin'].round(0)
-    bins = list(np.arange(0, math.ceil(bin_df[zcord].max())+bin_width, bin_width))
-    bin_labels = [bi for bi in bins][1:]
-    bin_df["bin"] = pd.cut(bin_df[zcord], bins=bins, labels=bin_labels, right=False)
+    bin_df = bin_average(bin_df, zcord, profile_id, columns, bin_width=bin_width, statistics=statistics,
+                         empty_bins=empty_bins)
 
-    # Combine the profile_id and z-cord in a list to set the groupby columns 
-    # for the binning command then group by the mean for each bin
-    gby = [profile_id,'bin']
+    return _binned_output(bin_df, params_out, statistics)
 
-    bin_df = bin_df.groupby(gby).mean(numeric_only=True).sort_values(by=gby).reset_index(inplace=False)
-    
-    bin_df = bin_df.drop(columns=[zcord]).rename(columns={'bin': zcord})
-    
-    bin_df = bin_df[params_out].rename(columns={'bin': zcord})
-    bin_df = bin_df.dropna(subset=bin_df.columns.difference(["CTD number", "depSM"]), how="all")
+def _heave_flagged(flags):
+    """
+    Returns:
+        numpy.ndarray
+        True for the scans flagged 4 for heave entrainment. The flags are 
+        strings when the heave screened data has not been round-tripped 
+        through csv, missing flags are not flagged
+    """
+    return pd.to_numeric(flags).fillna(0).astype('Int8').to_numpy(dtype=np.int8) == 4
+
+def _binned_output(bin_df, params_out, statistics=None):
+    """
+    Select the output parameters (and their statistics) of binned data and 
+    drop empty bins
+    """
+    columns = params_out + [f'{col}_{statistic}' for col in params_out for statistic in (statistics or [])
+                            if f'{col}_{statistic}' in bin_df.columns]
+    bin_df = bin_df[columns]
+    bin_df = bin_df.dropna(subset=pd.Index(params_out).difference(["CTD number", "depSM", "nbin"]), how="all")
     return bin_df
 
+#%%
+def bin_average(df, zcord, profile_id, columns, bin_width=1., statistics=None, empty_bins=True):
+    """
+    Bin average engine of bin_data. The bins are [z, z + bin_width) from 0 to
+    the maximum of zcord, labelled with the bin top edge, the same bins 
+    and labels as pandas.cut(right=False) on the bin edges 
+    numpy.arange(0, ceil(max) + bin_width, bin_width). The bin index of each
+    row is found with numpy.floor and the columns are averaged over each
+    profile and bin with numpy.bincount, ignoring NaN values.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data
+        zcord: str
+            Name of the z-coordinate column to bin on
+        profile_id: str
+            Name of column containing the profile name
+        columns: list
+            Numeric columns to average
+        bin_width: int | float
+            The width of the bins.
+        statistics: list
+            Statistics of BIN_STATISTICS of each column, in the same pass:
+            count (values that are not NaN), std (sample standard deviation,
+            NaN for a single value), min, max and median
+        empty_bins: bool
+            Keep the empty bins of each profile, see bin_data
+    Returns:
+        pandas.DataFrame
+        One row per profile and bin (with data, unless empty_bins), sorted
+        by profile and bin, 
+        with the profile, the bin label in zcord (categorical), the mean of
+        the columns, the number of scans in the bin in 'nbin' and the 
+        statistics as '{column}_{statistic}'
+    """
+    columns = [col for col in columns if col in df.columns and pd.api.types.is_numeric_dtype(df[col])]
+    profile_codes, profiles = _profile_codes(df[profile_id])
+    values = {col: (df[col].to_numpy(dtype=np.float64), df[col].dtype) for col in columns}
+    return _bin_means(df[zcord].to_numpy(dtype=np.float64), profile_codes, profiles, values,
+                      zcord, profile_id, bin_width, statistics=statistics, empty_bins=empty_bins)
+
+def _profile_codes(profile):
+    """
+    Categorical profile names (compact frames) are grouped over the profiles
+    present only, in category order, string profile names in sorted order
+
+    Returns:
+        tuple
+        Profile code of each row (-1 for missing names) and the profile names
+    """
+    if isinstance(profile.dtype, pd.CategoricalDtype):
+        codes = profile.cat.codes.to_numpy()
+        used = np.bincount(codes[codes >= 0], minlength=len(profile.cat.categories)) > 0
+        profile_codes = np.where(codes >= 0, np.cumsum(used)[codes] - 1, -1)
+        profiles = pd.Categorical.from_codes(np.arange(used.sum()), dtype=pd.CategoricalDtype(
+            profile.cat.categories[used], ordered=profile.cat.ordered))
+        return profile_codes, profiles
+    return pd.factorize(profile, sort=True)
+
+def _bin_means(z, profile_codes, profiles, values, zcord, profile_id, bin_width, statistics=None, empty_bins=True):
+    """
+    Bin averages of the values of each profile, see bin_average
+
+    Parameters:
+        z: numpy.ndarray
+        profile_codes: numpy.ndarray
+        profiles: array-like
+            Profile codes and names of _profile_codes
+        values: dict
+            {column: (float64 array, column dtype)}
+        statistics: list
+        empty_bins: bool
+    Returns:
+        pandas.DataFrame
+    """
+    # No bins without z-coordinate values from 0 (e.g. all NaN)
+    with np.errstate(invalid='ignore'):
+        top = z[z >= 0].max() if (z >= 0).any() else 0
+    edges = np.arange(0, max(math.ceil(top), bin_width) + bin_width, bin_width)
+
+    # Bin index from floor, corrected by one bin where rounding puts a value
+    # on the wrong side of an edge
+    # (the edges of numpy.arange from 0 are exactly index * bin_width)
+    with np.errstate(invalid='ignore'):
+        index = np.floor(z / bin_width)
+        valid = (z >= 0) & (z < edges[-1]) & (profile_codes >= 0)
+    index = np.clip(np.nan_to_num(index), 0, len(edges) - 2).astype(np.int64)
+    index -= z < index * bin_width
+    index += z >= (index + 1) * bin_width
+
+    # Rows are counted and summed into one slot per profile and bin with 
+    # numpy.bincount, the occupied slots are in profile and bin order
+    n_bins = len(edges) - 1
+    key = profile_codes[valid].astype(np.int64) * n_bins + index[valid]
+    n_slots = len(profiles) * n_bins
+    nbin = np.bincount(key, minlength=n_slots)
+    slots = np.flatnonzero(nbin)
+
+    statistics = statistics or []
+    if statistics:
+        # Output row of each input row, and the rows sorted by bin for the
+        # order statistics (reduceat over the bins)
+        row_slot = (np.cumsum(nbin > 0) - 1)[key]
+        if {'min', 'max', 'median'} & set(statistics):
+            order = np.argsort(key, kind='stable')
+            starts = np.cumsum(nbin[slots]) - nbin[slots]
+
+    out = pd.DataFrame({profile_id: profiles.take(slots // n_bins),
+                        zcord: pd.Categorical.from_codes(slots % n_bins, categories=edges[1:], ordered=True)})
+    stats = {}
+    for col, (column_values, dtype) in values.items():
+        dtype = dtype if dtype == np.float32 else np.float64
+        column_values = column_values[valid]
+        present = ~np.isnan(column_values)
+        sums = np.bincount(key[present], weights=column_values[present], minlength=n_slots)[slots]
+        counts = np.bincount(key[present], minlength=n_slots)[slots]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums / counts
+        out[col] = mean.astype(dtype, copy=False)
+
+        if 'count' in statistics:
+            stats[f'{col}_count'] = counts
+        if 'std' in statistics:
+            deviation = (column_values - mean[row_slot])[present]
+            squares = np.bincount(key[present], weights=deviation * deviation, minlength=n_slots)[slots]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+            stats[f'{col}_std'] = std.astype(dtype, copy=False)
+        if 'min' in statistics and len(slots):
+            stats[f'{col}_min'] = np.fmin.reduceat(column_values[order], starts).astype(dtype, copy=False)
+        if 'max' in statistics and len(slots):
+            stats[f'{col}_max'] = np.fmax.reduceat(column_values[order], starts).astype(dtype, copy=False)
+        if 'median' in statistics and len(slots):
+            # Values sorted within each bin, NaN last
+            ordered = column_values[np.lexsort((column_values, key))]
+            lower = starts + np.maximum(counts - 1, 0) // 2
+            upper = starts + counts // 2
+            median = np.where(counts > 0, (ordered[lower] + ordered[np.minimum(upper, len(ordered) - 1)]) / 2, np.nan)
+            stats[f'{col}_median'] = median.astype(dtype, copy=False)
+    out['nbin'] = nbin[slots]
+    if stats:
+        out = pd.concat([out, pd.DataFrame(stats)], axis=1)
+
+    if empty_bins and 0 < len(slots) < n_slots:
+        # All the bins of each profile, the empty bins with NaN values and no
+        # scans (the groupby of the categorical bins with observed=False)
+        counts = ['nbin'] + [col for col in stats if col.endswith('_count')]
+        out = out.set_axis(slots).reindex(np.arange(n_slots)).reset_index(drop=True)
+        out[profile_id] = profiles.take(np.arange(n_slots) // n_bins)
+        out[zcord] = pd.Categorical.from_codes(np.arange(n_slots) % n_bins, categories=edges[1:], ordered=True)
+        out[counts] = out[counts].fillna(0).astype(np.int64)
+    return out
+
+def binning_info(zcord, bin_width, cast=None):
+    """
+    Returns:
+        str
+        Width and unit of binned data as used in the binned cruise data file
+        names, e.g. '1_0decibar' for 1 dbar bins, with the cast if given, 
+        e.g. '1_0decibar_upcast' for the upcast
+    """
+    info = f"{str(bin_width).replace('.', '_')}{BIN_UNITS[zcord]}"
+    return info if cast is None else f"{info}_{BIN_CASTS[cast]}"
+
+def oxygen_units(df_binned):
+    """
+    Convert oxygen values from umol/l to ml/l and umol/kg
+
+    Parameters:
+        df_binned: pandas.DataFrame
+            Binned data with the oxygen (sbeox0Mm/L, sbeox1Mm/L) and density
+            (sigma-theta00, sigma-theta11) columns
+    Returns:
+        pandas.DataFrame
+    """
+    if 'sbeox0Mm/L' in df_binned.columns:
+        df_binned['sbeox0Mm/kg'] = df_binned['sbeox0Mm/L']/((df_binned['sigma-theta00']+1000)/1000)
+        df_binned['sbeox0ml/l'] = df_binned['sbeox0Mm/L']/44.66
+    if 'sbeox1Mm/L' in df_binned.columns:
+        df_binned['sbeox1Mm/kg'] = df_binned['sbeox1Mm/L']/((df_binned['sigma-theta11']+1000)/1000)
+        df_binned['sbeox1ml/l'] = df_binned['sbeox1Mm/L']/44.66
+    return df_binned
+
+def bin_products(input_df, specs, profile_id, params_out, output_directory=None, statistics=None, empty_bins=True):
+    """
+    Bin the data to several widths, z-coordinates and casts in one pass: the
+    heave flags, the profile names and the columns are prepared once for 
+    each cast and shared by the products of the cast. The oxygen values of
+    each product are converted with oxygen_units.
+
+    Parameters:
+        input_df: pandas.DataFrame | iterable of pandas.DataFrame
+            Profile data at 2Hz, profile frames from a generator are combined
+        specs: list
+            (zcord, bin_width, cast) of each product, see bin_data
+        profile_id: str
+            Name of column containing the profile name
+        params_out: list
+            Parameters to output, see bin_data
+        output_directory: str
+            Directory to write each product to, as 
+            cruise_data_uncal_{binning_info}binned.csv. The first product of
+            a z-coordinate and width is named without its cast, the others
+            of the same z-coordinate and width with their cast (see 
+            binning_info)
+        statistics: list
+            Per bin statistics, see bin_data
+        empty_bins: bool
+            Keep the empty bins of each profile, see bin_data
+    Returns:
+        dict
+        {binning_info: pandas.DataFrame} in the order of specs
+    """
+    specs = [tuple(spec) for spec in specs]
+    if len(set(specs)) < len(specs):
+        raise ValueError("Binned products with the same z-coordinate, width and cast would be written to the same file: %s" % specs)
+    keys = {}
+    for zcord, bin_width, cast in specs:
+        key = binning_info(zcord, bin_width)
+        keys[(zcord, bin_width, cast)] = key if key not in keys.values() else binning_info(zcord, bin_width, cast)
+    if not isinstance(input_df, pd.DataFrame):
+        input_df = pd.concat(list(input_df), ignore_index=True)
+
+    good = ~_heave_flagged(input_df['prDM_QC'])
+    columns = [col for col in params_out if col not in (profile_id, 'nbin') and col in input_df.columns
+               and pd.api.types.is_numeric_dtype(input_df[col])]
+    products = {}
+    for cast in dict.fromkeys(spec[2] for spec in specs):
+        rows = good & (input_df['cast'] == cast).to_numpy()
+        profile_codes, profiles = _profile_codes(input_df[profile_id][rows])
+        zcords = [zcord for zcord, _, spec_cast in specs if spec_cast == cast]
+        values = {col: (input_df[col].to_numpy(dtype=np.float64)[rows], input_df[col].dtype)
+                  for col in dict.fromkeys(columns + zcords)}
+        for zcord, bin_width, spec_cast in specs:
+            if spec_cast != cast:
+                continue
+            if not rows.any():
+                binned = pd.DataFrame(columns=params_out)
+            else:
+                binned = _bin_means(values[zcord][0], profile_codes, profiles,
+                                    {col: item for col, item in values.items() if col != zcord and col in columns},
+                                    zcord, profile_id, bin_width, statistics=statistics, empty_bins=empty_bins)
+                binned = _binned_output(binned, params_out, statistics)
+            products[keys[(zcord, bin_width, spec_cast)]] = oxygen_units(binned)
+
+    products = {key: products[key] for key in keys.values()}
+    if output_directory is not None:
+        for key, binned in products.items():
+            binned.to_csv(os.path.join(output_directory, f'cruise_data_uncal_{key}binned.csv'), index=False)
+    return products
+
+#%%
+def psa_channel_array(settings, array, cnv_columns, columns=None):
+    """
+    Map a per column array of a PSA file (e.g. 'SelectArray' of Wild Edit, 
+    'FilterTypeArray' of Filter), indexed by the column position in the 
+    input CNV file, to the CNV column names.
+
+    Parameters:
+        settings: dict
+            From psa_xml.psa_settings
+        array: str
+            Name of the array
+        cnv_columns: list
+            Column names in the order of the CNV file header, e.g. 
+            cnv_header.read_header(file)['columns']. Channels renamed in the
+            DataFrame (e.g. voltage channels by the sensor_dict of cnv2df) 
+            must be given with their new names
+        columns: list
+            Columns of the DataFrame the array is applied to. A channel with
+            a non-zero value that is not one of them raises a ValueError
+    Returns:
+        dict
+        {column: value} for the columns with a non-zero value
+    """
+    if cnv_columns is None:
+        raise ValueError("The column names of the CNV file header (cnv_header.read_header(file)['columns']) are "
+                         "required to map the %s of the PSA file to the channels." % array)
+    values = settings.get(array, [])
+    selected = {col: value for col, value in zip(cnv_columns, values) if value != 0}
+    if columns is not None:
+        missing = [col for col in selected if col not in columns]
+        if len(missing) > 0:
+            raise ValueError("Channels %s selected in the %s of the PSA file are not in the data, rename them in "
+                             "cnv_columns or give the channels explicitly." % (missing, array))
+    return selected
+
+def apply_per_profile(df, function, profile_id='profile', workers=None):
+    """
+    Apply a processing stage to each profile of a DataFrame. Profiles are 
+    independent, so they can be processed in parallel.
+
+    Parameters:
+        df: pandas.DataFrame
+            One or more profiles. A frame without the profile_id column is 
+            processed as a single profile
+        function: callable
+            Takes and returns the DataFrame of one profile. Must be picklable
+            (e.g. a functools.partial of a module level function) for workers
+        profile_id: str
+        workers: int | None
+            Number of processes used. None or 1 processes the profiles
+            sequentially in the current process.
+    Returns:
+        pandas.DataFrame
+        Processed profiles, in the order of the input rows
+    """
+    if profile_id not in df.columns or df.empty:
+        return function(df)
+    profiles = [group for _, group in df.groupby(profile_id, sort=False, observed=True)]
+    if workers is not None and workers > 1 and len(profiles) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            processed = list(executor.map(function, profiles))
+    else:
+        processed = [function(group) for group in profiles]
+    out = pd.concat(processed)
+    if df.index.is_unique:
+        out = out.reindex(df.index)
+    return out
+
+#%%
+def _block_statistics(blocks):
+    """
+    Mean and standard deviation of each block and channel, ignoring NaN
+
+    Parameters:
+        blocks: numpy.ndarray
+            Array of shape (blocks, scans per block, channels)
+    Returns:
+        tuple
+        Arrays of shape (blocks, 1, channels)
+    """
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, blocks, 0.).sum(axis=1, keepdims=True) / count
+        deviation = np.where(valid, blocks - mean, 0.)
+        std = np.sqrt((deviation * deviation).sum(axis=1, keepdims=True) / (count - 1))
+    return mean, std
+
+def _wildedit_profile(df, channels, std_pass_one, std_pass_two, scans_per_block, min_delta):
+    """
+    Wild Edit of the channels of a single profile, see wildedit
+    """
+    out = df.copy()
+    if len(out) == 0 or len(channels) == 0:
+        return out
+    values = out[channels].to_numpy(dtype=np.float64, copy=True)
+    n_scans, n_channels = values.shape
+    n_blocks = math.ceil(n_scans / scans_per_block)
+    blocks = np.full((n_blocks * scans_per_block, n_channels), np.nan)
+    blocks[:n_scans] = values
+    blocks = blocks.reshape(n_blocks, scans_per_block, n_channels)
+
+    # Pass one: statistics without the points outside std_pass_one standard deviations
+    mean, std = _block_statistics(blocks)
+    with np.errstate(invalid='ignore'):
+        kept = np.where(np.abs(blocks - mean) <= std_pass_one * std, blocks, np.nan)
+    # Pass two: points outside std_pass_two standard deviations of the 
+    # pass one statistics (and more than min_delta from the mean) are bad
+    mean, std = _block_statistics(kept)
+    with np.errstate(invalid='ignore'):
+        deviation = np.abs(blocks - mean)
+        bad = (deviation > std_pass_two * std) & (deviation > min_delta)
+    blocks[bad] = np.nan
+
+    edited = blocks.reshape(-1, n_channels)[:n_scans]
+    # Keep the column types (float32 for compact frames)
+    for i, col in enumerate(channels):
+        out[col] = edited[:, i].astype(out[col].dtype, copy=False)
+    return out
+
+def wildedit(df, psa_file=None, channels=None, cnv_columns=None, std_pass_one=None, std_pass_two=None,
+             scans_per_block=None, min_delta=None, profile_id='profile', workers=None):
+    """
+    SBE Wild Edit: two pass outlier rejection over blocks of scans. For each
+    block and channel, the mean and standard deviation are calculated, then 
+    recalculated without the points more than std_pass_one standard 
+    deviations from the mean. Points more than std_pass_two standard 
+    deviations (and min_delta) from the second mean are set to NaN. Values 
+    that are already NaN (bad flagged) are excluded from the statistics.
+    The last block of a profile can be shorter than scans_per_block.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data at the full scan rate, e.g. from datcnv.datcnv or 
+            cnv2df. Profiles are edited independently
+        psa_file: str
+            Wild Edit PSA file for the parameters and the channels, the
+            MI_wildeditTemplate.psa template if None
+        channels: list
+            Channels to edit. By default the columns selected in the 
+            SelectArray of the PSA file
+        cnv_columns: list
+            Column names in the order of the CNV file header, to map the 
+            SelectArray of the PSA file to column names (see 
+            psa_channel_array). Required unless channels is given
+        std_pass_one: float
+        std_pass_two: float
+        scans_per_block: int
+        min_delta: float
+            Parameters overriding the values of the PSA file
+        profile_id: str
+            Name of column containing the profile name
+        workers: int | None
+            Number of processes used to edit the profiles
+    Returns:
+        pandas.DataFrame
+        Copy of df with the edited points set to NaN
+    """
+    settings = psa_xml.psa_settings(psa_file or os.path.join(PSA_TEMPLATE_FOLDER, 'MI_wildeditTemplate.psa'))
+    if channels is None:
+        channels = list(psa_channel_array(settings, 'SelectArray', cnv_columns, df.columns))
+    channels = [col for col in channels if col in df.columns]
+    edit = partial(_wildedit_profile, channels=channels,
+                   std_pass_one=settings['StdDevPassOne'] if std_pass_one is None else std_pass_one,
+                   std_pass_two=settings['StdDevPassTwo'] if std_pass_two is None else std_pass_two,
+                   scans_per_block=int(settings['ScansPerBlock'] if scans_per_block is None else scans_per_block),
+                   min_delta=settings['MinDelta'] if min_delta is None else min_delta)
+    return apply_per_profile(df, edit, profile_id=profile_id, workers=workers)
+
+#%%
+def align_channels(df, advances, profile_id='profile', time='timeS'):
+    """
+    SBE AlignCTD: advance channels relative to the time (and pressure) of 
+    each scan by a number of seconds, e.g. {'sbeox0V': 2.5} replaces the 
+    oxygen voltage at time t with the voltage measured at t + 2.5 s. The 
+    advance can be a fraction of the scan interval, the values are linearly
+    interpolated in time. Negative values delay the channel.
+
+    All profiles are aligned at once: the rows are sorted by profile and 
+    time and the times of each profile are offset so the profiles do not 
+    overlap, then each channel is interpolated with a single numpy.interp.
+    Values are not taken across profiles, times outside the valid samples 
+    of the profile are NaN (as for a shift at the ends of a profile) and 
+    NaN values within the profile are interpolated over.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data, at the full scan rate or averaged in time (e.g. 2Hz)
+        advances: dict
+            {column: advance (s)}, e.g. for oxygen, conductivity or 
+            ancillary sensor channels
+        profile_id: str
+            Name of column containing the profile name
+        time: str
+            Name of the elapsed time column
+    Returns:
+        pandas.DataFrame
+        Copy of df with the aligned channels
+    """
+    out = df.copy()
+    advances = {col: float(advance) for col, advance in advances.items() if col in df.columns}
+    if len(out) == 0 or len(advances) == 0:
+        return out
+
+    codes, _ = pd.factorize(df[profile_id])
+    t = df[time].to_numpy(dtype=np.float64)
+    order = np.lexsort((t, codes))
+    codes, t = codes[order], t[order]
+    # Offset of each profile, larger than any profile duration plus advance
+    span = np.nanmax(t) - np.nanmin(t) + 2 * max(abs(advance) for advance in advances.values()) + 1.
+    t_all = t + codes * span
+
+    for col, advance in advances.items():
+        values = df[col].to_numpy(dtype=np.float64)[order]
+        valid = ~np.isnan(values) & ~np.isnan(t_all)
+        target = t_all + advance
+        aligned = np.full(len(values), np.nan)
+        if valid.any():
+            aligned = np.interp(target, t_all[valid], values[valid])
+            # First and last valid sample of the profile of each row
+            valid_codes, valid_t = codes[valid], t_all[valid]
+            first = np.searchsorted(valid_codes, codes, side='left')
+            last = np.searchsorted(valid_codes, codes, side='right') - 1
+            with np.errstate(invalid='ignore'):
+                inside = ((first <= last) & (target >= valid_t[np.minimum(first, len(valid_t) - 1)])
+                          & (target <= valid_t[np.maximum(last, 0)]))
+            aligned[~inside] = np.nan
+        result = np.empty(len(values))
+        result[order] = aligned
+        out[col] = result.astype(df[col].dtype if df[col].dtype == np.float32 else np.float64, copy=False)
+    return out
+
+#%%
+def low_pass(values, time_constant, sample_interval):
+    """
+    SBE Filter single pole low-pass filter, run forward then backward so
+    there is no phase shift: y[n] = A (x[n] + x[n-1]) - B y[n-1] with
+    A = 1 / (1 + 2 tc / dt) and B = A (1 - 2 tc / dt). Each pass starts from
+    the first value of the pass (steady state). NaN values are interpolated
+    for filtering and NaN again in the output.
+
+    Parameters:
+        values: numpy.ndarray
+            Array of shape (scans,) or (scans, channels)
+        time_constant: float
+            Time constant (s)
+        sample_interval: float
+            Time between scans (s)
+    Returns:
+        numpy.ndarray
+        Filtered float64 array of the same shape
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if time_constant <= 0 or len(values) < 2:
+        return values.copy()
+    one_dim = values.ndim == 1
+    x = values.reshape(len(values), -1).copy()
+    missing = np.isnan(x)
+    scan = np.arange(len(x))
+    for i in np.flatnonzero(missing.any(axis=0) & ~missing.all(axis=0)):
+        x[missing[:, i], i] = np.interp(scan[missing[:, i]], scan[~missing[:, i]], x[~missing[:, i], i])
+
+    ratio = 2. * time_constant / sample_interval
+    a = 1. / (1. + ratio)
+    b_coef, a_coef = [a, a], [1., a * (1. - ratio)]
+    zi = signal.lfilter_zi(b_coef, a_coef)[:, None]
+    y, _ = signal.lfilter(b_coef, a_coef, x, axis=0, zi=zi * x[:1])
+    y = y[::-1]
+    y, _ = signal.lfilter(b_coef, a_coef, y, axis=0, zi=zi * y[:1])
+    y = y[::-1]
+    y[missing] = np.nan
+    return y[:, 0] if one_dim else y
+
+def _filter_profile(df, filters, sample_interval, time):
+    """
+    Filter the channels of a single profile, see filter_channels
+    """
+    out = df.copy()
+    if len(out) < 2:
+        return out
+    if sample_interval is None:
+        sample_interval = float(np.nanmedian(np.diff(out[time].to_numpy()))) if time in out.columns else 1. / SCAN_RATE
+    # Channels with the same filter are filtered together as one 2D array
+    groups = {}
+    for col, (time_constant, high_pass) in filters.items():
+        groups.setdefault((time_constant, high_pass), []).append(col)
+    for (time_constant, high_pass), cols in groups.items():
+        values = out[cols].to_numpy(dtype=np.float64)
+        filtered = low_pass(values, time_constant, sample_interval)
+        if high_pass:
+            filtered = values - filtered
+        for i, col in enumerate(cols):
+            out[col] = filtered[:, i].astype(out[col].dtype, copy=False)
+    return out
+
+def filter_channels(df, psa_file=None, filters=None, cnv_columns=None, sample_interval=None,
+                    time='timeS', profile_id='profile', workers=None):
+    """
+    SBE Filter: low-pass (or high-pass) filtering of channels with the 
+    filter A or B time constants, applied to each profile with 
+    scipy.signal.lfilter on contiguous arrays.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data at the full scan rate
+        psa_file: str
+            Filter PSA file for the time constants and the filter of each
+            channel, the MI_filterTemplate.psa template if None
+        filters: dict
+            {column: time constant (s)} of the low-pass filters to apply. By 
+            default from the FilterTypeArray of the PSA file (1: low-pass A,
+            2: low-pass B, 3: high-pass A, 4: high-pass B)
+        cnv_columns: list
+            Column names in the order of the CNV file header, to map the 
+            FilterTypeArray of the PSA file to column names (see 
+            psa_channel_array). Required unless filters is given
+        sample_interval: float
+            Time between scans (s). By default the median interval of the
+            time column of each profile
+        time: str
+            Name of the elapsed time column
+        profile_id: str
+            Name of column containing the profile name
+        workers: int | None
+            Number of processes used to filter the profiles
+    Returns:
+        pandas.DataFrame
+        Copy of df with the filtered channels
+    """
+    if filters is None:
+        settings = psa_xml.psa_settings(psa_file or os.path.join(PSA_TEMPLATE_FOLDER, 'MI_filterTemplate.psa'))
+        time_constants = {1: (settings['TimeConstFilterA'], False), 2: (settings['TimeConstFilterB'], False),
+                          3: (settings['TimeConstFilterA'], True), 4: (settings['TimeConstFilterB'], True)}
+        filters = {col: time_constants[int(filter_type)]
+                   for col, filter_type in psa_channel_array(settings, 'FilterTypeArray', cnv_columns, df.columns).items()}
+    else:
+        filters = {col: (time_constant, False) for col, time_constant in filters.items()}
+    filters = {col: item for col, item in filters.items() if col in df.columns}
+    apply_filter = partial(_filter_profile, filters=filters, sample_interval=sample_interval, time=time)
+    return apply_per_profile(df, apply_filter, profile_id=profile_id, workers=workers)
+
+#%%
+def practical_salinity(c, t, p):
+    """
+    Practical salinity from conductivity c (S/m), temperature t (ITS-90,
+    deg C) and pressure p (dbar)
+    """
+    return seawater.salt(c * 10. / C3515, t, p)
+
+def thermal_mass_correction(temperature, alpha, tau, sample_interval):
+    """
+    SBE CellTM conductivity correction (S/m) for the thermal mass of the 
+    conductivity cell:
+        a = 2 alpha / (sample_interval beta + 2), with beta = 1 / tau
+        b = 1 - 2 a / alpha
+        dc/dT = 0.1 (1 + 0.006 (T - 20))
+        ctm[n] = -b ctm[n-1] + a dc/dT (T[n] - T[n-1])
+    The recursion is run with scipy.signal.lfilter, starting from 0 at the
+    first scan. NaN temperatures are interpolated.
+
+    Parameters:
+        temperature: numpy.ndarray
+            ITS-90 temperature (deg C) of a single profile
+        alpha: float
+            Thermal anomaly amplitude
+        tau: float
+            Thermal anomaly time constant (s)
+        sample_interval: float
+            Time between scans (s)
+    Returns:
+        numpy.ndarray
+        Correction to add to the conductivity (S/m)
+    """
+    t = np.asarray(temperature, dtype=np.float64).copy()
+    missing = np.isnan(t)
+    if len(t) < 2 or missing.all():
+        return np.zeros(len(t))
+    if missing.any():
+        scan = np.arange(len(t))
+        t[missing] = np.interp(scan[missing], scan[~missing], t[~missing])
+    a = 2. * alpha / (sample_interval / tau + 2.)
+    b = 1. - 2. * a / alpha
+    dcdt = 0.1 * (1. + 0.006 * (t - 20.))
+    dt = np.diff(t, prepend=t[0])
+    return signal.lfilter([1.], [1., b], a * dcdt * dt)
+
+def _celltm_profile(df, sections, sample_interval, time, pressure):
+    """
+    Cell Thermal Mass correction of a single profile, see celltm
+    """
+    out = df.copy()
+    if len(out) < 2:
+        return out
+    if sample_interval is None:
+        sample_interval = float(np.nanmedian(np.diff(out[time].to_numpy()))) if time in out.columns else 1. / SCAN_RATE
+    for temperature, conductivity, scale, salinity, alpha, tau in sections:
+        t = out[temperature].to_numpy(dtype=np.float64)
+        c = out[conductivity].to_numpy(dtype=np.float64) + thermal_mass_correction(t, alpha, tau, sample_interval) / scale
+        out[conductivity] = c.astype(out[conductivity].dtype, copy=False)
+        if salinity in out.columns and pressure in out.columns:
+            sal = practical_salinity(c * scale, t, out[pressure].to_numpy(dtype=np.float64))
+            out[salinity] = sal.astype(out[salinity].dtype, copy=False)
+    return out
+
+def celltm(df, psa_file=None, alpha=None, tau=None, sample_interval=None, time='timeS', pressure='prDM',
+           profile_id='profile', workers=None):
+    """
+    SBE Cell Thermal Mass: correction of the primary and secondary 
+    conductivity for the thermal mass of the conductivity cell, applied to 
+    each profile, see thermal_mass_correction. The practical salinity of a 
+    corrected sensor (sal00 and sal11) is recalculated from the corrected
+    conductivity.
+
+    Parameters:
+        df: pandas.DataFrame
+            Profile data at the full scan rate with the temperature (t090C, 
+            t190C) and conductivity (c0S/m, c1S/m or mS/cm, uS/cm) columns
+        psa_file: str
+            Cell Thermal Mass PSA file for the sensors to correct and the 
+            alpha and tau of each sensor, the MI_celltmTemplate.psa template
+            if None
+        alpha: float
+        tau: float
+            Thermal anomaly amplitude and time constant (s) overriding the 
+            values of the PSA file for both sensors
+        sample_interval: float
+            Time between scans (s). By default the median interval of the
+            time column of each profile
+        time: str
+            Name of the elapsed time column
+        pressure: str
+            Name of the pressure column for the salinity
+        profile_id: str
+            Name of column containing the profile name
+        workers: int | None
+            Number of processes used to correct the profiles
+    Returns:
+        pandas.DataFrame
+        Copy of df with the corrected conductivity and salinity
+    """
+    settings = psa_xml.psa_settings(psa_file or os.path.join(PSA_TEMPLATE_FOLDER, 'MI_celltmTemplate.psa'))
+    sections = []
+    for section, (ordinal, salinity) in CELLTM_SECTIONS.items():
+        if section not in settings or not settings[section]['Correct']:
+            continue
+        temperature = 't%d90C' % settings[section]['TempSensor']
+        conductivity = [('c%d%s' % (ordinal, unit), scale) for unit, scale in CONDUCTIVITY_UNITS.items()
+                        if 'c%d%s' % (ordinal, unit) in df.columns]
+        if temperature not in df.columns or len(conductivity) == 0:
+            continue
+        sections.append((temperature, *conductivity[0], salinity,
+                         settings[section]['TA_Amplitude'] if alpha is None else alpha,
+                         settings[section]['TA_TimeConstant'] if tau is None else tau))
+    correct = partial(_celltm_profile, sections=sections, sample_interval=sample_interval, time=time, pressure=pressure)
+    return apply_per_profile(df, correct, profile_id=profile_id, workers=workers)
@@ -5,11 +5,17 @@ Created on Tue Mar 26 09:29:53 2024
 @author: dosullivan1
 """
 import os
+import hashlib
 from pathlib import Path
 import xml.etree.ElementTree as elementTree
 import pandas as pd 
 from IPython.display import display
-from .filename_matching import replace_extension, match_stem_caseinsensitive
+from .filename_matching import replace_extension, match_stem_caseinsensitive, file_index
+
+# Sensor mappings parsed from XMLCON files, {content hash: sensor_dict}
+_sensor_configs = {}
+# Content hash of each XMLCON file read, {path: (size, mtime, content hash)}
+_config_hashes = {}
 
 #%% 
 def get_sensor_coefficients(master_sensor_coeffs,
@@ -67,7 +73,9 @@ def get_sensor_coefficients(master_sensor_coeffs,
 def file_sensor_config(directory, file):            
     """
     Creates a dictionary of sensors attached to each voltage channel based 
-    on the XMLCON file  
+    on the XMLCON file. The directory listing is cached and each XMLCON 
+    file is parsed once per content (files with the same configuration share
+    the parsed result).
     
     Parameters
     ----------
@@ -86,9 +94,36 @@ def file_sensor_config(directory, file):
     
     
     config_file = Path(directory).joinpath(match_stem_caseinsensitive(file, search_path=directory, searched_extension=".xmlcon"))
-    config_xml = elementTree.parse(config_file)
-    config = config_xml.getroot()
     
+    # Only read files that are new or changed since they were last hashed
+    stat = os.stat(config_file)
+    cached = _config_hashes.get(str(config_file))
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        digest = cached[2]
+    else:
+        with open(config_file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        _config_hashes[str(config_file)] = (stat.st_size, stat.st_mtime_ns, digest)
+        if digest not in _sensor_configs:
+            _sensor_configs[digest] = sensor_array_config(elementTree.fromstring(content))
+    
+    return dict(_sensor_configs[digest])
+
+
+def sensor_array_config(config):
+    """
+    Parameters
+    ----------
+    config: xml.etree.ElementTree.Element
+        Root element of an XMLCON file
+    
+    Returns
+    -------
+    dict
+        Voltage channels on the CTD rig with the sensors and serial numbers 
+        attached to each voltage channel
+    """
     # Initialise dictionary to use to store sensor information
     sensor_dict = {}
     # Search XMLCON to find Sensor Array and the number of sensors within the file
@@ -137,7 +172,7 @@ def sensor_config(directory, cruiseID):
             # df_sensor = pd.DataFrame(sensor_dict, index=[file.lower().replace('.xmlcon','')])
             # df_cast_sensors = pd.concat([df_cast_sensors,df_sensor])
     sensor_conf_extension = "XMLCON"
-    xmlcon_files = [str(file) for file in Path(directory).rglob(f"*") if file.suffix.lower() == f'.{sensor_conf_extension.lower()}']
+    xmlcon_files = [str(file) for file in file_index(directory, recursive=True).with_extension(f'.{sensor_conf_extension.lower()}')]
     for fi in xmlcon_files:
         fi_name = Path(fi).name
         sensor_dict = file_sensor_config(directory, fi_name)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Stage artifact store for the cruise-wide 2 Hz datasets.
+
+Each processing stage (SBE processed, screen ready, heave screened) is stored
+as a directory of Parquet files with one file per profile. Column types are
+kept between stages, the profiles in a stage are known from the file names
+without reading any data, and reads can be limited to a subset of profiles
+and columns.
+
+    <directory>/cruise_SBEproc_2Hz.parquet/<profile>.parquet
+"""
+import os
+import shutil
+from urllib.parse import quote, unquote
+import pandas as pd
+
+# Stage names and the base names of the stage datasets
+STAGES = {'SBEproc': 'cruise_SBEproc_2Hz',
+          'screenready': 'cruise_screenready_2Hz',
+          'heavescreened': 'cruise_heavescreened_2Hz',
+          }
+PARTITION_SUFFIX = '.parquet'
+
+#%%
+def stage_path(directory, stage):
+    """
+    Parameters:
+        directory: str
+            Output directory of the cruise-wide datasets (e.g. all_2Hz)
+        stage: str
+            Key of STAGES or a dataset base name
+    Returns:
+        str
+        Path of the stage dataset directory
+    """
+    return os.path.join(directory, STAGES.get(stage, stage) + PARTITION_SUFFIX)
+
+def _partition_file(path, profile):
+    """
+    Returns:
+        str
+        Path of the partition file of a profile, with the profile name escaped
+        so that it is a valid file name
+    """
+    return os.path.join(path, quote(str(profile), safe='') + PARTITION_SUFFIX)
+
+def stage_exists(directory, stage):
+    """
+    Returns:
+        bool
+        True if the stage has at least one profile stored
+    """
+    return len(stage_profiles(directory, stage)) > 0
+
+def stage_profiles(directory, stage):
+    """
+    List the profiles stored for a stage from the partition file names.
+
+    Parameters:
+        directory: str
+        stage: str
+    Returns:
+        list
+        Sorted profile names
+    """
+    path = stage_path(directory, stage)
+    if not os.path.isdir(path):
+        return []
+    return sorted(unquote(item[:-len(PARTITION_SUFFIX)]) for item in os.listdir(path)
+                  if item.endswith(PARTITION_SUFFIX))
+
+#%%
+def write_stage(data, directory, stage, partition_on='profile', replace=True):
+    """
+    Write a cruise-wide DataFrame to the stage store, one Parquet file per
+    profile. The DataFrame index is stored with the data.
+
+    Parameters:
+        data: pandas.DataFrame
+        directory: str
+            Output directory of the cruise-wide datasets
+        stage: str
+            Key of STAGES or a dataset base name
+        partition_on: str
+            Column with the profile names
+        replace: bool
+            True to replace all stored profiles of the stage, False to only
+            replace (or add) the profiles present in data. With True, the 
+            stage is written to a temporary directory swapped in once all 
+            profiles are written, so a failed write keeps the stored stage
+    Returns:
+        str
+        Path of the stage dataset directory
+    """
+    if partition_on not in data.columns:
+        raise KeyError("Column %s required to partition the %s stage is not in the data." % (partition_on, stage))
+    missing = data[partition_on].isna()
+    if missing.any():
+        raise ValueError("%s rows without a %s cannot be stored in the %s stage." % (missing.sum(), partition_on, stage))
+    path = stage_path(directory, stage)
+    if replace:
+        write_path = '%s.%s.tmp' % (path, os.getpid())
+        if os.path.isdir(write_path):
+            shutil.rmtree(write_path)
+    else:
+        write_path = path
+    os.makedirs(write_path, exist_ok=True)
+
+    try:
+        # Only the profiles present in data, not every category of a categorical profile column
+        for profile, group in data.groupby(partition_on, sort=False, observed=True):
+            if group.empty:
+                # An empty partition would overwrite a stored profile
+                continue
+            file = _partition_file(write_path, profile)
+            # Write to a temporary file first so an interrupted write does not
+            # leave a truncated partition behind
+            temp_file = file + '.tmp'
+            group.to_parquet(temp_file)
+            os.replace(temp_file, file)
+    except BaseException:
+        if replace:
+            shutil.rmtree(write_path, ignore_errors=True)
+        raise
+
+    if replace:
+        # A directory can only be renamed onto a missing or empty one, so the
+        # stored stage is moved aside first and restored if the swap fails
+        old_path = '%s.%s.old' % (path, os.getpid())
+        if os.path.isdir(path):
+            os.replace(path, old_path)
+        try:
+            os.replace(write_path, path)
+        except OSError:
+            if os.path.isdir(old_path):
+                os.replace(old_path, path)
+            raise
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    return path
+
+def read_stage(directory, stage, profiles=None, columns=None):
+    """
+    Read a stage from the store. Only the partition files of the requested
+    profiles and the requested columns are read.
+
+    Parameters:
+        directory: str
+            Output directory of the cruise-wide datasets
+        stage: str
+            Key of STAGES or a dataset base name
+        profiles: list
+            Profiles to read. All stored profiles are read if None
+        columns: list
+            Columns to read. All columns are read if None
+    Returns:
+        pandas.DataFrame
+        Profiles concatenated in profile name order, with the stored index
+    """
+    path = stage_path(directory, stage)
+    stored = stage_profiles(directory, stage)
+    if profiles is not None:
+        profiles = set(profiles)
+        stored = [item for item in stored if item in profiles]
+    if len(stored) == 0:
+        return pd.DataFrame(columns=columns)
+
+    frames = [pd.read_parquet(_partition_file(path, profile), columns=columns) for profile in stored]
+    return pd.concat(frames, sort=False)
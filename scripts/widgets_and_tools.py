@@ -1,5 +1,6 @@
 import re
 from os.path import commonprefix
+from typing import Callable
 
 import ipywidgets as widgets
 import pandas as pd
@@ -105,16 +106,24 @@ def update_flag_widget(casts, widget_group, widget_casts, widget_qc, df):
 
 
 def update_flag(flag, widget_group, widget_casts, widget_qc, df, write_to):
-    df.loc[
-        (df[column_casts].isin(widget_casts.value))
-        & (df[column_group] == widget_group.value),
-        column_qc_flag,
-    ] = QC_flags[widget_qc.value]
+    edited = (df[column_casts].isin(widget_casts.value)) & (df[column_group] == widget_group.value)
+    df.loc[edited, column_qc_flag] = QC_flags[widget_qc.value]
     if write_to:
-        df.to_csv(write_to, index=False)
+        write_flags(df, write_to, rows=edited)
         # df.to_csv(write_to, index=False, usecols=set(df.columns).difference([column_group, column_casts]))
 
 
+def write_flags(
+    df: pd.DataFrame, write_to: str | Callable[[pd.DataFrame], None], rows: pd.Series | None = None
+) -> None:
+    # write_to is either a csv file path or a function storing the DataFrame (e.g. in the stage store).
+    # A function only gets the edited rows when given, the csv file is always rewritten in full
+    if callable(write_to):
+        write_to(df if rows is None else df[rows])
+    else:
+        df.to_csv(write_to, index=False)
+
+
 def add_group_casts_columns_to_df(
     df: pd.DataFrame, base_column: str = "profile"
 ) -> pd.DataFrame:
@@ -137,13 +146,16 @@ def add_group_casts_columns_to_df(
 
 
 def display_flagging_widgets(
-    df: pd.DataFrame, write_to: str | None = None, base_column: str = "profile"
+    df: pd.DataFrame,
+    write_to: str | Callable[[pd.DataFrame], None] | None = None,
+    base_column: str = "profile",
 ) -> dict[str, widgets.widgets.widget.Widget]:
     df = add_group_casts_columns_to_df(df, base_column=base_column)
     if column_qc_flag not in df.columns:
         df[column_qc_flag] = 0
         # df.to_csv(write_to, index=False, usecols=set(df.columns).difference([column_group, column_casts]))
-        df.to_csv(write_to, index=False)
+        if write_to:
+            write_flags(df, write_to)
     group_widget = create_group_widget(df=df)
     init_options_casts = sorted(list(df.loc[df[column_group] == group_widget.value, column_casts].unique()))  # type: ignore
     casts_widget = create_casts_widget(init_options=init_options_casts)